@@ -0,0 +1,167 @@
+ #!/bin/env python
+
+'''
+Training and evaluation samples/s and peak memory of the temporal attention variants (MODEL: TEMPORAL_WINDOW and TEMPORAL_ATTENTION)
+at several segment lengths, for randomly initialized models of NTU_2D shape. Every measurement runs in a fresh process, so the peak memory
+of one does not hide the next: on CUDA the peak allocated memory, on CPU the growth of the peak resident memory over the model and data.
+Variants: full (softmax attention over all frames), window:<frames> (windowed attention with the class token as global token)
+or linear (kernelized attention)
+With --train_file and --test_file every variant is also trained for --epochs on the NTU_2D segments of every length and its test accuracy reported.
+
+e.g. python attention_benchmark.py --model_type spatial-temporal --segment_lens 60 120 300 --variants full window:8 window:16 linear
+'''
+
+import torch
+import torch.nn as nn
+import numpy as np
+import multiprocessing
+import pickle
+import resource
+import time
+import argparse
+from prettytable import PrettyTable
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+
+from transformer import TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer
+from utils import SetupLogger
+
+
+def build(model_type, variant, segment_len, embed_dim):
+    kwargs = dict(num_frames=segment_len, num_classes=120, num_joints=25, in_chans=2, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+    if variant.startswith('window:'):
+        kwargs['temporal_window'] = int(variant.split(':')[1])
+    elif variant == 'linear':
+        kwargs['temporal_attention'] = 'linear'
+    elif variant != 'full':
+        raise Exception('variant must be full, window:<frames> or linear, got %s' % variant)
+
+    if model_type == 'temporal':
+        return TemporalTransformer(embed_dim=embed_dim, **kwargs)
+    elif model_type == 'spatial-temporal':
+        return SpatialTemporalTransformer(embed_dim_ratio=embed_dim, **kwargs)
+    elif model_type == 'parts':
+        return BodyPartTransformer(dataset='NTU_2D', embed_dim_ratio=embed_dim, **kwargs)
+    raise Exception('model_type must be temporal, spatial-temporal or parts')
+
+def measure(model_type, variant, segment_len, embed_dim, batch_size, steps, threads):
+    '''
+    Runs in its own process, returns the training and evaluation samples/s and the peak memory in MB
+    '''
+    torch.set_num_threads(threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = build(model_type, variant, segment_len, embed_dim).to(device)
+    data = torch.randn(batch_size, segment_len, 50, device=device)
+    labels = torch.randint(120, (batch_size,), device=device)
+    optim = torch.optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.98), eps=1e-9)
+    cross_entropy_loss = nn.CrossEntropyLoss()
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    model.train()
+    for step in range(steps + 1):
+        if step == 1:
+            synchronize()
+            begin = time.perf_counter() # the first step is warmup
+        optim.zero_grad(set_to_none=True)
+        cross_entropy_loss(model(data), labels).backward()
+        optim.step()
+    synchronize()
+    train_speed = steps * batch_size / (time.perf_counter() - begin)
+
+    model.eval()
+    with torch.no_grad():
+        model(data)
+        synchronize()
+        begin = time.perf_counter()
+        for _ in range(steps):
+            model(data)
+        synchronize()
+    eval_speed = steps * batch_size / (time.perf_counter() - begin)
+
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+    return train_speed, eval_speed, peak
+
+def load_segments(path, segment_len):
+    from trajectory import extract_fixed_sized_segments, remove_short_trajectories
+    with open(path, "rb") as f:
+        trajectories = remove_short_trajectories(pickle.load(f), input_length=segment_len, input_gap=0, pred_length=0)
+    _, _, _, _, categories, X = extract_fixed_sized_segments('NTU_2D', trajectories, input_length=segment_len)
+    return torch.tensor(X, dtype=torch.float32), torch.tensor(categories[:, 0].astype(np.int64))
+
+def train_and_test(model_type, variant, segment_len, embed_dim, batch_size, threads, train_file, test_file, epochs, lr):
+    '''
+    Runs in its own process, trains a model from scratch on the NTU_2D segments and returns its test accuracy and balanced accuracy
+    '''
+    torch.set_num_threads(threads)
+    torch.manual_seed(0) # the same initialization and batches for all variants
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = build(model_type, variant, segment_len, embed_dim).to(device)
+    train_data, train_labels = load_segments(train_file, segment_len)
+    test_data, test_labels = load_segments(test_file, segment_len)
+    optim = torch.optim.Adam(model.parameters(), lr=lr, betas=(0.9, 0.98), eps=1e-9)
+    cross_entropy_loss = nn.CrossEntropyLoss()
+
+    model.train()
+    for epoch in range(epochs):
+        for index in torch.split(torch.randperm(len(train_data)), batch_size):
+            optim.zero_grad(set_to_none=True)
+            cross_entropy_loss(model(train_data[index].to(device)), train_labels[index].to(device)).backward()
+            optim.step()
+
+    model.eval()
+    with torch.no_grad():
+        predictions = torch.cat([model(batch.to(device)).argmax(dim=1).cpu() for batch in torch.split(test_data, batch_size)])
+    return accuracy_score(test_labels, predictions), balanced_accuracy_score(test_labels, predictions)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", help="temporal, spatial-temporal or parts", default='temporal')
+    parser.add_argument("--segment_lens", help="segment lengths in frames", default=[60, 120, 300], type=int, nargs='+')
+    parser.add_argument("--variants", help="attention variants: full, window:<frames> or linear", default=['full', 'window:8', 'window:16', 'linear'], nargs='+')
+    parser.add_argument("--embed_dim", help="EMBED_DIM of the models", default=32, type=int)
+    parser.add_argument("--batch_size", help="number of segments per batch", default=64, type=int)
+    parser.add_argument("--steps", help="number of timed batches", default=5, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    parser.add_argument("--train_file", help="pickled NTU_2D train trajectories for the accuracy comparison, e.g. trajectories_train_NTU_2D.dat")
+    parser.add_argument("--test_file", help="pickled NTU_2D test trajectories for the accuracy comparison, e.g. trajectories_test_NTU_2D.dat")
+    parser.add_argument("--epochs", help="number of training epochs of the accuracy comparison", default=10, type=int)
+    parser.add_argument("--lr", help="learning rate of the accuracy comparison", default=1e-3, type=float)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+
+    # spawn: a fresh process for every measurement, with its own peak memory
+    context = multiprocessing.get_context('spawn')
+    compare_accuracy = args.train_file and args.test_file
+    columns = ['SEGMENT LEN', 'ATTENTION', 'TRAIN SAMPLES/S', 'TRAIN SPEEDUP', 'EVAL SAMPLES/S', 'EVAL SPEEDUP', 'PEAK MEMORY (MB)', 'MEMORY RATIO']
+    if compare_accuracy:
+        columns += ['ACCURACY', 'BALANCED ACCURACY']
+    t = PrettyTable(columns)
+    for segment_len in args.segment_lens:
+        reference = None
+        for variant in args.variants:
+            with context.Pool(1) as pool:
+                train_speed, eval_speed, peak = pool.apply(measure, (args.model_type, variant, segment_len, args.embed_dim, args.batch_size, args.steps, args.threads))
+                if compare_accuracy:
+                    accuracy, balanced_accuracy = pool.apply(train_and_test, (args.model_type, variant, segment_len, args.embed_dim, args.batch_size, args.threads,
+                                                                              args.train_file, args.test_file, args.epochs, args.lr))
+            reference = reference or (train_speed, eval_speed, peak)
+            row = [segment_len, variant, '%.1f' % train_speed, '%.2f' % (train_speed / reference[0]), '%.1f' % eval_speed, '%.2f' % (eval_speed / reference[1]),
+                   '%.1f' % peak, '%.2f' % (peak / reference[2])]
+            if compare_accuracy:
+                row += ['%.4f' % accuracy, '%.4f' % balanced_accuracy]
+            t.add_row(row)
+            logger.info("%d frames, %s done", segment_len, variant)
+
+    logger.info('\n' + str(t))
@@ -0,0 +1,92 @@
+ #!/bin/env python
+
+'''
+Compares float32 with bfloat16 autocast (TRAINING: AUTOCAST) for a trained model:
+training and evaluation samples/s, and the accuracy of the model on the test set in both precisions.
+'''
+
+import torch
+import torch.nn as nn
+import numpy as np
+import pickle
+import time
+import argparse
+from prettytable import PrettyTable
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+
+from trajectory import extract_fixed_sized_segments, remove_short_trajectories
+from utils import SetupLogger, load_checkpoint, check_all_frames, load_model, autocast
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", help="checkpoint of a trained model, e.g. <name>_fold_1.pt")
+parser.add_argument("--test_file", help="pickled test trajectories, e.g. trajectories_test_NTU_2D.dat")
+parser.add_argument("--dataset", help="dataset of the test trajectories (default: from the checkpoint manifest)")
+parser.add_argument("--segment_len", help="number of frames per segment (default: from the checkpoint manifest)", type=int)
+parser.add_argument("--precisions", help="autocast dtypes to compare with float32", default=['bfloat16'], nargs='+')
+parser.add_argument("--batch_size", help="number of segments per forward pass", default=500, type=int)
+parser.add_argument("--max_segments", help="number of test segments to evaluate, 0 for all", default=20000, type=int)
+parser.add_argument("--train_steps", help="number of timed training steps", default=10, type=int)
+args = parser.parse_args()
+
+logger = SetupLogger('logger')
+logger.info('parser args: %s', str(args))
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+_, manifest = load_checkpoint(args.model)
+check_all_frames(manifest, args.model)
+layout = manifest['layout'] if manifest else {}
+dataset = args.dataset or layout.get('dataset')
+segment_len = args.segment_len or layout.get('segment_length')
+if dataset is None or segment_len is None:
+    raise Exception('--dataset and --segment_len are needed for models without a manifest')
+
+with open(args.test_file, "rb") as f:
+    test_trajectories = remove_short_trajectories(pickle.load(f), input_length=segment_len, input_gap=0, pred_length=0)
+_, _, _, _, categories, X = extract_fixed_sized_segments(dataset, test_trajectories, input_length=segment_len)
+if args.max_segments:
+    # a fixed random subset, the same for all precisions
+    subset = np.random.RandomState(0).permutation(len(X))[:args.max_segments]
+    categories, X = categories[subset], X[subset]
+data = torch.tensor(X, dtype=torch.float32)
+labels = torch.tensor(categories[:, 0].astype(np.int64))
+logger.info("%d test segments of %d frames", len(data), segment_len)
+
+def evaluate(model, precision):
+    model.eval()
+    outputs = []
+    begin = time.perf_counter()
+    with torch.no_grad(), autocast(device, precision):
+        for batch in torch.split(data, args.batch_size):
+            outputs.append(model(batch.to(device)).float().cpu())
+    return torch.cat(outputs), len(data) / (time.perf_counter() - begin)
+
+def train(model, precision):
+    model.train()
+    optim = torch.optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.98), eps=1e-9)
+    cross_entropy_loss = nn.CrossEntropyLoss()
+    batch, batch_labels = data[:args.batch_size].to(device), labels[:args.batch_size].to(device)
+    for step in range(args.train_steps + 1):
+        if step == 1:
+            begin = time.perf_counter() # the first step is warmup
+        optim.zero_grad(set_to_none=True)
+        with autocast(device, precision):
+            output = model(batch)
+        cross_entropy_loss(output, batch_labels).backward()
+        optim.step()
+    return args.train_steps * len(batch) / (time.perf_counter() - begin)
+
+t = PrettyTable(['PRECISION', 'TRAIN SAMPLES/S', 'TRAIN SPEEDUP', 'EVAL SAMPLES/S', 'EVAL SPEEDUP', 'ACCURACY', 'BALANCED ACCURACY', 'SAME PREDICTION', 'MAX LOG-LIKELIHOOD DIFF'])
+for precision in [None] + args.precisions:
+    log_likelihoods, eval_speed = evaluate(load_model(args.model, device), precision)
+    train_speed = train(load_model(args.model, device), precision) # a fresh copy, training changes the weights
+    predictions = log_likelihoods.argmax(dim=1)
+    if precision is None:
+        reference_log_likelihoods, reference_predictions, reference_train_speed, reference_eval_speed = log_likelihoods, predictions, train_speed, eval_speed
+
+    t.add_row([precision or 'float32', '%.1f' % train_speed, '%.2f' % (train_speed / reference_train_speed), '%.1f' % eval_speed, '%.2f' % (eval_speed / reference_eval_speed),
+               '%.4f' % accuracy_score(labels, predictions), '%.4f' % balanced_accuracy_score(labels, predictions),
+               '%.4f' % (predictions == reference_predictions).float().mean().item(), '%.2e' % (log_likelihoods - reference_log_likelihoods).abs().max().item()])
+    logger.info("%s done", precision or 'float32')
+
+logger.info('\n' + str(t))
@@ -0,0 +1,90 @@
+ #!/bin/env python
+
+'''
+Peak training memory and training samples/s with and without activation checkpointing (TRAINING: ACTIVATION_CHECKPOINTING)
+at several batch sizes and segment lengths, for randomly initialized models of NTU_2D shape. Every measurement runs in a fresh
+process, so the peak memory of one does not hide the next: on CUDA the peak allocated memory, on CPU the growth of the peak
+resident memory over the model and data.
+Modes: none, block (every Block recomputes its activations) or tower (every spatial tower does)
+
+e.g. python checkpoint_benchmark.py --model_type spatial-temporal --batch_sizes 100 500 --segment_lens 60 --modes none block tower
+'''
+
+import torch
+import torch.nn as nn
+import multiprocessing
+import resource
+import time
+import argparse
+from prettytable import PrettyTable
+
+from attention_benchmark import build
+from transformer import set_activation_checkpointing
+from utils import SetupLogger
+
+
+def measure(model_type, mode, batch_size, segment_len, embed_dim, steps, threads):
+    '''
+    Runs in its own process, returns the training samples/s and the peak memory in MB
+    '''
+    torch.set_num_threads(threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = set_activation_checkpointing(build(model_type, 'full', segment_len, embed_dim), None if mode == 'none' else mode).to(device).train()
+    data = torch.randn(batch_size, segment_len, 50, device=device)
+    labels = torch.randint(120, (batch_size,), device=device)
+    optim = torch.optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.98), eps=1e-9)
+    cross_entropy_loss = nn.CrossEntropyLoss()
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    for step in range(steps + 1):
+        if step == 1:
+            synchronize()
+            begin = time.perf_counter() # the first step is warmup
+        optim.zero_grad(set_to_none=True)
+        cross_entropy_loss(model(data), labels).backward()
+        optim.step()
+    synchronize()
+    speed = steps * batch_size / (time.perf_counter() - begin)
+
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+    return speed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", help="temporal, spatial-temporal or parts", default='spatial-temporal')
+    parser.add_argument("--batch_sizes", help="number of segments per batch", default=[100, 500], type=int, nargs='+')
+    parser.add_argument("--segment_lens", help="segment lengths in frames", default=[60], type=int, nargs='+')
+    parser.add_argument("--modes", help="activation checkpointing modes: none, block or tower", default=['none', 'block', 'tower'], nargs='+')
+    parser.add_argument("--embed_dim", help="EMBED_DIM of the models", default=32, type=int)
+    parser.add_argument("--steps", help="number of timed batches", default=3, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+
+    # spawn: a fresh process for every measurement, with its own peak memory
+    context = multiprocessing.get_context('spawn')
+    t = PrettyTable(['BATCH SIZE', 'SEGMENT LEN', 'CHECKPOINTING', 'TRAIN SAMPLES/S', 'SLOWDOWN', 'PEAK MEMORY (MB)', 'MEMORY REDUCTION'])
+    for batch_size in args.batch_sizes:
+        for segment_len in args.segment_lens:
+            reference = None
+            for mode in args.modes:
+                with context.Pool(1) as pool:
+                    speed, peak = pool.apply(measure, (args.model_type, mode, batch_size, segment_len, args.embed_dim, args.steps, args.threads))
+                reference = reference or (speed, peak)
+                t.add_row([batch_size, segment_len, mode, '%.1f' % speed, '%.2f' % (reference[0] / speed), '%.1f' % peak, '%.2f' % (reference[1] / peak)])
+                logger.info("batch size %d, %d frames, %s done", batch_size, segment_len, mode)
+
+    logger.info('\n' + str(t))
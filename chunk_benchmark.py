@@ -0,0 +1,88 @@
+ #!/bin/env python
+
+'''
+Peak inference memory and samples/s of large batches with and without chunked execution (INFERENCE: SPATIAL_CHUNK, ATTENTION_CHUNK),
+for randomly initialized models of NTU_2D shape. A chunking is FRAMES,SEQUENCES: the spatial towers encode at most FRAMES frames at a time
+and every attention layer attends over at most SEQUENCES sequences at a time (set_chunked_execution in transformer.py), 0 for all at once.
+Every measurement runs in a fresh process with the same model and data, so the peak memory of one does not hide the next: on CUDA the
+peak allocated memory, on CPU the growth of the peak resident memory over the model and data. MAX DIFFERENCE compares the outputs
+with those of the first chunking.
+
+e.g. python chunk_benchmark.py --model_type spatial-temporal --batch_sizes 1000 4000 --segment_len 60 --chunks 0,0 6000,0 6000,2000 60000,4000
+'''
+
+import torch
+import multiprocessing
+import resource
+import time
+import argparse
+from prettytable import PrettyTable
+
+from attention_benchmark import build
+from transformer import set_chunked_execution
+from utils import SetupLogger
+
+
+def measure(model_type, chunks, batch_size, segment_len, embed_dim, steps, threads):
+    '''
+    Runs in its own process, returns the outputs, the evaluation samples/s and the peak memory in MB
+    '''
+    torch.set_num_threads(threads)
+    torch.manual_seed(0) # the same model and data for every chunking
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    frames, sequences = [int(n) or None for n in chunks.split(',')]
+    model = set_chunked_execution(build(model_type, 'full', segment_len, embed_dim), frames, sequences).to(device).eval()
+    data = torch.randn(batch_size, segment_len, 50, device=device)
+
+    def synchronize():
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # KB on Linux
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    with torch.no_grad():
+        outputs = model(data) # warmup
+        synchronize()
+        begin = time.perf_counter()
+        for _ in range(steps):
+            model(data)
+        synchronize()
+    speed = steps * batch_size / (time.perf_counter() - begin)
+
+    if device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+    return outputs.cpu(), speed, peak
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", help="temporal, spatial-temporal or parts", default='spatial-temporal')
+    parser.add_argument("--batch_sizes", help="number of segments per forward pass", default=[1000, 4000], type=int, nargs='+')
+    parser.add_argument("--segment_len", help="segment length in frames", default=60, type=int)
+    parser.add_argument("--chunks", help="chunkings FRAMES,SEQUENCES, 0 for all at once", default=['0,0', '6000,0', '6000,2000'], nargs='+')
+    parser.add_argument("--embed_dim", help="EMBED_DIM of the models", default=32, type=int)
+    parser.add_argument("--steps", help="number of timed batches", default=3, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+
+    # spawn: a fresh process for every measurement, with its own peak memory
+    context = multiprocessing.get_context('spawn')
+    t = PrettyTable(['BATCH SIZE', 'CHUNKS', 'SAMPLES/S', 'SLOWDOWN', 'PEAK MEMORY (MB)', 'MEMORY REDUCTION', 'MAX DIFFERENCE'])
+    for batch_size in args.batch_sizes:
+        reference = None
+        for chunks in args.chunks:
+            with context.Pool(1) as pool:
+                outputs, speed, peak = pool.apply(measure, (args.model_type, chunks, batch_size, args.segment_len, args.embed_dim, args.steps, args.threads))
+            reference = reference or (outputs, speed, peak)
+            t.add_row([batch_size, chunks, '%.1f' % speed, '%.2f' % (reference[1] / speed), '%.1f' % peak, '%.2f' % (reference[2] / peak),
+                       '%.2e' % (outputs - reference[0]).abs().max().item()])
+            logger.info("batch size %d, chunks %s done", batch_size, chunks)
+
+    logger.info('\n' + str(t))
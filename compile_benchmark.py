@@ -0,0 +1,90 @@
+ #!/bin/env python
+
+'''
+Startup and steady-state throughput of a model with and without torch.compile (TRAINING: COMPILE, serve.py --compile),
+for training steps and evaluation batches. The break-even is the number of batches after which the compiled model
+has made up for its compile time.
+'''
+
+import torch
+import torch.nn as nn
+import time
+import argparse
+from prettytable import PrettyTable
+
+from utils import SetupLogger, load_checkpoint, check_all_frames, load_model, compile_model
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", help="checkpoint of a trained model, e.g. <name>_fold_1.pt")
+parser.add_argument("--segment_len", help="number of frames per segment (default: from the checkpoint manifest)", type=int)
+parser.add_argument("--num_values", help="number of values per frame (default: from the checkpoint manifest)", type=int)
+parser.add_argument("--batch_size", help="number of segments per batch", default=500, type=int)
+parser.add_argument("--steps", help="number of timed batches after the first one", default=20, type=int)
+args = parser.parse_args()
+
+logger = SetupLogger('logger')
+logger.info('parser args: %s', str(args))
+
+if not hasattr(torch, 'compile'):
+    raise Exception('torch.compile needs torch >= 2.0')
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+_, manifest = load_checkpoint(args.model)
+check_all_frames(manifest, args.model)
+layout = manifest['layout'] if manifest else {}
+segment_len = args.segment_len or layout.get('segment_length')
+num_values = args.num_values or (layout['num_joints'] * layout['in_chans'] if layout else None)
+if segment_len is None or num_values is None:
+    raise Exception('--segment_len and --num_values are needed for models without a manifest')
+
+data = torch.randn(args.batch_size, segment_len, num_values, device=device)
+
+def synchronize():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def measure(model, train):
+    '''
+    Returns the time of the first batch (including compilation) and the time per batch after it
+    '''
+    model.train(train)
+    optim = torch.optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.98), eps=1e-9)
+    cross_entropy_loss = nn.CrossEntropyLoss()
+    labels = None
+
+    def step():
+        nonlocal labels
+        if train:
+            optim.zero_grad(set_to_none=True)
+            output = model(data)
+            if labels is None:
+                labels = torch.randint(output.shape[1], (len(data),), device=device)
+            cross_entropy_loss(output, labels).backward()
+            optim.step()
+        else:
+            with torch.no_grad():
+                model(data)
+        synchronize()
+
+    begin = time.perf_counter()
+    step()
+    first = time.perf_counter() - begin
+    begin = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    return first, (time.perf_counter() - begin) / args.steps
+
+t = PrettyTable(['PHASE', 'MODE', 'FIRST BATCH (S)', 'STEADY SAMPLES/S', 'SPEEDUP', 'BREAK-EVEN (BATCHES)'])
+for phase, train in (('training', True), ('evaluation', False)):
+    eager_first, eager_step = measure(load_model(args.model, device), train)
+    torch._dynamo.reset() # compile from scratch, as a new process would
+    compiled_first, compiled_step = measure(compile_model(load_model(args.model, device)), train)
+
+    saved = eager_step - compiled_step
+    break_even = '%.0f' % ((compiled_first - eager_first) / saved) if saved > 0 else 'never'
+    t.add_row([phase, 'eager', '%.3f' % eager_first, '%.1f' % (args.batch_size / eager_step), '1.00', ''])
+    t.add_row([phase, 'compiled', '%.3f' % compiled_first, '%.1f' % (args.batch_size / compiled_step), '%.2f' % (eager_step / compiled_step), break_even])
+    logger.info("%s done", phase)
+
+logger.info('\n' + str(t))
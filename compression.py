@@ -0,0 +1,132 @@
+'''
+Model surgery shared by the compression scripts and by build_model in utils.py, which rebuilds the compressed models of a checkpoint manifest:
+  pruning        structured removal of attention heads and MLP hidden units, see prune.py
+  quantization   int8 nn.Linear layers for CPU inference, see quantize.py
+'''
+
+import torch
+import torch.nn as nn
+import copy
+import contextlib
+
+from transformer import Attention, Mlp
+
+try:
+    from torch.ao import quantization
+except ImportError: # torch < 1.10
+    from torch import quantization
+
+
+def select_features(linear, index, dim):
+    '''
+    Returns a new nn.Linear with only the output (dim 0) or input (dim 1) features in index
+    '''
+    weight = linear.weight.detach().index_select(dim, index)
+    selected = nn.Linear(weight.shape[1], weight.shape[0], bias=linear.bias is not None).to(weight.device)
+    with torch.no_grad():
+        selected.weight.copy_(weight)
+        if linear.bias is not None:
+            selected.bias.copy_(linear.bias[index] if dim == 0 else linear.bias)
+    return selected
+
+def prune_attention(attention, heads):
+    '''
+    Keeps only the given heads of an Attention, qkv loses their rows of q, k and v and proj their input columns
+    '''
+    heads = torch.as_tensor(heads, dtype=torch.long, device=attention.qkv.weight.device)
+    head_dim = attention.qkv.out_features // (3 * attention.num_heads)
+    channels = (heads[:, None] * head_dim + torch.arange(head_dim, device=heads.device)).flatten()
+    attention.qkv = select_features(attention.qkv, torch.cat([part * attention.num_heads * head_dim + channels for part in range(3)]), 0)
+    attention.proj = select_features(attention.proj, channels, 1)
+    attention.num_heads = len(heads)
+
+def prune_mlp(mlp, units):
+    '''
+    Keeps only the given hidden units of an Mlp
+    '''
+    units = torch.as_tensor(units, dtype=torch.long, device=mlp.fc1.weight.device)
+    mlp.fc1 = select_features(mlp.fc1, units, 0)
+    mlp.fc2 = select_features(mlp.fc2, units, 1)
+
+def pruned_sizes(model):
+    '''
+    Returns the number of heads of every Attention and of hidden units of every Mlp, by module name
+    '''
+    sizes = {}
+    for name, module in model.named_modules():
+        if isinstance(module, Attention):
+            sizes[name] = module.num_heads
+        elif isinstance(module, Mlp):
+            sizes[name] = module.fc1.out_features
+    return sizes
+
+def resize_model(model, sizes):
+    '''
+    Shrinks the Attentions and Mlps of a freshly built model to the sizes of pruned_sizes, to load the state dict of a pruned model into.
+    Also for the _store_attn variants of the models, their Attention_store_attn and Mlp have the same layers
+    '''
+    for name, size in sizes.items():
+        module = model.get_submodule(name)
+        if hasattr(module, 'qkv'):
+            prune_attention(module, range(size))
+        else:
+            prune_mlp(module, range(size))
+    return model
+
+QUANTIZATION_MODES = ('dynamic', 'static')
+
+def quantizable_layers(model):
+    '''
+    Returns the names of the nn.Linear layers to quantize, all but the classifier head
+    '''
+    return [name for name, module in model.named_modules() if isinstance(module, nn.Linear) and name.split('.')[-1] != 'head']
+
+@contextlib.contextmanager
+def quantized_engine(engine=None):
+    '''
+    Sets the quantized engine (the current one for None) while int8 layers are built or their weights loaded, and restores the previous engine after
+    '''
+    previous = torch.backends.quantized.engine
+    try:
+        torch.backends.quantized.engine = engine or previous
+        yield torch.backends.quantized.engine
+    finally:
+        torch.backends.quantized.engine = previous
+
+def quantize_model(model, mode, engine=None, calibration=None, batch_size=500):
+    '''
+    Returns an int8 copy of the model (see quantizable_layers) for the quantized engine ('x86', 'fbgemm' on x86 CPUs, 'qnnpack' on ARM).
+    The static mode calibrates the activation scales on the calibration segments (n f e). Without calibration
+    segments it only builds the structure to load the state dict of a saved quantized model into
+    '''
+    if mode not in QUANTIZATION_MODES:
+        raise Exception('quantization mode must be one of %s, got %s' % (QUANTIZATION_MODES, mode))
+    with quantized_engine(engine) as engine:
+        model = copy.deepcopy(model).cpu().eval()
+        layers = quantizable_layers(model)
+
+        if mode == 'dynamic':
+            return quantization.quantize_dynamic(model, {name: quantization.default_dynamic_qconfig for name in layers}, dtype=torch.qint8)
+
+        # eager mode static quantization: every layer quantizes its input with its own calibrated scale and dequantizes its output,
+        # the LayerNorms, attention matmuls and softmax in between stay in float
+        qconfig = quantization.get_default_qconfig(engine)
+        for name in layers:
+            parent, _, attribute = name.rpartition('.')
+            wrapper = nn.Sequential(quantization.QuantStub(), model.get_submodule(name), quantization.DeQuantStub())
+            wrapper.qconfig = qconfig
+            setattr(model.get_submodule(parent) if parent else model, attribute, wrapper)
+        quantization.prepare(model, inplace=True)
+        if calibration is not None:
+            with torch.no_grad():
+                for batch in torch.split(calibration, batch_size):
+                    model(batch)
+        return quantization.convert(model, inplace=True)
+
+def make_quantized_checkpoint(model, manifest, mode, engine=None):
+    '''
+    Returns the checkpoint of a model returned by quantize_model, with the quantization in its manifest
+    '''
+    manifest = dict(manifest, quantization={'mode': mode, 'engine': engine or torch.backends.quantized.engine})
+    return {'manifest': manifest, 'state_dict': model.state_dict()}
+
@@ -0,0 +1,96 @@
+ #!/bin/env python
+
+'''
+Scaling benchmark of the distributed data parallel training of train_transformer_cross_val_NTU.py on one CPU node.
+Trains a model with gloo on localhost for several numbers of processes, the cores are split between the processes
+and every step uses the same global batch size, and reports the training samples/s.
+'''
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from prettytable import PrettyTable
+from datetime import timedelta
+import socket
+import time
+import math
+import os
+import argparse
+
+from utils import SetupLogger, load_model
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def worker(rank, world_size, port, threads, args, results):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:%d' % port, rank=rank, world_size=world_size, timeout=timedelta(minutes=10))
+    torch.set_num_threads(threads)
+    torch.manual_seed(rank)
+
+    model = load_model(args.model, all_frames=True)
+    model.train()
+    ddp_model = DistributedDataParallel(model)
+    optim = torch.optim.Adam(model.parameters(), lr=0.001, betas=(0.9, 0.98), eps=1e-9)
+    cross_entropy_loss = nn.CrossEntropyLoss()
+
+    # every rank trains on its share of the global batch
+    rank_batch_size = math.ceil(args.batch_size / world_size)
+    data = torch.randn(rank_batch_size, args.segment_len, args.num_values)
+    with torch.no_grad():
+        num_classes = model(data[:1]).shape[-1]
+    labels = torch.randint(num_classes, (rank_batch_size,))
+
+    def step():
+        optim.zero_grad(set_to_none=True)
+        loss = cross_entropy_loss(ddp_model(data), labels)
+        loss.backward()
+        optim.step()
+
+    for _ in range(args.warmup):
+        step()
+    dist.barrier()
+    begin = time.perf_counter()
+    for _ in range(args.steps):
+        step()
+    dist.barrier()
+    elapsed = time.perf_counter() - begin
+
+    if rank == 0:
+        results[world_size] = rank_batch_size * world_size * args.steps / elapsed
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="checkpoint of the model to train, e.g. <name>_fold_1.pt")
+    parser.add_argument("--segment_len", help="number of frames per segment", type=int)
+    parser.add_argument("--num_values", help="number of values per frame (2xnumber of joints)", default=50, type=int)
+    parser.add_argument("--batch_size", help="global batch size, split between the processes", default=100, type=int)
+    parser.add_argument("--processes", help="numbers of processes to measure", default=[1, 2, 4], type=int, nargs='+')
+    parser.add_argument("--cpus", help="number of cores to split between the processes (default: all available)", type=int)
+    parser.add_argument("--warmup", help="number of untimed training steps", default=3, type=int)
+    parser.add_argument("--steps", help="number of timed training steps", default=20, type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+
+    cpus = args.cpus or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+    results = mp.Manager().dict()
+
+    t = PrettyTable(['PROCESSES', 'THREADS/PROCESS', 'BATCH/PROCESS', 'SAMPLES/S', 'SPEEDUP', 'EFFICIENCY'])
+    for world_size in args.processes:
+        threads = max(1, cpus // world_size)
+        logger.info("Training with %d processes, %d threads each", world_size, threads)
+        mp.spawn(worker, args=(world_size, free_port(), threads, args, results), nprocs=world_size)
+
+        # relative to the first number of processes
+        speedup = results[world_size] / results[args.processes[0]]
+        t.add_row([world_size, threads, math.ceil(args.batch_size / world_size), '%.1f' % results[world_size], '%.2f' % speedup, '%.0f %%' % (100 * speedup * args.processes[0] / world_size)])
+
+    logger.info('\n' + str(t))
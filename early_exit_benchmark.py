@@ -0,0 +1,78 @@
+ #!/bin/env python
+
+'''
+Average depth, throughput and accuracy of a model trained with MODEL: EARLY_EXIT at several confidence thresholds.
+After every temporal block the segments whose exit head gives its most likely class at least the threshold probability
+leave the batch (EarlyExits in transformer.py), none for all segments through all blocks.
+
+e.g. python early_exit_benchmark.py --model <name>_fold_1.pt --test_file trajectories_test_NTU_2D.dat --thresholds 0.99 0.95 0.9 0.8
+'''
+
+import torch
+import numpy as np
+import pickle
+import time
+import argparse
+from prettytable import PrettyTable
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+
+from trajectory import extract_fixed_sized_segments, remove_short_trajectories
+from utils import SetupLogger, load_checkpoint, check_all_frames, build_model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="checkpoint of a model trained with MODEL: EARLY_EXIT, e.g. <name>_fold_1.pt")
+    parser.add_argument("--test_file", help="pickled test trajectories, e.g. trajectories_test_NTU_2D.dat")
+    parser.add_argument("--thresholds", help="confidence thresholds, probabilities of the most likely class", default=[0.99, 0.95, 0.9, 0.8, 0.6], type=float, nargs='+')
+    parser.add_argument("--batch_size", help="number of segments per forward pass", default=500, type=int)
+    parser.add_argument("--max_segments", help="number of test segments to evaluate, 0 for all", default=20000, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+    torch.set_num_threads(args.threads)
+
+    state_dict, manifest = load_checkpoint(args.model)
+    if manifest is None:
+        raise Exception('the benchmark needs a checkpoint with a manifest, see save_checkpoint in utils.py')
+    check_all_frames(manifest, args.model)
+    model = build_model(manifest, state_dict).eval()
+    if getattr(model, 'exit_heads', None) is None:
+        raise Exception('%s has no exit heads, train it with MODEL: EARLY_EXIT' % args.model)
+    layout = manifest['layout']
+    dataset, segment_len = layout['dataset'], layout['segment_length']
+
+    with open(args.test_file, "rb") as f:
+        trajectories = remove_short_trajectories(pickle.load(f), input_length=segment_len, input_gap=0, pred_length=0)
+    _, _, _, _, categories, X = extract_fixed_sized_segments(dataset, trajectories, input_length=segment_len)
+    if args.max_segments:
+        subset = np.random.RandomState(0).permutation(len(X))[:args.max_segments]
+        categories, X = categories[subset], X[subset]
+    data, labels = torch.tensor(X, dtype=torch.float32), torch.tensor(categories[:, 0].astype(np.int64))
+    logger.info("%d test segments of %d frames", len(data), segment_len)
+
+    depth = len(model.blocks)
+    t = PrettyTable(['THRESHOLD', 'AVERAGE DEPTH', 'SEGMENTS PER EXIT', 'SAMPLES/S', 'SPEEDUP', 'ACCURACY', 'BALANCED ACCURACY', 'SAME PREDICTION'])
+    for threshold in [None] + args.thresholds:
+        model.exit_threshold = threshold
+        outputs, depths = [], []
+        with torch.no_grad():
+            model(data[:args.batch_size])
+            begin = time.perf_counter()
+            for batch in torch.split(data, args.batch_size):
+                outputs.append(model(batch))
+                depths.append(model.exit_depths if threshold is not None else torch.full((len(batch),), depth))
+            throughput = len(data) / (time.perf_counter() - begin)
+
+        predictions = torch.cat(outputs).argmax(dim=1)
+        depths = torch.cat(depths)
+        if threshold is None:
+            reference_throughput, reference_predictions = throughput, predictions
+        t.add_row(['none' if threshold is None else threshold, '%.2f/%d' % (depths.float().mean().item(), depth), '/'.join(str(n) for n in torch.bincount(depths, minlength=depth + 1)[1:].tolist()),
+                   '%.1f' % throughput, '%.2f' % (throughput / reference_throughput), '%.4f' % accuracy_score(labels, predictions), '%.4f' % balanced_accuracy_score(labels, predictions),
+                   '%.4f' % (predictions == reference_predictions).float().mean().item()])
+        logger.info("threshold %s done", threshold)
+
+    logger.info('\n' + str(t))
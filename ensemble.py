@@ -0,0 +1,124 @@
+ #!/bin/env python
+
+'''
+Fold ensemble of the cross validation models (<name>_fold_1..k.pt) of one architecture.
+The parameters of all folds are stacked and the model is run once with vmap over the fold dimension,
+so the k folds cost about one call with a k times wider batch instead of k separate calls.
+Run as a script to compare it with evaluating the fold models one at a time.
+'''
+
+import torch
+import torch.nn as nn
+import copy
+import glob
+import time
+import argparse
+
+try:
+    from torch.func import functional_call, vmap # torch >= 2.0
+except ImportError:
+    try:
+        from torch.nn.utils.stateless import functional_call # torch 1.12 with the functorch package
+        from functorch import vmap
+    except ImportError:
+        vmap = None
+
+from utils import SetupLogger, load_model
+
+
+class FoldEnsemble(nn.Module):
+    '''
+    Stacks the parameters of fold models with the same architecture, forward returns the
+    log likelihoods of every fold, shape: k b num_classes
+    '''
+    def __init__(self, models):
+        super().__init__()
+        if len(set(type(model) for model in models)) != 1:
+            raise Exception('all fold models must have the same model class, got %s' % str([type(model).__name__ for model in models]))
+
+        self.models = nn.ModuleList(models)
+        self.base = copy.deepcopy(models[0]).eval()
+        self.base.requires_grad_(False)
+        names = [name for name, _ in self.base.named_parameters()]
+        for model in models[1:]:
+            if [name for name, _ in model.named_parameters()] != names or any(p.shape != q.shape for p, q in zip(model.parameters(), self.base.parameters())):
+                raise Exception('fold models have different parameter shapes, they were trained with different hyperparameters')
+
+        # the stacked parameters are buffers of the ensemble, so .to(device) and state_dict() include them,
+        # buffer names can not contain dots, the parameter names are kept to map them back for functional_call
+        self.param_names = names
+        for name in names:
+            self.register_buffer('stacked_' + name.replace('.', '__'), torch.stack([dict(model.named_parameters())[name].detach() for model in models]))
+        self.vectorized = vmap is not None
+
+    @property
+    def stacked_params(self):
+        return {name: getattr(self, 'stacked_' + name.replace('.', '__')) for name in self.param_names}
+
+    @property
+    def shared_buffers(self):
+        # buffers only describe the architecture (e.g. the body part index) and are shared by the folds
+        return dict(self.base.named_buffers())
+
+    def forward_fold(self, params, x):
+        return functional_call(self.base, (params, self.shared_buffers), (x,))
+
+    @torch.no_grad()
+    def forward(self, x):
+        if self.vectorized:
+            return vmap(self.forward_fold, in_dims=(0, None))(self.stacked_params, x)
+        # without vmap (torch 1.12 without functorch) the folds are run one after the other
+        return torch.stack([model.eval()(x) for model in self.models])
+
+    def predict(self, x):
+        '''
+        Returns the per fold log likelihoods (k b num_classes) and their average over the folds (b num_classes)
+        '''
+        log_likelihoods = self.forward(x)
+        return log_likelihoods, log_likelihoods.mean(dim=0)
+
+
+def load_fold_ensemble(model_dir, model_name, device='cpu'):
+    '''
+    Loads all <model_name>_fold_N.pt models of a training run into one FoldEnsemble
+    '''
+    paths = sorted(glob.glob('%s/%s_fold_*.pt' % (model_dir, model_name)))
+    if not paths:
+        raise Exception('no fold models %s_fold_*.pt in %s' % (model_name, model_dir))
+    return FoldEnsemble([load_model(path, device, all_frames=True).eval() for path in paths])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir", help="models folder of the training run")
+    parser.add_argument("--model_name", help="name of the training run, the models are <model_name>_fold_N.pt")
+    parser.add_argument("--segment_len", help="number of frames per segment", type=int)
+    parser.add_argument("--num_values", help="number of values per frame (2xnumber of joints)", default=50, type=int)
+    parser.add_argument("--batch_size", help="number of segments per forward pass", default=500, type=int)
+    parser.add_argument("--repeats", help="number of timed forward passes", default=10, type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+
+    ensemble = load_fold_ensemble(args.model_dir, args.model_name)
+    logger.info("Loaded %d fold models, vectorized: %s", len(ensemble.models), str(ensemble.vectorized))
+
+    x = torch.randn(args.batch_size, args.segment_len, args.num_values)
+    with torch.no_grad():
+        reference = torch.stack([model(x) for model in ensemble.models])
+    log_likelihoods, _ = ensemble.predict(x)
+    logger.info("Max difference to the separate fold models: %.2e", (log_likelihoods - reference).abs().max().item())
+
+    with torch.no_grad():
+        begin = time.perf_counter()
+        for _ in range(args.repeats):
+            [model(x) for model in ensemble.models]
+        separate = (time.perf_counter() - begin) / args.repeats
+
+        begin = time.perf_counter()
+        for _ in range(args.repeats):
+            ensemble.predict(x)
+        stacked = (time.perf_counter() - begin) / args.repeats
+
+    logger.info("Time per batch of %d segments: separate folds %.1f ms, stacked ensemble %.1f ms", args.batch_size, separate * 1000, stacked * 1000)
@@ -0,0 +1,80 @@
+ #!/bin/env python
+
+'''
+Launcher for distributed training over several nodes, like torchrun: starts the local ranks of the training script on this node.
+Run it once per node. The ranks meet at a rendezvous:
+  tcp://<host of node 0>:<port>   TCP store on node 0
+  file://<path>                   file on a filesystem shared by all nodes, use a new path for every job (e.g. with $SLURM_JOB_ID)
+On slurm --nnodes and --node_rank default to $SLURM_NNODES and $SLURM_NODEID. To test on one machine, start it several times
+with --nnodes N and --node_rank 0..N-1.
+
+A launcher only watches the ranks of its own node: when one fails it stops them and exits with its exit code. The ranks on the
+other nodes find out at their next collective. A rank that exits closes its connections, so the pending collective usually fails
+at once. A rank on a hung or unreachable node is only noticed after TRAINING: COLLECTIVE_TIMEOUT minutes, or after 6 hours
+when the others wait for rank 0 to write the teacher cache or test a fold. The failed ranks then exit and their launchers stop too.
+
+e.g. python launch.py --nnodes 2 --nproc_per_node 4 --rdzv tcp://node001:29500 train_transformer_cross_val_NTU.py --config_file config.yml
+'''
+
+import subprocess
+import argparse
+import signal
+import time
+import sys
+import os
+
+from utils import SetupLogger
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--nnodes", help="number of nodes", default=int(os.environ.get('SLURM_NNODES', 1)), type=int)
+parser.add_argument("--node_rank", help="rank of this node, 0 hosts the TCP store", default=int(os.environ.get('SLURM_NODEID', 0)), type=int)
+parser.add_argument("--nproc_per_node", help="number of ranks on this node, the cores are split between them", default=1, type=int)
+parser.add_argument("--rdzv", help="rendezvous, tcp://host:port or file://path", default="tcp://127.0.0.1:29500")
+parser.add_argument("script", help="training script")
+parser.add_argument("script_args", help="arguments of the training script", nargs=argparse.REMAINDER)
+args = parser.parse_args()
+
+logger = SetupLogger('launcher')
+logger.info('parser args: %s', str(args))
+
+world_size = args.nnodes * args.nproc_per_node
+env = dict(os.environ, WORLD_SIZE=str(world_size), LOCAL_WORLD_SIZE=str(args.nproc_per_node), GROUP_RANK=str(args.node_rank))
+if args.rdzv.startswith('tcp://'):
+    env['MASTER_ADDR'], env['MASTER_PORT'] = args.rdzv[len('tcp://'):].rsplit(':', 1)
+    env['INIT_METHOD'] = 'env://'
+elif args.rdzv.startswith('file://'):
+    env['INIT_METHOD'] = args.rdzv
+else:
+    raise Exception('rendezvous must be tcp://host:port or file://path, got %s' % args.rdzv)
+
+processes = []
+for local_rank in range(args.nproc_per_node):
+    rank = args.node_rank * args.nproc_per_node + local_rank
+    processes.append(subprocess.Popen([sys.executable, '-u', args.script] + args.script_args, env=dict(env, RANK=str(rank), LOCAL_RANK=str(local_rank))))
+logger.info("Started ranks %d to %d of %d", args.node_rank * args.nproc_per_node, (args.node_rank + 1) * args.nproc_per_node - 1, world_size)
+
+def stop(signum, frame):
+    # e.g. slurm preemption: passed on to the ranks, restart with --resume to continue from the last saved training state
+    for process in processes:
+        process.send_signal(signum)
+signal.signal(signal.SIGTERM, stop)
+signal.signal(signal.SIGINT, stop)
+
+# wait for all ranks, if one fails the others would wait for it at the next collective, so they are stopped
+exitcode = 0
+while None in [process.poll() for process in processes]: # poll every rank, so the exit code of a failed one is seen
+    failed = [process for process in processes if process.returncode not in (None, 0)]
+    if failed:
+        exitcode = failed[0].returncode
+        logger.info("A rank failed with exit code %d, stopping the others", exitcode)
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+        break
+    time.sleep(1)
+
+exitcode = exitcode or next((process.returncode for process in processes if process.returncode != 0), 0)
+sys.exit(exitcode)
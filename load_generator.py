@@ -0,0 +1,102 @@
+ #!/bin/env python
+
+'''
+Load generator for serve.py, measures the latency percentiles and throughput of the server
+at several numbers of concurrent clients. With --max_batch_sizes and/or --max_wait_ms it compares batching policies:
+every combination is set on the running server (POST /policy) and measured at all concurrency levels,
+afterwards the server gets its own policy back.
+
+e.g. python load_generator.py --model st --segment_len 60 --max_batch_sizes 1 16 64 256 --max_wait_ms 1 5 20
+'''
+
+import numpy as np
+import threading
+import itertools
+import time
+import json
+import argparse
+import urllib.request
+from prettytable import PrettyTable
+
+from utils import SetupLogger
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--url", help="address of the server", default="http://127.0.0.1:8000")
+parser.add_argument("--model", help="name of the served model")
+parser.add_argument("--segment_len", help="number of frames per segment", type=int)
+parser.add_argument("--num_values", help="number of values per frame (2xnumber of joints)", default=50, type=int)
+parser.add_argument("--segments_per_request", help="number of segments sent with every request", default=1, type=int)
+parser.add_argument("--concurrency", help="numbers of concurrent clients to measure", default=[1, 4, 16, 64], type=int, nargs='+')
+parser.add_argument("--duration", help="seconds to measure per concurrency level", default=10, type=float)
+parser.add_argument("--max_batch_sizes", help="maximum batch sizes of the policies to compare, the server's own if not given", type=int, nargs='+')
+parser.add_argument("--max_wait_ms", help="maximum wait times (ms) of the policies to compare, the server's own if not given", type=float, nargs='+')
+args = parser.parse_args()
+
+logger = SetupLogger('logger')
+logger.info('parser args: %s', str(args))
+
+
+def get_stats():
+    with urllib.request.urlopen(args.url + '/stats') as response:
+        return json.loads(response.read())[args.model]
+
+def set_policy(max_batch_size, max_wait_ms):
+    body = json.dumps({'model': args.model, 'max_batch_size': max_batch_size, 'max_wait_ms': max_wait_ms}).encode()
+    request = urllib.request.Request(args.url + '/policy', data=body, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def client(body, stop, latencies, errors):
+    while time.perf_counter() < stop:
+        request = urllib.request.Request(args.url + '/predict', data=body, headers={'Content-Type': 'application/json'})
+        begin = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            latencies.append(time.perf_counter() - begin)
+        except Exception as error:
+            errors.append(error)
+
+
+segments = np.random.randn(args.segments_per_request, args.segment_len, args.num_values).astype(np.float32)
+body = json.dumps({'model': args.model, 'segments': segments.tolist()}).encode()
+
+stats = get_stats()
+logger.info("Batching policy of the server: max batch %d, max wait %.1f ms", stats['max_batch_size'], stats['max_wait_ms'])
+policies = list(itertools.product(args.max_batch_sizes or [stats['max_batch_size']], args.max_wait_ms or [stats['max_wait_ms']]))
+
+t = PrettyTable(['POLICY', 'CLIENTS', 'REQUESTS/S', 'SEGMENTS/S', 'P50 (MS)', 'P99 (MS)', 'MEAN BATCH', 'ERRORS'])
+try:
+    for max_batch_size, max_wait_ms in policies:
+        set_policy(max_batch_size, max_wait_ms)
+        policy = 'max batch %d, max wait %.1f ms' % (max_batch_size, max_wait_ms)
+        for concurrency in args.concurrency:
+            latencies, errors = [], []
+            before = get_stats()
+            start = time.perf_counter()
+            stop = start + args.duration
+
+            threads = [threading.Thread(target=client, args=(body, stop, latencies, errors)) for _ in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            elapsed = time.perf_counter() - start
+            after = get_stats()
+            batches = max(after['batches'] - before['batches'], 1)
+            mean_batch = (after['segments'] - before['segments']) / batches
+            latencies = np.array(latencies) * 1000
+            if errors:
+                logger.info("%d failed requests, first error: %s", len(errors), str(errors[0]))
+            if len(latencies) == 0:
+                continue
+
+            t.add_row([policy, concurrency, '%.1f' % (len(latencies) / elapsed), '%.1f' % (len(latencies) * args.segments_per_request / elapsed),
+                       '%.2f' % np.percentile(latencies, 50), '%.2f' % np.percentile(latencies, 99), '%.1f' % mean_batch, len(errors)])
+            logger.info("%s, %d clients done", policy, concurrency)
+finally:
+    set_policy(stats['max_batch_size'], stats['max_wait_ms'])
+
+logger.info('\n' + str(t))
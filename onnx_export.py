@@ -0,0 +1,117 @@
+ #!/bin/env python
+
+'''
+Exports a trained model (any model class of transformer.py) to ONNX with a dynamic batch dimension.
+The dataset layout of the checkpoint manifest is stored in the ONNX metadata for onnx_inference.py.
+Models trained with MODEL: FRAME_SELECTION get a second input, the positions of the selected frames in their segments.
+Run as a script to export a checkpoint, check the ONNX Runtime outputs against PyTorch and compare
+their latency and throughput on the CPU.
+'''
+
+import torch
+import numpy as np
+import onnx
+import json
+import time
+import argparse
+from prettytable import PrettyTable
+
+from onnx_inference import OnnxModel
+from utils import SetupLogger, load_checkpoint, load_model
+
+
+def random_inputs(batch_size, segment_length, num_values, frame_selection=None):
+    '''
+    Random segments (batch, segment_length, num_values) for the model, with frame_selection the segments of the selected frames
+    (batch, frame_selection, num_values) and random positions of them in the segments (batch, frame_selection) in temporal order
+    '''
+    if not frame_selection:
+        return (torch.randn(batch_size, segment_length, num_values),)
+    positions = torch.rand(batch_size, segment_length).argsort(dim=1)[:, :frame_selection].sort(dim=1).values
+    return torch.randn(batch_size, frame_selection, num_values), positions
+
+def export_onnx(model, path, segment_length, num_values, layout=None, opset=14):
+    '''
+    Exports the model for inputs of shape (batch, segment_length, num_values), batch is dynamic.
+    With frame_selection in the layout the inputs are the selected frames (batch, frame_selection, num_values) and their positions (batch, frame_selection)
+    '''
+    model = model.cpu().eval()
+    dummy = random_inputs(2, segment_length, num_values, (layout or {}).get('frame_selection'))
+    input_names = ['segments', 'positions'][:len(dummy)]
+    kwargs = dict(input_names=input_names, output_names=['log_likelihoods'], opset_version=opset, do_constant_folding=True,
+                  dynamic_axes=dict({name: {0: 'batch'} for name in input_names}, log_likelihoods={0: 'batch'}))
+    with torch.no_grad():
+        try:
+            torch.onnx.export(model, dummy, path, dynamo=False, **kwargs) # the TorchScript exporter, newer torch versions default to the dynamo one
+        except TypeError: # torch < 2.1 has no dynamo argument
+            torch.onnx.export(model, dummy, path, **kwargs)
+
+    onnx_model = onnx.load(path)
+    onnx.checker.check_model(onnx_model)
+    if layout:
+        onnx.helper.set_model_props(onnx_model, {'layout': json.dumps(layout), 'model_class': type(model).__name__})
+        onnx.save(onnx_model, path)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="checkpoint of a trained model, e.g. <name>_fold_1.pt")
+    parser.add_argument("--output", help="path of the .onnx file (default: the checkpoint path with .onnx)")
+    parser.add_argument("--segment_len", help="number of frames per segment (default: from the checkpoint manifest)", type=int)
+    parser.add_argument("--num_values", help="number of values per frame (default: from the checkpoint manifest)", type=int)
+    parser.add_argument("--opset", help="ONNX opset version", default=14, type=int)
+    parser.add_argument("--tolerance", help="maximum difference of the log likelihoods to PyTorch", default=1e-4, type=float)
+    parser.add_argument("--batch_sizes", help="batch sizes to benchmark, 1 measures the latency of single segments", default=[1, 64, 500], type=int, nargs='+')
+    parser.add_argument("--repeats", help="number of timed forward passes per batch size", default=20, type=int)
+    parser.add_argument("--threads", help="number of CPU threads for PyTorch and ONNX Runtime", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+    torch.set_num_threads(args.threads)
+
+    _, manifest = load_checkpoint(args.model)
+    layout = manifest['layout'] if manifest else {}
+    segment_len = args.segment_len or layout.get('segment_length')
+    num_values = args.num_values or (layout['num_joints'] * layout['in_chans'] if layout else None)
+    if segment_len is None or num_values is None:
+        raise Exception('--segment_len and --num_values are needed for models without a manifest')
+
+    model = load_model(args.model).eval()
+    output = args.output or args.model[:-3] + '.onnx'
+    export_onnx(model, output, segment_len, num_values, layout, args.opset)
+    logger.info("Exported %s to %s", type(model).__name__, output)
+
+    onnx_model = OnnxModel(output, args.threads)
+
+    # a batch size different from the export, so the dynamic batch dimension is checked too
+    frame_selection = layout.get('frame_selection')
+    inputs = random_inputs(7, segment_len, num_values, frame_selection)
+    with torch.no_grad():
+        reference = model(*inputs).numpy()
+    difference = np.abs(onnx_model(*[x.numpy() for x in inputs]) - reference).max()
+    logger.info("Max difference to PyTorch: %.2e", difference)
+    if difference > args.tolerance:
+        raise Exception('ONNX Runtime outputs differ from PyTorch by %.2e, more than the tolerance %.1e' % (difference, args.tolerance))
+
+    t = PrettyTable(['BATCH', 'PYTORCH (MS)', 'ONNX RUNTIME (MS)', 'PYTORCH SEGMENTS/S', 'ONNX RUNTIME SEGMENTS/S', 'SPEEDUP'])
+    for batch_size in args.batch_sizes:
+        inputs = random_inputs(batch_size, segment_len, num_values, frame_selection)
+        inputs_numpy = [x.numpy() for x in inputs]
+        with torch.no_grad():
+            model(*inputs)
+            begin = time.perf_counter()
+            for _ in range(args.repeats):
+                model(*inputs)
+            eager = (time.perf_counter() - begin) / args.repeats
+
+        onnx_model(*inputs_numpy)
+        begin = time.perf_counter()
+        for _ in range(args.repeats):
+            onnx_model(*inputs_numpy)
+        runtime = (time.perf_counter() - begin) / args.repeats
+
+        t.add_row([batch_size, '%.2f' % (eager * 1000), '%.2f' % (runtime * 1000), '%.1f' % (batch_size / eager), '%.1f' % (batch_size / runtime), '%.2f' % (eager / runtime)])
+
+    logger.info('\n' + str(t))
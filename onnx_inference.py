@@ -0,0 +1,61 @@
+ #!/bin/env python
+
+'''
+ONNX Runtime inference for models exported with onnx_export.py. Needs only numpy and onnxruntime,
+not torch or the rest of the training stack.
+Run as a script to classify the segments (n f e) of a .npy file. Models trained with MODEL: FRAME_SELECTION take the selected
+frames (n k e) and their positions in the segments (n k, see extract_selected_segments in trajectory.py) from a second .npy file.
+'''
+
+import numpy as np
+import json
+import argparse
+import onnxruntime as ort
+
+
+class OnnxModel:
+    '''
+    Wraps an exported model on the ONNX Runtime CPU backend, calling it with segments (n f e) returns their log likelihoods (n num_classes).
+    A model with frame selection is called with the selected frames (n k e) and their positions (n k).
+    layout is the dataset layout of the checkpoint manifest (segment_length, num_joints, in_chans, categories, ...) if the export had one
+    '''
+    def __init__(self, path, threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.layout = json.loads(metadata['layout']) if 'layout' in metadata else {}
+
+    def __call__(self, segments, positions=None):
+        inputs = {self.input_names[0]: np.ascontiguousarray(segments, dtype=np.float32)}
+        if len(self.input_names) > 1:
+            if positions is None:
+                raise Exception('the model was trained on %d selected frames per segment and needs their positions' % self.layout.get('frame_selection'))
+            inputs[self.input_names[1]] = np.ascontiguousarray(positions, dtype=np.int64)
+        return self.session.run(None, inputs)[0]
+
+    def predict(self, segments, positions=None):
+        '''
+        Returns the log likelihoods and the predicted class indices of the segments
+        '''
+        log_likelihoods = self(segments, positions)
+        return log_likelihoods, log_likelihoods.argmax(axis=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="exported .onnx model")
+    parser.add_argument("--segments", help=".npy file with segments of shape n f e")
+    parser.add_argument("--positions", help=".npy file with the positions (n k) of the selected frames, for models trained with frame selection")
+    parser.add_argument("--threads", help="number of CPU threads used by ONNX Runtime (default: all)", type=int)
+    args = parser.parse_args()
+
+    model = OnnxModel(args.model, args.threads)
+    categories = model.layout.get('categories')
+    _, predictions = model.predict(np.load(args.segments), np.load(args.positions) if args.positions else None)
+    for index, prediction in enumerate(predictions):
+        print(index, categories[prediction] if categories else prediction)
@@ -0,0 +1,183 @@
+ #!/bin/env python
+
+'''
+Structured pruning of the attention heads and MLP hidden units of the Blocks of a trained model.
+Heads and hidden units are scored on validation segments by the first order Taylor importance |dL/dmask|, where
+mask scales the output of the head or unit (Michel et al. 2019, Molchanov et al. 2019). The lowest scoring ones are
+removed from the weights, so the pruned model is a smaller architecture and not a masked one.
+The pruned sizes go into the checkpoint manifest, load_model in utils.py rebuilds the smaller model from it (resize_model in compression.py).
+Run as a script to prune a checkpoint at several ratios, optionally fine-tune the pruned models on the training
+segments and report their MACs, latency and accuracy.
+'''
+
+import torch
+import torch.nn as nn
+import numpy as np
+import copy
+import pickle
+import time
+import argparse
+from prettytable import PrettyTable
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+
+from transformer import Attention, Mlp
+from compression import prune_attention, prune_mlp, pruned_sizes
+
+
+def count_attention(module, x, y):
+    '''
+    thop custom op for Attention, thop counts no matmuls: the MACs of qkv, q @ k^T, attn @ v and proj
+    '''
+    B, N, _ = x[0].shape
+    inner = module.qkv.out_features // 3
+    module.total_ops += torch.DoubleTensor([B * N * (module.qkv.in_features * module.qkv.out_features + 2 * N * inner + inner * module.proj.out_features)])
+
+def importance_scores(model, data, labels, batch_size=100):
+    '''
+    Returns the importance of every head (Attention) and hidden unit (Mlp) on the segments (n f e), by module name.
+    dL/dmask of a head or unit is the sum of weight * gradient over the proj or fc2 input columns it feeds,
+    its absolute value is summed over the batches
+    '''
+    model.eval() # no dropout, but gradients
+    cross_entropy_loss = nn.CrossEntropyLoss(reduction='sum')
+    modules = {name: module for name, module in model.named_modules() if isinstance(module, (Attention, Mlp))}
+    scores = {name: 0 for name in modules}
+    for batch, batch_labels in zip(torch.split(data, batch_size), torch.split(labels, batch_size)):
+        model.zero_grad(set_to_none=True)
+        cross_entropy_loss(model(batch), batch_labels).backward()
+        for name, module in modules.items():
+            if isinstance(module, Attention):
+                taylor = (module.proj.weight * module.proj.weight.grad).sum(dim=0).view(module.num_heads, -1).sum(dim=1)
+            else:
+                taylor = (module.fc2.weight * module.fc2.weight.grad).sum(dim=0)
+            scores[name] = scores[name] + taylor.abs().detach()
+    model.zero_grad(set_to_none=True)
+    return scores
+
+def prune_model(model, scores, ratio):
+    '''
+    Returns a copy of the model without the lowest scoring ratio of the heads and hidden units of every Attention and Mlp, at least one of each is kept
+    '''
+    model = copy.deepcopy(model)
+    for name, score in scores.items():
+        keep = max(1, int(round(len(score) * (1 - ratio))))
+        kept = torch.sort(torch.topk(score, keep).indices).values # in their original order
+        module = model.get_submodule(name)
+        if isinstance(module, Attention):
+            prune_attention(module, kept)
+        else:
+            prune_mlp(module, kept)
+    return model
+
+
+if __name__ == '__main__':
+    from thop import profile
+    from trajectory import extract_fixed_sized_segments, remove_short_trajectories, split_into_train_and_test
+    from utils import SetupLogger, load_checkpoint, check_all_frames, build_model
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="checkpoint of a trained model, e.g. <name>_fold_1.pt")
+    parser.add_argument("--train_file", help="pickled train trajectories, split into validation trajectories for the scores and the rest for fine-tuning")
+    parser.add_argument("--test_file", help="pickled test trajectories for the accuracy, e.g. trajectories_test_NTU_2D.dat")
+    parser.add_argument("--ratios", help="fractions of the heads and hidden units to remove", default=[0.25, 0.5, 0.75], type=float, nargs='+')
+    parser.add_argument("--val_fraction", help="fraction of the train trajectories to score on", default=0.2, type=float)
+    parser.add_argument("--finetune_epochs", help="number of epochs to fine-tune the pruned models, 0 for none", default=0, type=int)
+    parser.add_argument("--lr", help="learning rate of the fine-tuning", default=1e-4, type=float)
+    parser.add_argument("--batch_size", help="number of segments per batch", default=100, type=int)
+    parser.add_argument("--max_segments", help="number of test segments to evaluate, 0 for all", default=20000, type=int)
+    parser.add_argument("--repeats", help="number of timed single segment forward passes for the latency", default=100, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+    torch.set_num_threads(args.threads)
+
+    state_dict, manifest = load_checkpoint(args.model)
+    if manifest is None:
+        raise Exception('pruning needs a checkpoint with a manifest, see save_checkpoint in utils.py')
+    check_all_frames(manifest, args.model)
+    if manifest.get('quantization'):
+        raise Exception('%s is quantized, prune the float model and quantize it afterwards' % args.model)
+    model = build_model(manifest, state_dict).eval()
+    layout = manifest['layout']
+    dataset, segment_len = layout['dataset'], layout['segment_length']
+
+    def load_segments(trajectories, max_segments=0):
+        trajectories = remove_short_trajectories(trajectories, input_length=segment_len, input_gap=0, pred_length=0)
+        _, _, _, _, categories, X = extract_fixed_sized_segments(dataset, trajectories, input_length=segment_len)
+        if max_segments:
+            subset = np.random.RandomState(0).permutation(len(X))[:max_segments]
+            categories, X = categories[subset], X[subset]
+        return torch.tensor(X, dtype=torch.float32), torch.tensor(categories[:, 0].astype(np.int64))
+
+    with open(args.train_file, "rb") as f:
+        finetune_trajectories, val_trajectories = split_into_train_and_test(pickle.load(f), train_ratio=1 - args.val_fraction)
+    with open(args.test_file, "rb") as f:
+        test_trajectories = pickle.load(f)
+    val_data, val_labels = load_segments(val_trajectories)
+    test_data, test_labels = load_segments(test_trajectories, args.max_segments)
+    if args.finetune_epochs:
+        finetune_data, finetune_labels = load_segments(finetune_trajectories)
+    logger.info("%d validation and %d test segments of %d frames", len(val_data), len(test_data), segment_len)
+
+    def measure(model):
+        macs, params = profile(copy.deepcopy(model), inputs=(test_data[:1],), custom_ops={Attention: count_attention}, verbose=False)
+        outputs = []
+        with torch.no_grad():
+            for batch in torch.split(test_data, args.batch_size):
+                outputs.append(model(batch))
+            segment = test_data[:1]
+            model(segment)
+            begin = time.perf_counter()
+            for _ in range(args.repeats):
+                model(segment)
+            latency = (time.perf_counter() - begin) / args.repeats
+        predictions = torch.cat(outputs).argmax(dim=1)
+        return macs, params, latency, accuracy_score(test_labels, predictions), balanced_accuracy_score(test_labels, predictions)
+
+    def finetune(model):
+        model.train()
+        optim = torch.optim.Adam(model.parameters(), lr=args.lr, betas=(0.9, 0.98), eps=1e-9)
+        cross_entropy_loss = nn.CrossEntropyLoss()
+        for epoch in range(args.finetune_epochs):
+            for index in torch.split(torch.randperm(len(finetune_data)), args.batch_size):
+                optim.zero_grad(set_to_none=True)
+                cross_entropy_loss(model(finetune_data[index]), finetune_labels[index]).backward()
+                optim.step()
+            logger.info("fine-tuning epoch %d done", epoch + 1)
+        return model.eval()
+
+    def total_sizes(model):
+        return (sum(module.num_heads for module in model.modules() if isinstance(module, Attention)),
+                sum(module.fc1.out_features for module in model.modules() if isinstance(module, Mlp)))
+
+    scores = importance_scores(model, val_data, val_labels, args.batch_size)
+    heads, units = total_sizes(model)
+
+    columns = ['RATIO', 'HEADS', 'MLP UNITS', 'PARAMS', 'MACS (M)', 'LATENCY (MS)', 'SPEEDUP', 'ACCURACY', 'BALANCED ACCURACY']
+    if args.finetune_epochs:
+        columns += ['FINE-TUNED ACCURACY', 'FINE-TUNED BALANCED ACCURACY']
+    t = PrettyTable(columns)
+    for ratio in [0] + args.ratios:
+        pruned = prune_model(model, scores, ratio) if ratio else model
+        macs, params, latency, accuracy, balanced_accuracy = measure(pruned)
+        if not ratio:
+            reference_latency = latency
+        pruned_heads, pruned_units = total_sizes(pruned)
+        row = [ratio, '%d/%d' % (pruned_heads, heads), '%d/%d' % (pruned_units, units),
+               '%d' % params, '%.2f' % (macs / 1e6), '%.3f' % (latency * 1000), '%.2f' % (reference_latency / latency), '%.4f' % accuracy, '%.4f' % balanced_accuracy]
+
+        if ratio:
+            if args.finetune_epochs:
+                pruned = finetune(pruned)
+                _, _, _, accuracy, balanced_accuracy = measure(pruned)
+            output = args.model[:-3] + '_pruned_%g.pt' % ratio
+            torch.save({'manifest': dict(manifest, pruning=pruned_sizes(pruned)), 'state_dict': pruned.state_dict()}, output)
+            logger.info("Saved %s", output)
+        if args.finetune_epochs:
+            row += ['%.4f' % accuracy, '%.4f' % balanced_accuracy]
+        t.add_row(row)
+        logger.info("ratio %g done", ratio)
+
+    logger.info('\n' + str(t))
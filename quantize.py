@@ -0,0 +1,116 @@
+ #!/bin/env python
+
+'''
+Post-training int8 quantization of a trained model for CPU inference. The nn.Linear layers of the embeddings,
+Attention.qkv/proj and the Mlp are quantized, the classifier head stays in float:
+  dynamic   int8 weights, the activations are quantized with a scale computed per batch at run time
+  static    int8 weights, the activation scales are calibrated once on a sample of training segments
+The quantized checkpoint keeps the manifest of the model, load_model in utils.py loads it like any other checkpoint (quantize_model is in compression.py).
+Run as a script to quantize a checkpoint and report the accuracy loss against the CPU speedup and the size reduction.
+'''
+
+import torch
+import numpy as np
+import io
+import pickle
+import time
+import argparse
+from prettytable import PrettyTable
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+
+from compression import QUANTIZATION_MODES, quantize_model, make_quantized_checkpoint
+
+
+if __name__ == '__main__':
+    from trajectory import extract_fixed_sized_segments, remove_short_trajectories
+    from utils import SetupLogger, load_checkpoint, check_all_frames, build_model
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="checkpoint of a trained model, e.g. <name>_fold_1.pt")
+    parser.add_argument("--train_file", help="pickled train trajectories to calibrate the static mode on, e.g. trajectories_train_NTU_2D.dat")
+    parser.add_argument("--test_file", help="pickled test trajectories, e.g. trajectories_test_NTU_2D.dat")
+    parser.add_argument("--modes", help="quantization modes to compare with float32", default=list(QUANTIZATION_MODES), nargs='+')
+    parser.add_argument("--engine", help="quantized engine, x86/fbgemm for x86 CPUs, qnnpack for ARM", default=torch.backends.quantized.engine)
+    parser.add_argument("--calibration_segments", help="number of training segments to calibrate the static mode on", default=2000, type=int)
+    parser.add_argument("--batch_size", help="number of segments per forward pass", default=500, type=int)
+    parser.add_argument("--max_segments", help="number of test segments to evaluate, 0 for all", default=20000, type=int)
+    parser.add_argument("--repeats", help="number of timed single segment forward passes for the latency", default=100, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+    torch.set_num_threads(args.threads)
+    torch.backends.quantized.engine = args.engine # the int8 models are timed with the engine they are quantized for, quantize_model restores the engine it set
+
+    state_dict, manifest = load_checkpoint(args.model)
+    if manifest is None:
+        raise Exception('quantization needs a checkpoint with a manifest, see save_checkpoint in utils.py')
+    check_all_frames(manifest, args.model)
+    if manifest.get('quantization'):
+        raise Exception('%s is already quantized' % args.model)
+    model = build_model(manifest, state_dict).eval()
+    layout = manifest['layout']
+    dataset, segment_len = layout['dataset'], layout['segment_length']
+
+    def load_segments(path, max_segments):
+        with open(path, "rb") as f:
+            trajectories = remove_short_trajectories(pickle.load(f), input_length=segment_len, input_gap=0, pred_length=0)
+        _, _, _, _, categories, X = extract_fixed_sized_segments(dataset, trajectories, input_length=segment_len)
+        if max_segments:
+            # a fixed random subset, the same for all modes
+            subset = np.random.RandomState(0).permutation(len(X))[:max_segments]
+            categories, X = categories[subset], X[subset]
+        return torch.tensor(X, dtype=torch.float32), torch.tensor(categories[:, 0].astype(np.int64))
+
+    data, labels = load_segments(args.test_file, args.max_segments)
+    logger.info("%d test segments of %d frames", len(data), segment_len)
+    if 'static' in args.modes:
+        calibration, _ = load_segments(args.train_file, args.calibration_segments)
+        logger.info("%d calibration segments", len(calibration))
+
+    def checkpoint_size(checkpoint):
+        buffer = io.BytesIO()
+        torch.save(checkpoint, buffer)
+        return buffer.tell()
+
+    def evaluate(model):
+        outputs = []
+        with torch.no_grad():
+            begin = time.perf_counter()
+            for batch in torch.split(data, args.batch_size):
+                outputs.append(model(batch))
+            throughput = len(data) / (time.perf_counter() - begin)
+
+            segment = data[:1]
+            model(segment)
+            begin = time.perf_counter()
+            for _ in range(args.repeats):
+                model(segment)
+            latency = (time.perf_counter() - begin) / args.repeats
+        return torch.cat(outputs), throughput, latency
+
+    t = PrettyTable(['MODE', 'SIZE (KB)', 'SIZE REDUCTION', 'SAMPLES/S', 'SPEEDUP', 'LATENCY (MS)', 'ACCURACY', 'ACCURACY LOSS', 'BALANCED ACCURACY', 'SAME PREDICTION'])
+    for mode in ['float32'] + args.modes:
+        if mode == 'float32':
+            quantized, checkpoint = model, {'manifest': manifest, 'state_dict': model.state_dict()}
+        else:
+            quantized = quantize_model(model, mode, args.engine, calibration if mode == 'static' else None, args.batch_size)
+            checkpoint = make_quantized_checkpoint(quantized, manifest, mode, args.engine)
+            output = args.model[:-3] + '_int8_%s.pt' % mode
+            torch.save(checkpoint, output)
+            logger.info("Saved %s", output)
+
+        log_likelihoods, throughput, latency = evaluate(quantized)
+        predictions = log_likelihoods.argmax(dim=1)
+        size = checkpoint_size(checkpoint)
+        accuracy = accuracy_score(labels, predictions)
+        if mode == 'float32':
+            reference_predictions, reference_size, reference_throughput, reference_accuracy = predictions, size, throughput, accuracy
+
+        t.add_row([mode, '%.1f' % (size / 1024), '%.2f' % (reference_size / size), '%.1f' % throughput, '%.2f' % (throughput / reference_throughput), '%.3f' % (latency * 1000),
+                   '%.4f' % accuracy, '%.4f' % (reference_accuracy - accuracy), '%.4f' % balanced_accuracy_score(labels, predictions),
+                   '%.4f' % (predictions == reference_predictions).float().mean().item()])
+        logger.info("%s done", mode)
+
+    logger.info('\n' + str(t))
@@ -0,0 +1,110 @@
+ #!/bin/env python
+
+'''
+Replays recorded trajectory CSV files as live skeleton streams through the OnlineClassifier
+and reports the per frame latency.
+'''
+
+import torch
+import numpy as np
+import time
+import glob
+import os
+import sys
+import argparse
+
+from streaming import OnlineClassifier, MultiStreamScheduler
+from utils import SetupLogger, load_model
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", help="trained model (*_fold_N.pt) to run")
+parser.add_argument("--csv", help="trajectory CSV files or folders containing them", nargs='+')
+parser.add_argument("--segment_len", help="number of frames per window the model was trained on", type=int)
+parser.add_argument("--every", help="predict every k frames", default=1, type=int)
+parser.add_argument("--fps", help="replay rate in frames per second, 0 replays as fast as possible", default=30, type=float)
+parser.add_argument("--threads", help="number of CPU threads used by torch", default=1, type=int)
+parser.add_argument("--no_cache", help="buffer raw frames even if the model can cache frame features", action='store_true')
+parser.add_argument("--batched", help="classify all persons of a tick in one batch with the MultiStreamScheduler", action='store_true')
+args = parser.parse_args()
+
+logger = SetupLogger('logger')
+logger.info('parser args: %s', str(args))
+
+torch.set_num_threads(args.threads)
+
+'''
+LOAD THE RECORDED TRAJECTORIES, one stream per CSV file (frame number followed by the keypoints)
+'''
+files = []
+for path in args.csv:
+    if os.path.isdir(path):
+        files.extend(sorted(glob.glob(os.path.join(path, '**', '*.csv'), recursive=True)))
+    else:
+        files.append(path)
+
+streams = {}
+for file in files:
+    trajectory = np.loadtxt(file, dtype=np.float32, delimiter=',', ndmin=2)
+    streams[os.path.basename(file)[:-4]] = trajectory[:, 1:]
+
+logger.info("Loaded %d streams with %d frames", len(streams), sum(len(x) for x in streams.values()))
+
+if args.batched:
+    classifier = MultiStreamScheduler(load_model(args.model, all_frames=True), args.segment_len, every=args.every, cache_features=not args.no_cache)
+else:
+    classifier = OnlineClassifier(load_model(args.model, all_frames=True), args.segment_len, every=args.every, cache_features=not args.no_cache)
+logger.info("Caching frame features: %s", str(classifier.cache_features))
+
+'''
+REPLAY, all streams start together and get one frame per tick
+'''
+latencies = []
+predictions = 0
+missed_ticks = 0
+num_ticks = max(len(x) for x in streams.values())
+
+start = time.perf_counter()
+for tick in range(num_ticks):
+    if args.fps > 0:
+        deadline = start + tick / args.fps
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        elif tick > 0:
+            missed_ticks += 1
+
+    if args.batched:
+        # persons whose stream ended are missing from the tick and leave the scene
+        outputs = classifier.tick({person: frames[tick] for person, frames in streams.items() if tick < len(frames)})
+        predictions += len(outputs)
+        continue
+
+    for person, frames in streams.items():
+        if tick == len(frames):
+            classifier.remove(person)
+        if tick >= len(frames):
+            continue
+
+        begin = time.perf_counter()
+        output = classifier.update(person, frames[tick])
+        latencies.append(time.perf_counter() - begin)
+
+        if output is not None:
+            predictions += 1
+
+total_time = time.perf_counter() - start
+
+if args.batched:
+    stats = classifier.statistics()
+    logger.info("Frames: %d, predictions: %d, ticks: %d, missed ticks: %d", sum(classifier.tick_persons), predictions, num_ticks, missed_ticks)
+    logger.info("Latency per tick (ms): mean %.3f, p50 %.3f, p90 %.3f, p99 %.3f, max %.3f", stats['latency_mean'], stats['latency_p50'], stats['latency_p90'], stats['latency_p99'], stats['latency_max'])
+    logger.info("Persons per tick: %.2f, batch size per tick: %.2f", stats['persons_mean'], stats['batch_mean'])
+    logger.info("Throughput: %.1f frames/s, %.1f predictions/s of processing time, replay took %.2f s", stats['frames_per_s'], stats['predictions_per_s'], total_time)
+    sys.exit()
+
+latencies = np.array(latencies) * 1000
+
+logger.info("Frames: %d, predictions: %d, ticks: %d, missed ticks: %d", len(latencies), predictions, num_ticks, missed_ticks)
+logger.info("Latency per frame (ms): mean %.3f, p50 %.3f, p90 %.3f, p99 %.3f, max %.3f", latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 90), np.percentile(latencies, 99), latencies.max())
+logger.info("Throughput: %.1f frames/s, replay took %.2f s", len(latencies) / total_time, total_time)
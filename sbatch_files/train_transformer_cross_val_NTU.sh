@@ -36,4 +36,5 @@ echo $CONDA_DEFAULT_ENV
 # python -u ../train_transformer_cross_val_NTU.py --filename training_NTU_2D_128d_100e_10p_001 --lr 0.001 --embed_dim 128 --dataset NTU_2D --model_type temporal --epochs 100 --patience 10
 # python -u ../train_transformer_cross_val_NTU.py --config_file ../config_debug.yml
 # python -u ../train_transformer_cross_val_NTU.py --filename temporal_2 --lr 0.001 --embed_dim 128 --dataset NTU_2D --model_type temporal_2 --epochs 100 --patience 10 --batch_size 2000
-python -u ../train_transformer_cross_val_NTU.py --config_file ../config.yml
+# torchrun --standalone --nproc_per_node=4 ../train_transformer_cross_val_NTU.py --config_file ../config.yml --resume   # CPU nodes: data parallel training, the cores of -c are split between the 4 processes
+python -u ../train_transformer_cross_val_NTU.py --config_file ../config.yml --resume   # continues a preempted run, starts a new one if there is no saved training state
@@ -0,0 +1,264 @@
+ #!/bin/env python
+
+'''
+Local inference server for trained models (*_fold_N.pt).
+
+POST /predict  {"model": <name>, "segments": [segment, ...]} with every segment a list of frames (2xnumber of joints values)
+               returns {"log_likelihoods": [...], "predictions": [...]}
+GET  /stats    returns the batching policy and batch statistics of every model
+POST /policy   {"model": <name>, "max_batch_size": n, "max_wait_ms": ms} changes the batching policy of a model, see load_generator.py
+
+Concurrent requests to the same model are collected into dynamic batches that are bounded by
+a maximum number of segments and a maximum wait time after the first request arrived.
+With --compile the models are compiled with torch.compile, the batches are padded to a power of two
+(at most --max_batch_size) so only a few batch shapes are compiled, all of them at startup.
+A policy can then only lower the maximum batch size, a larger one would need batch shapes that were not compiled.
+'''
+
+import torch
+import numpy as np
+import threading
+import queue
+import time
+import json
+import os
+import math
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils import SetupLogger, load_model, load_checkpoint, compile_model, pad_batch
+
+
+class DynamicBatcher:
+    '''
+    Runs the requests of one model in dynamic batches on a background thread.
+    '''
+    def __init__(self, model, max_batch_size=256, max_wait=0.005, device='cpu', compile=False):
+        self.model = model.to(device)
+        self.model.eval()
+        self.compiled = compile
+        if compile:
+            self.model = compile_model(self.model)
+        self.compiled_batch_size = max_batch_size # largest padded batch size, fixed at startup
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.device = device
+        self.queue = queue.Queue()
+        self.pending = None # request that did not fit in the previous batch
+
+        self.num_batches = 0
+        self.num_requests = 0
+        self.num_segments = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, segments):
+        '''
+        Queues the segments (n f e) of one request and waits for their log likelihoods
+        '''
+        request = {'segments': torch.as_tensor(segments, dtype=torch.float32), 'done': threading.Event(), 'output': None, 'error': None}
+        self.queue.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise request['error']
+        return request['output']
+
+    def collect(self):
+        '''
+        Blocks until a request arrives, then collects more requests until the batch is full or max_wait has passed
+        '''
+        if self.pending is not None:
+            requests, self.pending = [self.pending], None
+        else:
+            requests = [self.queue.get()]
+        size = len(requests[0]['segments'])
+        deadline = time.perf_counter() + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(request['segments']) > self.max_batch_size:
+                self.pending = request
+                break
+            requests.append(request)
+            size += len(request['segments'])
+
+        return requests
+
+    def set_policy(self, max_batch_size=None, max_wait=None):
+        '''
+        Changes the batching policy, it applies from the next batch on
+        '''
+        if max_batch_size is not None:
+            if max_batch_size < 1:
+                raise ValueError('max_batch_size must be at least 1, got %d' % max_batch_size)
+            if self.compiled and max_batch_size > self.compiled_batch_size:
+                raise ValueError('max_batch_size can be at most %d, the largest batch size compiled at startup, got %d' % (self.compiled_batch_size, max_batch_size))
+            self.max_batch_size = max_batch_size
+        if max_wait is not None:
+            self.max_wait = max_wait
+
+    def padded_size(self, n):
+        '''
+        The batch size compiled by warmup that n segments are padded to: the next power of two, at most compiled_batch_size
+        '''
+        return min(2 ** math.ceil(math.log2(n)), self.compiled_batch_size)
+
+    @torch.no_grad()
+    def predict(self, x):
+        if self.compiled:
+            # a single request can have more segments than the largest compiled batch, it runs in several
+            return torch.cat([self.model(pad_batch(batch, self.padded_size(len(batch))).to(self.device))[:len(batch)].cpu() for batch in torch.split(x, self.compiled_batch_size)])
+        return self.model(x.to(self.device)).cpu()
+
+    def warmup(self, segment_shape):
+        '''
+        Compiles the model for all padded batch sizes, so no request has to wait for compilation
+        '''
+        for batch_size in sorted({self.padded_size(2 ** exponent) for exponent in range(math.ceil(math.log2(self.compiled_batch_size)) + 1)}):
+            self.predict(torch.zeros((batch_size,) + tuple(segment_shape)))
+
+    @torch.no_grad()
+    def forward(self, requests):
+        segments = [request['segments'] for request in requests]
+        try:
+            outputs = self.predict(torch.cat(segments, dim=0))
+            outputs = torch.split(outputs, [len(x) for x in segments])
+        except Exception:
+            # e.g. requests with different segment shapes, run them one by one so only the bad ones fail
+            outputs = []
+            for x in segments:
+                try:
+                    outputs.append(self.predict(x))
+                except Exception as error:
+                    outputs.append(error)
+
+        for request, output in zip(requests, outputs):
+            if isinstance(output, Exception):
+                request['error'] = output
+            else:
+                request['output'] = output
+            request['done'].set()
+
+    def run(self):
+        while True:
+            requests = self.collect()
+            self.forward(requests)
+
+            self.num_batches += 1
+            self.num_requests += len(requests)
+            self.num_segments += sum(len(request['segments']) for request in requests)
+
+    def statistics(self):
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'batches': self.num_batches,
+            'requests': self.num_requests,
+            'segments': self.num_segments,
+        }
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP handler, self.server.batchers maps the model names to their DynamicBatcher
+    '''
+    def reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, {name: batcher.statistics() for name, batcher in self.server.batchers.items()})
+        else:
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path == '/policy':
+            self.set_policy()
+            return
+        if self.path != '/predict':
+            self.reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            batcher = self.server.batchers[request['model']]
+            segments = np.asarray(request['segments'], dtype=np.float32)
+            if segments.ndim != 3:
+                raise ValueError('segments must have the shape n f e, got %s' % str(segments.shape))
+            log_likelihoods = batcher.submit(segments)
+        except KeyError as error:
+            self.reply(400, {'error': 'unknown model or missing field %s' % str(error)})
+            return
+        except Exception as error:
+            self.reply(400, {'error': str(error)})
+            return
+
+        self.reply(200, {'log_likelihoods': log_likelihoods.tolist(), 'predictions': torch.argmax(log_likelihoods, dim=1).tolist()})
+
+    def set_policy(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            batcher = self.server.batchers[request['model']]
+            max_wait_ms = request.get('max_wait_ms')
+            batcher.set_policy(request.get('max_batch_size'), max_wait_ms / 1000 if max_wait_ms is not None else None)
+        except KeyError as error:
+            self.reply(400, {'error': 'unknown model or missing field %s' % str(error)})
+            return
+        except Exception as error:
+            self.reply(400, {'error': str(error)})
+            return
+
+        self.reply(200, batcher.statistics())
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="model to serve as name=path or path (name is the file name), can be repeated", action='append', required=True)
+    parser.add_argument("--host", help="address to listen on", default="127.0.0.1")
+    parser.add_argument("--port", help="port to listen on", default=8000, type=int)
+    parser.add_argument("--max_batch_size", help="maximum number of segments per batch", default=256, type=int)
+    parser.add_argument("--max_wait_ms", help="maximum time to wait for more requests after the first one of a batch", default=5, type=float)
+    parser.add_argument("--threads", help="number of CPU threads used by torch", default=torch.get_num_threads(), type=int)
+    parser.add_argument("--compile", help="torch.compile the models (torch >= 2.0), compiling at startup needs the checkpoint manifest for the segment shape", action='store_true')
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+
+    torch.set_num_threads(args.threads)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    batchers = {}
+    for model in args.model:
+        name, path = model.split('=', 1) if '=' in model else (os.path.basename(model)[:-3], model)
+        batchers[name] = DynamicBatcher(load_model(path, device, all_frames=True), args.max_batch_size, args.max_wait_ms / 1000, device, compile=args.compile)
+        logger.info("Loaded model %s from %s", name, path)
+        if args.compile:
+            _, manifest = load_checkpoint(path)
+            if manifest is None:
+                logger.info("No manifest in %s, %s is compiled at its first requests", path, name)
+                continue
+            begin = time.perf_counter()
+            layout = manifest['layout']
+            batchers[name].warmup((layout['segment_length'], layout['num_joints'] * layout['in_chans']))
+            logger.info("Compiled %s for batch sizes up to %d in %.1f s", name, args.max_batch_size, time.perf_counter() - begin)
+
+    ThreadingHTTPServer.request_queue_size = 128 # listen backlog, the default of 5 resets connections under load
+    server = ThreadingHTTPServer((args.host, args.port), InferenceHandler)
+    server.batchers = batchers
+    logger.info("Serving %s on http://%s:%d (max batch size %d, max wait %.1f ms)", ','.join(batchers), args.host, args.port, args.max_batch_size, args.max_wait_ms)
+    server.serve_forever()
@@ -0,0 +1,30 @@
+ #!/bin/env python
+
+'''
+Splits a pickled train trajectory file (output of load_trajectories_NTU.py) into a sharded trajectory store.
+Set TRAINING: TRAJECTORY_SHARDS to the output folder, then every rank of a distributed training
+reads and segments only its own shards instead of the whole train set.
+'''
+
+import pickle
+import argparse
+
+from trajectory import write_trajectory_shards
+from utils import SetupLogger
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", help="pickled dict of trajectories, e.g. trajectories_train_NTU_decom_GR_3D.dat")
+parser.add_argument("--output", help="folder of the sharded trajectory store")
+parser.add_argument("--num_shards", help="number of shards, at least the number of ranks that will read the store", default=64, type=int)
+args = parser.parse_args()
+
+logger = SetupLogger('logger')
+logger.info('parser args: %s', str(args))
+
+with open(args.input, "rb") as f:
+    trajectories = pickle.load(f)
+logger.info("Loaded %d trajectories", len(trajectories))
+
+frames = write_trajectory_shards(args.output, trajectories, args.num_shards)
+logger.info("Wrote %d shards to %s, frames per shard: min %d, max %d", args.num_shards, args.output, min(frames), max(frames))
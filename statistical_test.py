@@ -11,6 +11,8 @@ import os
 import argparse
 import csv
 from einops import rearrange
+from utils import load_checkpoint, check_all_frames, build_model
+import transformer_store_attn
 
 from visualize_attention_weights import visualize_attention_weights
 from visualize_skeleton_and_attention import visualize_skeleton_and_attention
@@ -68,15 +70,11 @@ embed_dim_2 = 16
 def load_model(model_type, filename, embed_dim):
 
     PATH = '/data/s3447707/MasterThesis/trained_models/' + filename + '.pt'
-    model = torch.load(PATH)
-    
-    
-    NEW_PATH = '/data/s3447707/MasterThesis/saved_state_dict/' + filename + '.pt'
-    if not os.path.isfile(NEW_PATH):
-        torch.save(model.state_dict(), NEW_PATH)
-        print('\nsave model state dict to', NEW_PATH)
-    else:
-        print('\model state dict %s already exists' % (NEW_PATH))
+    state_dict, manifest = load_checkpoint(PATH)
+    check_all_frames(manifest, PATH)
+    if manifest is not None:
+        # the checkpoint describes its model, the _store_attn variant of its class keeps the attention weights
+        return build_model(manifest, state_dict, models=transformer_store_attn, class_suffix='_store_attn')
     
     
     #Create model object
@@ -97,7 +95,7 @@ def load_model(model_type, filename, embed_dim):
     
     
     #Load model state dict
-    model.load_state_dict(torch.load(NEW_PATH), strict=False)
+    model.load_state_dict(state_dict, strict=False)
     return model
 
 
@@ -0,0 +1,211 @@
+import torch
+import numpy as np
+import time
+
+
+class FrameRingBuffer:
+    '''
+    A fixed length ring buffer over the last frames (or frame features) of one tracked person.
+    '''
+    def __init__(self, length, dim, device='cpu'):
+        self.length = length
+        self.frames = torch.zeros(length, dim, device=device)
+        self.order = torch.arange(length, device=device)
+        self.position = 0 # slot that is written next
+        self.count = 0 # number of frames pushed so far
+
+    def push(self, frame):
+        self.frames[self.position] = frame
+        self.position = (self.position + 1) % self.length
+        self.count += 1
+
+    def is_full(self):
+        return self.count >= self.length
+
+    def window(self):
+        '''
+        Returns the buffered frames in chronological order, shape: f e
+        '''
+        return self.frames[(self.order + self.position) % self.length]
+
+
+class OnlineClassifier:
+    '''
+    Online inference on live skeleton streams, frames are passed one at a time per tracked person.
+    Keeps a ring buffer of the last segment_length frames of every person and classifies the window every
+    `every` frames once it is full, so the work per frame is constant.
+    Models with a per frame spatial stage (SpatialTemporalTransformer) buffer the spatial features instead
+    of the raw frames, so every frame is spatially encoded only once.
+    '''
+    def __init__(self, model, segment_length, every=1, device='cpu', cache_features=True):
+        self.model = model.to(device)
+        self.model.eval()
+        self.segment_length = segment_length
+        self.every = every
+        self.device = device
+        self.cache_features = cache_features and hasattr(model, 'Spatial_forward_frames')
+        self.buffers = {}
+
+    def encode(self, frames):
+        '''
+        Turns raw frames (n e) into what is kept in the ring buffers
+        '''
+        if self.cache_features:
+            return self.model.Spatial_forward_frames(frames)
+        return frames
+
+    def classify(self, windows):
+        '''
+        Returns the log likelihoods of a batch of buffered windows, shape: b f e
+        '''
+        if self.cache_features:
+            return self.model.forward_cached(windows)
+        return self.model(windows)
+
+    def push(self, person, frame):
+        '''
+        Adds the next frame of a person to its ring buffer, returns whether a prediction is due
+        '''
+        buffer = self.buffers.get(person)
+        if buffer is None:
+            buffer = FrameRingBuffer(self.segment_length, frame.shape[-1], self.device)
+            self.buffers[person] = buffer
+        buffer.push(frame)
+        return buffer.is_full() and (buffer.count - self.segment_length) % self.every == 0
+
+    @torch.no_grad()
+    def update(self, person, frame):
+        '''
+        Takes the next skeleton frame (2xnumber of joints values) of a person.
+        Returns the log likelihoods of the current window, or None if no prediction is due on this frame.
+        '''
+        frame = torch.as_tensor(frame, dtype=torch.float32, device=self.device)
+        frame = self.encode(frame.unsqueeze(0))[0]
+
+        if not self.push(person, frame):
+            return None
+
+        return self.classify(self.buffers[person].window().unsqueeze(0))[0]
+
+    def remove(self, person):
+        '''
+        Drops the buffer of a person that left the scene
+        '''
+        self.buffers.pop(person, None)
+
+
+class MultiStreamScheduler(OnlineClassifier):
+    '''
+    Batched online inference over many tracked persons at once.
+    Every tick takes the new frame of each person in the scene, encodes them together and classifies
+    all persons whose window is due in a single forward pass. The ring buffers of all persons share one
+    tensor (one slot per person), so writing frames and gathering windows is vectorized.
+    Persons that are missing for more than max_missing ticks are considered gone and their slot is freed.
+    '''
+    def __init__(self, model, segment_length, every=1, device='cpu', cache_features=True, max_missing=0, capacity=16):
+        super().__init__(model, segment_length, every=every, device=device, cache_features=cache_features)
+        self.max_missing = max_missing
+        self.capacity = capacity
+        self.frames = None # capacity f e, allocated on the first tick
+        self.positions = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.counts = torch.zeros(capacity, dtype=torch.long, device=device)
+        self.order = torch.arange(segment_length, device=device)
+        self.slots = {} # person -> slot
+        self.missing = {} # person -> number of ticks without a frame
+        self.free_slots = list(range(capacity))
+
+        self.tick_latencies = []
+        self.tick_persons = []
+        self.tick_batch_sizes = []
+
+    def grow(self):
+        '''
+        Doubles the number of slots
+        '''
+        self.free_slots.extend(range(self.capacity, 2*self.capacity))
+        self.positions = torch.cat((self.positions, torch.zeros_like(self.positions)))
+        self.counts = torch.cat((self.counts, torch.zeros_like(self.counts)))
+        if self.frames is not None:
+            self.frames = torch.cat((self.frames, torch.zeros_like(self.frames)))
+        self.capacity *= 2
+
+    def enter(self, person):
+        if not self.free_slots:
+            self.grow()
+        slot = self.free_slots.pop(0)
+        self.positions[slot] = 0
+        self.counts[slot] = 0
+        self.slots[person] = slot
+        return slot
+
+    def remove(self, person):
+        slot = self.slots.pop(person, None)
+        self.missing.pop(person, None)
+        if slot is not None:
+            self.free_slots.append(slot)
+
+    @torch.no_grad()
+    def tick(self, frames):
+        '''
+        Takes a dict person -> skeleton frame (2xnumber of joints values) with the frames of this tick.
+        Returns a dict person -> log likelihoods for every person whose prediction is due.
+        '''
+        begin = time.perf_counter()
+
+        for person in list(self.slots):
+            if person in frames:
+                self.missing[person] = 0
+            else:
+                self.missing[person] = self.missing.get(person, 0) + 1
+                if self.missing[person] > self.max_missing:
+                    self.remove(person)
+
+        predictions = {}
+        if frames:
+            persons = list(frames)
+            slots = torch.tensor([self.slots[p] if p in self.slots else self.enter(p) for p in persons], device=self.device)
+
+            x = torch.as_tensor(np.stack([np.asarray(frames[p], dtype=np.float32) for p in persons]), device=self.device)
+            x = self.encode(x)
+
+            if self.frames is None:
+                self.frames = torch.zeros(self.capacity, self.segment_length, x.shape[-1], device=self.device)
+            self.frames[slots, self.positions[slots]] = x
+            self.positions[slots] = (self.positions[slots] + 1) % self.segment_length
+            self.counts[slots] += 1
+
+            counts = self.counts[slots]
+            due = (counts >= self.segment_length) & ((counts - self.segment_length) % self.every == 0)
+
+            if due.any():
+                ready = slots[due]
+                windows = self.frames[ready.unsqueeze(1), (self.order + self.positions[ready].unsqueeze(1)) % self.segment_length]
+                outputs = self.classify(windows)
+                ready_persons = [p for p, d in zip(persons, due.tolist()) if d]
+                predictions = dict(zip(ready_persons, outputs))
+
+        self.tick_latencies.append(time.perf_counter() - begin)
+        self.tick_persons.append(len(frames))
+        self.tick_batch_sizes.append(len(predictions))
+
+        return predictions
+
+    def statistics(self):
+        '''
+        Returns the latency percentiles (ms) per tick, the average number of persons and batch size per tick
+        and the throughput in frames and predictions per second of processing time
+        '''
+        latencies = np.array(self.tick_latencies) * 1000
+        busy = latencies.sum() / 1000
+        return {
+            'ticks': len(latencies),
+            'latency_mean': latencies.mean(),
+            'latency_p50': np.percentile(latencies, 50),
+            'latency_p90': np.percentile(latencies, 90),
+            'latency_p99': np.percentile(latencies, 99),
+            'latency_max': latencies.max(),
+            'persons_mean': np.mean(self.tick_persons),
+            'batch_mean': np.mean(self.tick_batch_sizes),
+            'frames_per_s': sum(self.tick_persons) / busy,
+            'predictions_per_s': sum(self.tick_batch_sizes) / busy,
+        }
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# the modules live in the repository root, run the tests with python -m pytest tests
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transformer import TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer
+
+# small models of the architectures and attention variants the regression tests run on, by name
+MODELS = {
+    'temporal': (TemporalTransformer, dict(embed_dim=32)),
+    'linear': (TemporalTransformer, dict(embed_dim=32, temporal_attention='linear')),
+    'window': (TemporalTransformer, dict(embed_dim=32, temporal_window=4)),
+    'spatial_temporal': (SpatialTemporalTransformer, dict(embed_dim_ratio=8)),
+    'body_parts': (BodyPartTransformer, dict(dataset='NTU_2D', embed_dim_ratio=8)),
+}
+
+
+@pytest.fixture
+def make_model():
+    '''
+    Builds the model of a MODELS name for segments of 12 frames of 25 2D joints and 5 classes, kwargs override its options
+    '''
+    def make(name, **kwargs):
+        torch.manual_seed(0)
+        model_class, model_kwargs = MODELS[name]
+        return model_class(**dict(dict(num_classes=5, num_frames=12, num_joints=25, in_chans=2, depth=2), **model_kwargs, **kwargs))
+    return make
+
+
+@pytest.fixture(params=list(MODELS))
+def model_name(request):
+    '''
+    Every name of MODELS, tests that need other combinations parametrize model_name themselves
+    '''
+    return request.param
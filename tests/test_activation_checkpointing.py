@@ -0,0 +1,30 @@
+'''
+Activation checkpointing recomputes the activations in the backward pass, the outputs and gradients stay those of the model without it
+'''
+
+import copy
+import pytest
+import torch
+
+from transformer import set_activation_checkpointing
+
+
+def outputs_and_gradients(model, x):
+    torch.manual_seed(1) # the same dropout masks, checkpointing replays the random state of the forward pass
+    output = model(x)
+    output.sum().backward()
+    return output.detach(), {name: p.grad for name, p in model.named_parameters() if p.grad is not None}
+
+
+@pytest.mark.parametrize('model_name, mode', [('temporal', 'block'), ('spatial_temporal', 'block'), ('spatial_temporal', 'tower'), ('body_parts', 'block'), ('body_parts', 'tower')])
+def test_activation_checkpointing(make_model, model_name, mode):
+    model = make_model(model_name).train()
+    checkpointed = set_activation_checkpointing(copy.deepcopy(model), mode)
+    x = torch.randn(3, 12, 50)
+
+    output, gradients = outputs_and_gradients(model, x)
+    checkpointed_output, checkpointed_gradients = outputs_and_gradients(checkpointed, x)
+    assert torch.allclose(checkpointed_output, output, atol=1e-5)
+    assert checkpointed_gradients.keys() == gradients.keys()
+    for name, gradient in gradients.items():
+        assert torch.allclose(checkpointed_gradients[name], gradient, atol=1e-5), name
@@ -0,0 +1,49 @@
+'''
+build_model rebuilds pruned and int8 checkpoints also as the _store_attn models of the analysis scripts, and refuses options a model class lacks
+'''
+
+import pytest
+import torch
+
+import transformer
+import transformer_store_attn
+from compression import QUANTIZATION_MODES, prune_attention, prune_mlp, pruned_sizes, quantize_model
+from utils import build_model
+
+
+@pytest.mark.parametrize('model_class, kwargs', [('TemporalTransformer', dict(embed_dim=32)), ('SpatialTemporalTransformer', dict(embed_dim_ratio=8)),
+                                                 ('BodyPartTransformer', dict(dataset='NTU_2D', embed_dim_ratio=8))])
+def test_pruned_store_attn_model(model_class, kwargs):
+    torch.manual_seed(0)
+    model_kwargs = dict(num_classes=5, num_frames=12, num_joints=25, in_chans=2, depth=2, **kwargs)
+    model = getattr(transformer, model_class)(**model_kwargs).eval()
+    for module in model.modules():
+        if isinstance(module, transformer.Attention):
+            prune_attention(module, [0, 2, 5])
+        elif isinstance(module, transformer.Mlp):
+            prune_mlp(module, range(module.fc1.out_features // 2))
+    manifest = {'model_class': model_class, 'model_kwargs': model_kwargs, 'layout': {}, 'pruning': pruned_sizes(model)}
+    store_attn_model = build_model(manifest, model.state_dict(), models=transformer_store_attn, class_suffix='_store_attn').eval()
+    x = torch.randn(4, 12, 50)
+
+    with torch.no_grad():
+        assert torch.allclose(store_attn_model(x), model(x), atol=1e-5)
+
+
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_quantized_store_attn_model(mode):
+    torch.manual_seed(0)
+    model_kwargs = dict(num_classes=5, num_frames=12, num_joints=25, in_chans=2, depth=2, embed_dim=32)
+    x = torch.randn(4, 12, 50)
+    quantized = quantize_model(transformer.TemporalTransformer(**model_kwargs).eval(), mode, calibration=x)
+    manifest = {'model_class': 'TemporalTransformer', 'model_kwargs': model_kwargs, 'layout': {}, 'quantization': {'mode': mode, 'engine': torch.backends.quantized.engine}}
+    store_attn_model = build_model(manifest, quantized.state_dict(), models=transformer_store_attn, class_suffix='_store_attn').eval()
+
+    with torch.no_grad():
+        assert torch.allclose(store_attn_model(x), quantized(x), atol=1e-5)
+
+
+def test_unsupported_model_kwargs():
+    model_kwargs = dict(num_classes=5, num_frames=12, num_joints=25, in_chans=2, depth=2, embed_dim=32, early_exit=True)
+    with pytest.raises(Exception, match='TemporalTransformer_store_attn does not support the options early_exit'):
+        build_model({'model_class': 'TemporalTransformer', 'model_kwargs': model_kwargs, 'layout': {}}, models=transformer_store_attn, class_suffix='_store_attn')
@@ -0,0 +1,27 @@
+'''
+The checkpoint writer rebuilds the last saved model, and says so when no model was saved
+'''
+
+import os
+import pytest
+import torch
+
+from transformer import TemporalTransformer
+from utils import AsyncCheckpointWriter
+
+
+def test_best_model(tmp_path):
+    torch.manual_seed(0)
+    model_kwargs = dict(num_classes=5, num_frames=12, num_joints=25, in_chans=2, embed_dim=32, depth=2)
+    model = TemporalTransformer(**model_kwargs).eval()
+    writer = AsyncCheckpointWriter()
+    with pytest.raises(Exception, match='no checkpoint was saved'):
+        writer.best_model()
+
+    path = str(tmp_path / 'model_fold_1.pt')
+    writer.save(model, path, model_kwargs)
+    writer.close()
+    x = torch.randn(3, 12, 50)
+    with torch.no_grad():
+        assert torch.equal(writer.best_model().eval()(x), model(x))
+    assert os.path.exists(path)
@@ -0,0 +1,28 @@
+'''
+Chunked execution bounds the peak memory of large batches, the outputs stay those of the model run all at once
+'''
+
+import copy
+import pytest
+import torch
+
+from transformer import set_chunked_execution
+
+
+@pytest.mark.parametrize('model_name, frames, sequences', [('temporal', None, 4), ('linear', None, 4), ('window', None, 3), ('spatial_temporal', 25, None),
+                                                            ('spatial_temporal', 25, 4), ('body_parts', 7, 4)])
+def test_chunked_execution(make_model, model_name, frames, sequences):
+    model = make_model(model_name).eval()
+    chunked = set_chunked_execution(copy.deepcopy(model), frames, sequences)
+    x = torch.randn(10, 12, 50)
+
+    with torch.no_grad():
+        assert torch.allclose(chunked(x), model(x), atol=1e-5)
+        # batches smaller than the chunks run at once
+        assert torch.allclose(chunked(x[:2]), model(x[:2]), atol=1e-5)
+
+
+def test_chunked_execution_without_towers(make_model):
+    model = make_model('temporal')
+    with pytest.raises(Exception, match='no spatial towers'):
+        set_chunked_execution(model, 100, None)
@@ -0,0 +1,48 @@
+'''
+With early exits every segment of a batch gets the output and exit depth it gets when run alone, also when the batch leaves at mixed depths
+'''
+
+import pytest
+import torch
+
+
+@pytest.fixture(params=['temporal', 'spatial_temporal'])
+def model(request, make_model):
+    model = make_model(request.param, depth=4, dropout=0., early_exit=True)
+    with torch.no_grad():
+        for head in model.exit_heads: # confident exit heads, so some segments leave early and others do not
+            head[1].weight.mul_(30)
+    return model
+
+
+def test_exit_outputs(model):
+    model.train()
+    x = torch.randn(16, 12, 50)
+    output = model(x)
+
+    assert len(model.exit_outputs) == len(model.blocks) - 1
+    assert all(exit_output.shape == output.shape for exit_output in model.exit_outputs)
+
+
+def test_mixed_exit_depths(model):
+    x = torch.randn(16, 12, 50)
+    with torch.no_grad():
+        model.train()
+        model(x)
+        # half of the segments are confident enough after the first block
+        model.exit_threshold = model.exit_outputs[0].max(dim=1).values.exp().median().item()
+        # every segment leaves after the first block whose exit head is confident enough, without one it runs through all blocks
+        confident = torch.stack([exit_output.max(dim=1).values.exp() >= model.exit_threshold for exit_output in model.exit_outputs] + [torch.ones(len(x), dtype=torch.bool)], dim=1)
+        expected_depths = confident.int().argmax(dim=1) + 1
+        model.eval()
+
+        output = model(x)
+        depths = model.exit_depths.clone()
+        alone, alone_depths = [], []
+        for segment in x.split(1):
+            alone.append(model(segment))
+            alone_depths.append(model.exit_depths[0].item())
+
+    assert len(set(depths.tolist())) > 1
+    assert depths.tolist() == expected_depths.tolist() == alone_depths
+    assert torch.allclose(output, torch.cat(alone), atol=1e-5)
@@ -0,0 +1,31 @@
+'''
+An empty batch gives empty outputs, also for the attention variants and pruned heads
+'''
+
+import pytest
+import torch
+
+from compression import QUANTIZATION_MODES, prune_attention, quantize_model
+
+
+def test_empty_batch(make_model, model_name):
+    model = make_model(model_name).eval()
+    x = torch.randn(3, 12, 50)
+
+    with torch.no_grad():
+        assert model(x[:0]).shape == (0, 5)
+        prune_attention(model.blocks[0].attn, [0, 3])
+        assert model(x[:0]).shape == (0, 5)
+        assert model(x).shape == (3, 5)
+
+
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_empty_batch_quantized(make_model, mode):
+    model = make_model('temporal').eval()
+    x = torch.randn(3, 12, 50)
+    # static quantization wraps the qkv layers, the heads are split by the size of their output
+    quantized = quantize_model(model, mode, calibration=x)
+
+    with torch.no_grad():
+        assert quantized(x[:0]).shape == (0, 5)
+        assert quantized(x).shape == (3, 5)
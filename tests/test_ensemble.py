@@ -0,0 +1,39 @@
+'''
+The fold ensemble run with vmap over the stacked parameters gives the outputs of the separate fold models
+'''
+
+import pytest
+import torch
+
+from transformer import TemporalTransformer, TubeletTemporalPart_concat_chan_2_Transformer
+from ensemble import FoldEnsemble
+
+
+def fold_models(model_class, kwargs, k=3):
+    torch.manual_seed(0)
+    return [model_class(num_classes=5, num_joints=25, in_chans=2, **kwargs).eval() for _ in range(k)]
+
+
+@pytest.mark.parametrize('model_class, kwargs, num_frames', [(TemporalTransformer, dict(embed_dim=32, depth=2), 12),
+                                                             (TemporalTransformer, dict(embed_dim=32, depth=4, temporal_merge=[0.25, 0, 0.25, 0]), 12),
+                                                             (TubeletTemporalPart_concat_chan_2_Transformer, dict(dataset='NTU_2D', embed_dim=8, kernel=(8, 2, 2), stride=(8, 1, 1)), 16)])
+def test_fold_ensemble(model_class, kwargs, num_frames):
+    models = fold_models(model_class, dict(num_frames=num_frames, **kwargs))
+    ensemble = FoldEnsemble(models)
+    x = torch.randn(7, num_frames, 50)
+
+    with torch.no_grad():
+        assert torch.allclose(ensemble(x), torch.stack([model(x) for model in models]), atol=1e-5)
+
+
+def test_fold_ensemble_state():
+    models = fold_models(TemporalTransformer, dict(num_frames=12, embed_dim=32, depth=2))
+    ensemble = FoldEnsemble(models)
+    state = ensemble.state_dict()
+
+    # the stacked parameters move with the ensemble and are saved with it
+    for name, stacked in ensemble.stacked_params.items():
+        assert torch.equal(state['stacked_' + name.replace('.', '__')], stacked)
+    ensemble.to(torch.float64)
+    assert all(stacked.dtype == torch.float64 for stacked in ensemble.stacked_params.values())
+    assert all(model.head.weight.dtype == torch.float64 for model in ensemble.models)
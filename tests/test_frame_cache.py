@@ -0,0 +1,18 @@
+'''
+Sliding-window inference from cached frame features gives the same log-likelihoods as the windowed forward pass
+'''
+
+import torch
+
+from transformer import SpatialTemporalTransformer
+
+
+def test_forward_trajectory():
+    torch.manual_seed(0)
+    model = SpatialTemporalTransformer(num_frames=12, num_classes=120, num_joints=25, in_chans=2, embed_dim_ratio=8).eval()
+    trajectory = torch.randn(30, 50)
+    windows = trajectory.unfold(0, 12, 1).transpose(1, 2) # every window of 12 frames with stride 1, as extract_fixed_sized_segments
+
+    with torch.no_grad():
+        # small batches so the frames and windows are split over several batches
+        assert torch.allclose(model.forward_trajectory(trajectory, batch_size=4), model(windows), atol=1e-5)
@@ -0,0 +1,26 @@
+'''
+The exported ONNX models give the outputs of the PyTorch models, for any batch size
+'''
+
+import pytest
+import torch
+
+from transformer import TemporalTransformer, SpatialTemporalTransformer
+
+pytest.importorskip('onnxruntime')
+from onnx_export import export_onnx, random_inputs
+from onnx_inference import OnnxModel
+
+
+@pytest.mark.parametrize('model_class, kwargs, frame_selection', [(TemporalTransformer, dict(embed_dim=32), None), (TemporalTransformer, dict(embed_dim=32, temporal_merge=[0.25, 0, 0.25, 0]), None),
+                                                                  (TemporalTransformer, dict(embed_dim=32), 6), (SpatialTemporalTransformer, dict(embed_dim_ratio=8), 6)])
+def test_onnx_export(tmp_path, model_class, kwargs, frame_selection):
+    torch.manual_seed(0)
+    model = model_class(num_classes=5, num_frames=12, num_joints=25, in_chans=2, depth=4, **kwargs).eval()
+    export_onnx(model, str(tmp_path / 'model.onnx'), 12, 50, {'frame_selection': frame_selection})
+    onnx_model = OnnxModel(str(tmp_path / 'model.onnx'))
+
+    for batch_size in [1, 7]:
+        inputs = random_inputs(batch_size, 12, 50, frame_selection)
+        with torch.no_grad():
+            assert torch.allclose(torch.from_numpy(onnx_model(*[x.numpy() for x in inputs])), model(*inputs), atol=1e-5)
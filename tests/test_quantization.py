@@ -0,0 +1,25 @@
+'''
+quantize_model leaves the quantized engine of the process as it was, also when quantizing fails
+'''
+
+import pytest
+import torch
+
+from compression import QUANTIZATION_MODES, quantize_model
+
+
+@pytest.mark.parametrize('mode', QUANTIZATION_MODES)
+def test_quantized_engine_restored(make_model, mode):
+    engine = torch.backends.quantized.engine
+    others = [other for other in torch.backends.quantized.supported_engines if other not in (engine, 'none')]
+    if not others:
+        pytest.skip('only one quantized engine is supported')
+    model = make_model('temporal').eval()
+    x = torch.randn(3, 12, 50)
+
+    quantize_model(model, mode, others[0], calibration=x)
+    assert torch.backends.quantized.engine == engine
+    if mode == 'static':
+        with pytest.raises(RuntimeError):
+            quantize_model(model, mode, others[0], calibration=x[:, :, :10])
+        assert torch.backends.quantized.engine == engine
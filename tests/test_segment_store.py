@@ -0,0 +1,35 @@
+'''
+The segment store is reused only for the trajectories and description it was made from
+'''
+
+import numpy as np
+import pytest
+
+from trajectory import Trajectory, segment_store, extract_fixed_sized_segments
+
+
+def make_trajectories(seed, n=4):
+    rng = np.random.RandomState(seed)
+    trajectories = {}
+    for i in range(n):
+        trajectory_id = 'S%03dC001P001R001A%03d_%d' % (seed + 1, i + 1, i)
+        length = rng.randint(15, 25)
+        trajectories[trajectory_id] = Trajectory(trajectory_id, np.arange(length), rng.randn(length, 50).astype(np.float32), i % 3, str(i % 2), '2D')
+    return trajectories
+
+
+def test_segment_store(tmp_path):
+    path = str(tmp_path / 'train_NTU_2D_joints_12')
+    description = {'decomposed': None, 'debug': False}
+    first, second = make_trajectories(0), make_trajectories(1)
+
+    X = segment_store(path, 'NTU_2D', first, 12, description=description)[-1]
+    assert np.array_equal(X, extract_fixed_sized_segments('NTU_2D', first, 12)[-1])
+    # a reader without trajectories gets the segments of the same description
+    assert np.array_equal(segment_store(path, 'NTU_2D', None, 12, description=description)[-1], X)
+    with pytest.raises(Exception, match='made from other trajectories'):
+        segment_store(path, 'NTU_2D', None, 12, description={'decomposed': None, 'debug': True})
+
+    # other trajectories in the same folder make the segments again
+    X = segment_store(path, 'NTU_2D', second, 12, description=description)[-1]
+    assert np.array_equal(X, extract_fixed_sized_segments('NTU_2D', second, 12)[-1])
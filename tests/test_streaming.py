@@ -0,0 +1,51 @@
+'''
+Online inference on frame streams gives the same log-likelihoods as the offline forward pass over the same windows
+'''
+
+import pytest
+import torch
+
+from streaming import OnlineClassifier, MultiStreamScheduler
+from transformer import SpatialTemporalTransformer, TemporalTransformer
+
+
+def build(model_class):
+    torch.manual_seed(0)
+    if model_class is SpatialTemporalTransformer:
+        return model_class(num_frames=12, num_classes=120, num_joints=25, in_chans=2, embed_dim_ratio=8).eval()
+    return model_class(num_frames=12, num_classes=120, num_joints=25, in_chans=2, embed_dim=16).eval()
+
+
+@pytest.mark.parametrize('model_class', [TemporalTransformer, SpatialTemporalTransformer])
+def test_online_classifier(model_class):
+    model = build(model_class)
+    trajectory = torch.randn(30, 50)
+    with torch.no_grad():
+        offline = model(trajectory.unfold(0, 12, 1).transpose(1, 2))
+
+    classifier = OnlineClassifier(model, 12, every=3)
+    online = [classifier.update('person', frame) for frame in trajectory]
+
+    # a prediction every 3 frames once the first window is complete
+    assert [t for t, output in enumerate(online) if output is not None] == list(range(11, 30, 3))
+    assert torch.allclose(torch.stack([output for output in online if output is not None]), offline[::3], atol=1e-5)
+
+
+@pytest.mark.parametrize('model_class', [TemporalTransformer, SpatialTemporalTransformer])
+def test_multi_stream_scheduler(model_class):
+    model = build(model_class)
+    trajectories = {person: torch.randn(length, 50) for person, length in (('a', 30), ('b', 20), ('c', 25))}
+    with torch.no_grad():
+        offline = {person: model(trajectory.unfold(0, 12, 1).transpose(1, 2)) for person, trajectory in trajectories.items()}
+
+    # persons enter at different ticks and 'b' leaves early, fewer slots than persons so the buffers grow
+    scheduler = MultiStreamScheduler(model, 12, capacity=2)
+    starts = {'a': 0, 'b': 3, 'c': 5}
+    online = {person: [] for person in trajectories}
+    for tick in range(35):
+        frames = {person: trajectory[tick - starts[person]].numpy() for person, trajectory in trajectories.items() if 0 <= tick - starts[person] < len(trajectory)}
+        for person, output in scheduler.tick(frames).items():
+            online[person].append(output)
+
+    for person, outputs in online.items():
+        assert torch.allclose(torch.stack(outputs), offline[person], atol=1e-5)
@@ -0,0 +1,39 @@
+'''
+The grouped part embedding of the tubelet part models gives the same embeddings as one Conv3d per body part
+'''
+
+import pytest
+import torch
+from einops import rearrange
+
+from transformer import TubeletTemporalPart_mean_chan_1_Transformer, TubeletTemporalPart_concat_chan_1_Transformer, TubeletTemporalPart_mean_chan_2_Transformer, TubeletTemporalPart_concat_chan_2_Transformer, TubeletTemporalSpatialPart_concat_chan_2_Transformer
+
+
+def per_part_embedding(model, x):
+    '''
+    The part embedding as it was before the grouped convolution: every part volume through its own Conv3d
+    '''
+    convs = [model.torso_conv, model.elbows_conv, model.wrists_conv, model.knees_conv, model.ankles_conv]
+    embeds = [conv(volume) for conv, volume in zip(convs, model.part_volumes(x))]
+    if isinstance(model, (TubeletTemporalPart_mean_chan_1_Transformer, TubeletTemporalPart_mean_chan_2_Transformer)):
+        return torch.stack([torch.flatten(embed, start_dim=2).mean(dim=2) for embed in embeds], dim=1)
+    if isinstance(model, TubeletTemporalSpatialPart_concat_chan_2_Transformer):
+        towers = [model.Torso_forward_features, model.Elbow_forward_features, model.Wrist_forward_features, model.Knee_forward_features, model.Ankle_forward_features]
+        return torch.stack([tower(rearrange(embed, "b e n1 n2 n3 -> b (n1 n2 n3) e")) for tower, embed in zip(towers, embeds)], dim=1)
+    return torch.stack([rearrange(torch.flatten(embed, start_dim=2), "b e n -> b (n e)") for embed in embeds], dim=1)
+
+
+@pytest.mark.parametrize('model_class, pad_mode', [(TubeletTemporalPart_mean_chan_1_Transformer, None), (TubeletTemporalPart_concat_chan_1_Transformer, None),
+                                                   (TubeletTemporalPart_mean_chan_2_Transformer, None), (TubeletTemporalPart_concat_chan_2_Transformer, None),
+                                                   (TubeletTemporalSpatialPart_concat_chan_2_Transformer, 'constant'), (TubeletTemporalSpatialPart_concat_chan_2_Transformer, 'replicate')])
+def test_grouped_part_embedding(model_class, pad_mode):
+    torch.manual_seed(0)
+    kwargs = dict(dataset='NTU_2D', num_classes=120, num_frames=16, num_joints=25, in_chans=2, kernel=(8, 2, 2), stride=(8, 1, 1))
+    if pad_mode is None:
+        model = model_class(embed_dim=8, **kwargs).eval()
+    else:
+        model = model_class(embed_dim_ratio=8, pad_mode=pad_mode, **kwargs).eval()
+    x = torch.randn(3, 16, 50)
+
+    with torch.no_grad():
+        assert torch.allclose(model.tubelet_embedding(x), per_part_embedding(model, x), atol=1e-5)
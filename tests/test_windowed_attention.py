@@ -0,0 +1,43 @@
+'''
+Windowed attention gives the dense attention with a band mask of window positions around every token plus the global tokens
+'''
+
+import pytest
+import torch
+
+from transformer import Attention
+
+
+def banded_attention(attention, q, k, v):
+    '''
+    Dense reference: the global tokens attend to all tokens, the others to the global tokens and the tokens at most window positions away
+    '''
+    N, g = q.shape[2], attention.num_global
+    position = torch.arange(N)
+    allowed = ((position[:, None] - position[None, :]).abs() <= attention.window) | (position[None, :] < g) | (position[:, None] < g)
+    attn = ((q @ k.transpose(-2, -1)) * attention.scale).masked_fill(~allowed, float('-inf'))
+    return attn.softmax(dim=-1) @ v
+
+
+@pytest.mark.parametrize('window', [1, 2, 3, 5])
+@pytest.mark.parametrize('num_global', [0, 1, 3])
+@pytest.mark.parametrize('num_tokens', [12, 13, 17, 30]) # frame tokens that do and do not divide into windows
+def test_windowed_attention(window, num_global, num_tokens):
+    torch.manual_seed(0)
+    attention = Attention(32, num_heads=4, window=window, num_global=num_global).eval()
+    q, k, v = torch.randn(3, 3, 4, num_global + num_tokens, 8).unbind(0)
+
+    assert torch.allclose(attention.windowed_attention(q, k, v), banded_attention(attention, q, k, v), atol=1e-5)
+
+
+@pytest.mark.parametrize('chunk_size', [None, 2])
+def test_windowed_attention_forward(chunk_size):
+    torch.manual_seed(0)
+    attention = Attention(32, num_heads=4, window=3, num_global=1).eval()
+    attention.chunk_size = chunk_size
+    x = torch.randn(5, 21, 32)
+
+    with torch.no_grad():
+        q, k, v = attention.qkv(x).reshape(5, 21, 3, 4, 8).permute(2, 0, 3, 1, 4)
+        expected = attention.proj(banded_attention(attention, q, k, v).transpose(1, 2).reshape(5, 21, 32))
+        assert torch.allclose(attention(x), expected, atol=1e-5)
@@ -0,0 +1,97 @@
+ #!/bin/env python
+
+'''
+MACs, latency, throughput and accuracy of a trained model under several temporal token merging schedules (MODEL: TEMPORAL_MERGE).
+A schedule is the fraction of the frame tokens merged with a neighbouring frame after every temporal block (merge_frame_tokens in transformer.py),
+comma separated, one per block. The ratios are relative to the first schedule. Merging needs no parameters, so the schedules are applied
+to the trained model as it is, a model trained with MODEL: TEMPORAL_MERGE loses less accuracy under its own schedule.
+
+e.g. python token_merge_benchmark.py --model <name>_fold_1.pt --test_file trajectories_test_NTU_2D.dat --schedules 0,0,0,0 0.25,0.25,0.25,0 0.5,0.5,0,0
+'''
+
+import torch
+import numpy as np
+import copy
+import pickle
+import time
+import argparse
+from prettytable import PrettyTable
+from sklearn.metrics import accuracy_score, balanced_accuracy_score
+from thop import profile
+
+from prune import count_attention
+from transformer import Attention
+from trajectory import extract_fixed_sized_segments, remove_short_trajectories
+from utils import SetupLogger, load_checkpoint, check_all_frames, build_model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", help="checkpoint of a trained temporal, spatial-temporal or parts model, e.g. <name>_fold_1.pt")
+    parser.add_argument("--test_file", help="pickled test trajectories, e.g. trajectories_test_NTU_2D.dat")
+    parser.add_argument("--schedules", help="merging schedules, comma separated fractions, one per temporal block", default=['0,0,0,0', '0.25,0.25,0.25,0', '0.5,0.5,0,0', '0.5,0.5,0.5,0'], nargs='+')
+    parser.add_argument("--batch_size", help="number of segments per forward pass", default=500, type=int)
+    parser.add_argument("--max_segments", help="number of test segments to evaluate, 0 for all", default=20000, type=int)
+    parser.add_argument("--repeats", help="number of timed single segment forward passes for the latency", default=100, type=int)
+    parser.add_argument("--threads", help="number of CPU threads", default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+
+    logger = SetupLogger('logger')
+    logger.info('parser args: %s', str(args))
+    torch.set_num_threads(args.threads)
+
+    state_dict, manifest = load_checkpoint(args.model)
+    if manifest is None:
+        raise Exception('the benchmark needs a checkpoint with a manifest, see save_checkpoint in utils.py')
+    check_all_frames(manifest, args.model)
+    model = build_model(manifest, state_dict).eval()
+    if not hasattr(model, 'temporal_merge'):
+        raise Exception('%s has no temporal token merging, only the temporal, spatial-temporal and parts models have' % manifest['model_class'])
+    layout = manifest['layout']
+    dataset, segment_len = layout['dataset'], layout['segment_length']
+
+    with open(args.test_file, "rb") as f:
+        trajectories = remove_short_trajectories(pickle.load(f), input_length=segment_len, input_gap=0, pred_length=0)
+    _, _, _, _, categories, X = extract_fixed_sized_segments(dataset, trajectories, input_length=segment_len)
+    if args.max_segments:
+        subset = np.random.RandomState(0).permutation(len(X))[:args.max_segments]
+        categories, X = categories[subset], X[subset]
+    data, labels = torch.tensor(X, dtype=torch.float32), torch.tensor(categories[:, 0].astype(np.int64))
+    logger.info("%d test segments of %d frames", len(data), segment_len)
+
+    # number of tokens every temporal block runs on
+    tokens = []
+    for blk in model.blocks:
+        blk.register_forward_pre_hook(lambda module, x: tokens.append(x[0].shape[1]))
+
+    t = PrettyTable(['SCHEDULE', 'TOKENS PER BLOCK', 'MACS (M)', 'MACS RATIO', 'LATENCY (MS)', 'SPEEDUP', 'SAMPLES/S', 'ACCURACY', 'BALANCED ACCURACY'])
+    for schedule in args.schedules:
+        model.temporal_merge = [float(ratio) for ratio in schedule.split(',')]
+        if len(model.temporal_merge) != len(model.blocks):
+            raise Exception('schedule %s needs one fraction per temporal block, the model has %d' % (schedule, len(model.blocks)))
+
+        macs, _ = profile(copy.deepcopy(model), inputs=(data[:1],), custom_ops={Attention: count_attention}, verbose=False)
+        outputs = []
+        with torch.no_grad():
+            begin = time.perf_counter()
+            for batch in torch.split(data, args.batch_size):
+                outputs.append(model(batch))
+            throughput = len(data) / (time.perf_counter() - begin)
+
+            segment = data[:1]
+            del tokens[:]
+            model(segment)
+            tokens_per_block = '-'.join(str(n) for n in tokens)
+            begin = time.perf_counter()
+            for _ in range(args.repeats):
+                model(segment)
+            latency = (time.perf_counter() - begin) / args.repeats
+
+        predictions = torch.cat(outputs).argmax(dim=1)
+        if schedule == args.schedules[0]:
+            reference_macs, reference_latency = macs, latency
+        t.add_row([schedule, tokens_per_block, '%.2f' % (macs / 1e6), '%.2f' % (macs / reference_macs), '%.3f' % (latency * 1000), '%.2f' % (reference_latency / latency),
+                   '%.1f' % throughput, '%.4f' % accuracy_score(labels, predictions), '%.4f' % balanced_accuracy_score(labels, predictions)])
+        logger.info("schedule %s done", schedule)
+
+    logger.info('\n' + str(t))
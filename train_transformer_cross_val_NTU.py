@@ -7,9 +7,11 @@ import packages
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch._six import inf
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.tensorboard import SummaryWriter
 from functools import partial
 from random import shuffle
@@ -19,6 +21,7 @@ from mlflow import log_metric, log_param, start_run
 from datetime import timedelta
 from einops import rearrange
 import time
+import math
 import pickle
 import sys
 import csv
@@ -28,11 +31,13 @@ import pandas as pd
 import os
 import logging
 import argparse
+import shutil
+import subprocess
 
 
-from trajectory import Trajectory, TrajectoryDataset, extract_fixed_sized_segments, split_into_train_and_test, remove_short_trajectories, get_categories, get_UTK_categories, get_NTU_categories
-from transformer import TubeletTemporalSpatialPart_concat_chan_2_Transformer, TubeletTemporalPart_concat_chan_1_Transformer, TubeletTemporalTransformer, TubeletTemporalPart_mean_chan_1_Transformer, TubeletTemporalPart_mean_chan_2_Transformer, TubeletTemporalPart_concat_chan_2_Transformer, TemporalTransformer_4, TemporalTransformer_3, TemporalTransformer_2, BodyPartTransformer, SpatialTemporalTransformer, TemporalTransformer, Block, Attention, Mlp
-from utils import print_statistics, SetupLogger, evaluate_all, evaluate_category, conv_to_float, SetupFolders, train_acc
+from trajectory import Trajectory, TrajectoryDataset, extract_fixed_sized_segments, extract_selected_segments, segment_store, read_trajectory_shards, get_video_and_person, split_into_train_and_test, remove_short_trajectories, get_categories, get_UTK_categories, get_NTU_categories
+from transformer import TubeletTemporalSpatialPart_concat_chan_2_Transformer, TubeletTemporalPart_concat_chan_1_Transformer, TubeletTemporalTransformer, TubeletTemporalPart_mean_chan_1_Transformer, TubeletTemporalPart_mean_chan_2_Transformer, TubeletTemporalPart_concat_chan_2_Transformer, TemporalTransformer_4, TemporalTransformer_3, TemporalTransformer_2, BodyPartTransformer, SpatialTemporalTransformer, TemporalTransformer, Block, Attention, Mlp, set_activation_checkpointing, set_chunked_execution
+from utils import print_statistics, SetupLogger, evaluate_all, evaluate_category, conv_to_float, SetupFolders, train_acc, autocast, compile_model, pad_batch, AsyncCheckpointWriter, snapshot, get_rng_state, set_rng_state, torch_load, load_checkpoint, build_model
 
 # logger.info("Reading args")
 
@@ -40,40 +45,76 @@ begin_time = time.time() # Log starting time
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config_file", help="file from which configs need to be loaded", default="config")
+parser.add_argument("--resume", help="continue an interrupted training with the same config from its last saved training state", action='store_true')
 args = parser.parse_args()
 
 with open(args.config_file, "r") as ymlfile:
     cfg = yaml.load(ymlfile, Loader=yaml.FullLoader)
 
-base_folder, model_dir, log_dir, results_dir = SetupFolders(cfg['META']['NAME'], cfg['MODEL']['DATASET'])
-
-logger = SetupLogger('logger', log_dir)
+# data parallel training when started with torchrun, e.g. torchrun --standalone --nproc_per_node=4 train_transformer_cross_val_NTU.py --config_file ...
+# rank 0 does the logging, checkpointing and CSV writing
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+rank = int(os.environ.get('RANK', 0))
+distributed = world_size > 1
+if distributed:
+    # env:// as set by torchrun, launch.py can also pass a tcp:// or file:// rendezvous for several nodes
+    # short timeout for the training collectives: a hung or unreachable rank on another node stops the others after COLLECTIVE_TIMEOUT minutes
+    dist.init_process_group('gloo', init_method=os.environ.get('INIT_METHOD', 'env://'), rank=rank, world_size=world_size,
+                            timeout=timedelta(minutes=cfg['TRAINING'].get('COLLECTIVE_TIMEOUT', 30)))
+    # long timeout only for the barriers where the other ranks wait while rank 0 writes the teacher cache or tests the best model of a fold
+    rank0_wait_group = dist.new_group(timeout=timedelta(hours=6))
+    # split the cores of the node between its processes (torchrun sets OMP_NUM_THREADS=1)
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    torch.set_num_threads(max(1, num_cpus // int(os.environ.get('LOCAL_WORLD_SIZE', world_size))))
+
+# a fold worker of PARALLEL_FOLDS is a fresh process of this script, started by the training below with its folds and CPU cores
+worker_id = int(os.environ['FOLD_WORKER']) if 'FOLD_WORKER' in os.environ else None
+if worker_id is not None:
+    worker_cpus = [int(cpu) for cpu in os.environ['FOLD_WORKER_CPUS'].split(',')]
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, worker_cpus)
+    torch.set_num_threads(len(worker_cpus))
+
+if rank == 0:
+    base_folder, model_dir, log_dir, results_dir = SetupFolders(cfg['META']['NAME'], cfg['MODEL']['DATASET'], resume=args.resume or worker_id is not None)
+if distributed:
+    dist.barrier()
+if rank > 0:
+    base_folder, model_dir, log_dir, results_dir = SetupFolders(cfg['META']['NAME'], cfg['MODEL']['DATASET'], resume=True) # created by rank 0
+
+logger = SetupLogger('logger', log_dir if rank == 0 else None)
+if rank > 0:
+    logger.setLevel(logging.WARNING)
 logger.info("Logger set up!")
 logger.info("Tensorboard set up!\n\n\n\n")
 logger.info("FOLDER NAME: %s", cfg['META']['NAME'])
 logger.info("\nCONFIGS \n=======\n"+yaml.dump(cfg))
+if distributed:
+    logger.info("Distributed data parallel training with %d processes, %d threads each", world_size, torch.get_num_threads())
 
-with open(os.path.join(base_folder,'config.yml'), 'w') as config_file:
-    yaml.dump(cfg, config_file)
+if rank == 0 and worker_id is None:
+    with open(os.path.join(base_folder,'config.yml'), 'w') as config_file:
+        yaml.dump(cfg, config_file)
 
 # with start_run(run_name=args.filename):
-log_param("filename", cfg['META']['NAME'])
-log_param("embed_dim", cfg['MODEL']['EMBED_DIM'])
-log_param("debug", cfg['MODEL']['DEBUG'])
-log_param("epochs", cfg['TRAINING']['EPOCHS'])
-log_param("patience", cfg['TRAINING']['PATIENCE'])
-log_param("k_fold", cfg['TRAINING']['KFOLD'])
-log_param("lr", cfg['TRAINING']['LR'])
-log_param("lr_patience", cfg['TRAINING']['LR_PATIENCE'])
-log_param("model_type", cfg['MODEL']['MODEL_TYPE'])
-log_param("segment_length", cfg['MODEL']['SEGMENT_LEN'])
-log_param("dataset", cfg['MODEL']['DATASET'])
-log_param("batch_size", cfg['TRAINING']['BATCH_SIZE'])
-log_param("decomposed", cfg['DECOMPOSED']['ENABLE'])
-log_param("weight_decay", cfg['TRAINING']['WEIGHT_DECAY'])
-log_param("pad_mode", cfg['TUBELET']['PAD_MODE'])
-log_param("kernel", cfg['TUBELET']['KERNEL'])
-log_param("stride", cfg['TUBELET']['STRIDE'])
+if rank == 0 and worker_id is None:
+    log_param("filename", cfg['META']['NAME'])
+    log_param("embed_dim", cfg['MODEL']['EMBED_DIM'])
+    log_param("debug", cfg['MODEL']['DEBUG'])
+    log_param("epochs", cfg['TRAINING']['EPOCHS'])
+    log_param("patience", cfg['TRAINING']['PATIENCE'])
+    log_param("k_fold", cfg['TRAINING']['KFOLD'])
+    log_param("lr", cfg['TRAINING']['LR'])
+    log_param("lr_patience", cfg['TRAINING']['LR_PATIENCE'])
+    log_param("model_type", cfg['MODEL']['MODEL_TYPE'])
+    log_param("segment_length", cfg['MODEL']['SEGMENT_LEN'])
+    log_param("dataset", cfg['MODEL']['DATASET'])
+    log_param("batch_size", cfg['TRAINING']['BATCH_SIZE'])
+    log_param("decomposed", cfg['DECOMPOSED']['ENABLE'])
+    log_param("weight_decay", cfg['TRAINING']['WEIGHT_DECAY'])
+    log_param("pad_mode", cfg['TUBELET']['PAD_MODE'])
+    log_param("kernel", cfg['TUBELET']['KERNEL'])
+    log_param("stride", cfg['TUBELET']['STRIDE'])
 
 logger.info('Number of arguments given: %s arguments.', str(len(sys.argv)))
 logger.info('Arguments given: %s', ';'.join([str(x) for x in sys.argv]))
@@ -85,8 +126,10 @@ logger.info('CUDA available: %s', str(torch.cuda.is_available()))
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 logger.info('Available devices: %s', torch.cuda.device_count())
 # logger.info('Current cuda device: %s ', str(torch.cuda.current_device()))
+if distributed and device.type == 'cuda':
+    raise Exception('distributed training uses the gloo backend on CPU nodes, CUDA is not supported')
 
-writer = SummaryWriter(log_dir=log_dir) # Tensorboard writer
+writer = SummaryWriter(log_dir=log_dir, filename_suffix='' if worker_id is None else '.worker_' + str(worker_id)) if rank == 0 else None # Tensorboard writer
 
 if cfg['DECOMPOSED']['ENABLE']:
     if cfg['DECOMPOSED']['TYPE'] == "GR":
@@ -142,16 +185,35 @@ LOAD TRAINING AND TEST DATASETS (ALREADY CREATED)
 '''
 logger.info("Loading train and test files")
 
-with open(PIK_train, "rb") as f:
-    train_crime_trajectories = pickle.load(f)
-
-with open(PIK_test, "rb") as f:
-    test_crime_trajectories = pickle.load(f)
-
-logger.info("Loaded %d train and %d test files", len(train_crime_trajectories), len(test_crime_trajectories))
+# sharded trajectory store written by shard_trajectories.py, every rank of a distributed training reads only its shards of the train set
+trajectory_shards = cfg['TRAINING'].get('TRAJECTORY_SHARDS') if distributed else None
 
-# Load the frame lengths to a list so that the min, max and mean no. of frames could be found
-print_statistics(train_crime_trajectories, test_crime_trajectories, logger)
+if trajectory_shards:
+    train_crime_trajectories = read_trajectory_shards(trajectory_shards, rank, world_size)
+    logger.info("Read %d train trajectories from the shards of rank 0 in %s", len(train_crime_trajectories), trajectory_shards)
+elif worker_id is not None:
+    train_crime_trajectories = {} # the fold workers read the segments from the segment store
+else:
+    with open(PIK_train, "rb") as f:
+        train_crime_trajectories = pickle.load(f)
+
+# only rank 0 tests when the train set is sharded
+if worker_id is not None:
+    # the test segments are in the segment store too, the whole test trajectories are only needed for the frame cache
+    test_crime_trajectories = {}
+    if cfg.get('INFERENCE', {}).get('FRAME_CACHE', False):
+        with open(PIK_test, "rb") as f:
+            test_crime_trajectories = pickle.load(f)
+elif rank == 0 or not trajectory_shards:
+    with open(PIK_test, "rb") as f:
+        test_crime_trajectories = pickle.load(f)
+
+    logger.info("Loaded %d train and %d test files", len(train_crime_trajectories), len(test_crime_trajectories))
+
+    # Load the frame lengths to a list so that the min, max and mean no. of frames could be found
+    print_statistics(train_crime_trajectories, test_crime_trajectories, logger)
+else:
+    test_crime_trajectories = {}
 
 
 
@@ -178,6 +240,31 @@ if cfg['MODEL']['DEBUG']:
 logger.info("Categories: %s", ','.join(all_categories))
 
 model_name = cfg['META']['NAME'] #e.g. "transformer_model_embed_dim_32"
+frame_cache = cfg.get('INFERENCE', {}).get('FRAME_CACHE', False) # spatial-temporal only, test windows are assembled from cached frame features
+if frame_cache and cfg['MODEL']['MODEL_TYPE'] != 'spatial-temporal':
+    logger.info('FRAME_CACHE is supported by the spatial-temporal model only, testing on fixed sized segments')
+    frame_cache = False
+# chunked execution of the test evaluation, bounds the peak memory of large batches with the same outputs
+spatial_chunk, attention_chunk = cfg.get('INFERENCE', {}).get('SPATIAL_CHUNK'), cfg.get('INFERENCE', {}).get('ATTENTION_CHUNK')
+precision = cfg['TRAINING'].get('AUTOCAST') or None # mixed precision forward passes in training and evaluation, bfloat16 or float16 (CUDA only)
+if precision == 'float16' and device.type != 'cuda':
+    raise Exception('float16 autocast needs CUDA, use bfloat16 on CPU')
+activation_checkpointing = cfg['TRAINING'].get('ACTIVATION_CHECKPOINTING') # block or tower, recompute activations in the backward pass to fit larger batches and segments
+compile_models = cfg['TRAINING'].get('COMPILE', False) # torch.compile the models, the batches keep one shape so they are compiled once
+if compile_models and not hasattr(torch, 'compile'):
+    logger.info('COMPILE needs torch >= 2.0, training without it')
+    compile_models = False
+# knowledge distillation: the model also learns the soft log-likelihoods of a frozen teacher, run on every batch or read from a cache
+distillation = cfg.get('DISTILLATION', {})
+teacher_path, teacher_cache_path = distillation.get('TEACHER'), distillation.get('TEACHER_CACHE')
+temperature, alpha = distillation.get('TEMPERATURE', 4), distillation.get('ALPHA', 0.5)
+temporal_window = cfg['MODEL'].get('TEMPORAL_WINDOW') # frames attend only to the frames at most this far away and the global tokens, for long segments
+temporal_attention = cfg['MODEL'].get('TEMPORAL_ATTENTION', 'softmax') # softmax or linear (kernelized) attention of the temporal blocks
+temporal_merge = cfg['MODEL'].get('TEMPORAL_MERGE') # fraction of the frame tokens merged with a neighbouring frame after every temporal block
+frame_selection = cfg['MODEL'].get('FRAME_SELECTION') # only this many frames of every segment are kept, those with the most motion
+early_exit = cfg['MODEL'].get('EARLY_EXIT', False) # classification heads after every temporal block but the last, trained with the final head
+if frame_selection and (teacher_path or teacher_cache_path or frame_cache):
+    raise Exception('FRAME_SELECTION cannot be combined with DISTILLATION or INFERENCE: FRAME_CACHE, they run on all frames of a segment')
 embed_dim = cfg['MODEL']['EMBED_DIM']
 
 file_name_train = os.path.join(results_dir, 'training.csv')
@@ -229,14 +316,52 @@ def train_model(embed_dim, epochs):
             num_joints = num_joints*2
         elif cfg['DECOMPOSED']['TYPE'] == "GS":
             num_joints+=1
-    
-    with open(file_name_train, 'a') as csv_file_train:
-        csv_writer_train = csv.writer(csv_file_train, delimiter=';')
-        csv_writer_train.writerow(['fold', 'epoch', 'LR', 'Training Loss', 'Validation Loss', 'Validation Accuracy', 'Time'])
-    
-    with open(file_name_test, 'a') as csv_file_test:
-        csv_writer_test = csv.writer(csv_file_test, delimiter=';')
-        csv_writer_test.writerow(['fold', 'label', 'video', 'person', 'prediction', 'log_likelihoods'])
+
+    # dataset layout the models are trained on, stored in the manifest of every checkpoint
+    layout = {'dataset': dataset, 'segment_length': segment_length, 'num_joints': num_joints, 'in_chans': in_chans, 'num_classes': num_classes,
+              'decomposed': cfg['DECOMPOSED']['TYPE'] if cfg['DECOMPOSED']['ENABLE'] else None, 'categories': all_categories,
+              'frame_selection': frame_selection}
+
+    # training state of an interrupted run, saved every CHECKPOINT_EVERY epochs and after every fold
+    checkpoint_every = cfg['TRAINING'].get('CHECKPOINT_EVERY', 1)
+    # number of folds trained at the same time in worker processes, each with its own share of the CPU cores
+    parallel_folds = cfg['TRAINING'].get('PARALLEL_FOLDS', 1)
+
+    if distributed and parallel_folds > 1:
+        raise Exception('PARALLEL_FOLDS cannot be combined with distributed training, every rank trains all folds')
+
+    # compiled models by architecture, later folds reuse the compiled graphs of the first one
+    compiled_models = {}
+
+    def write_csv_headers(file_name_train, file_name_test):
+        if rank > 0:
+            return
+        with open(file_name_train, 'w') as csv_file_train:
+            csv_writer_train = csv.writer(csv_file_train, delimiter=';')
+            csv_writer_train.writerow(['fold', 'epoch', 'LR', 'Training Loss', 'Validation Loss', 'Validation Accuracy', 'Time'])
+
+        with open(file_name_test, 'w') as csv_file_test:
+            csv_writer_test = csv.writer(csv_file_test, delimiter=';')
+            csv_writer_test.writerow(['fold', 'label', 'video', 'person', 'prediction', 'log_likelihoods'])
+
+    def load_training_state(state_path, file_name_train, file_name_test):
+        '''
+        Returns the training state saved by an interrupted run and truncates the result CSVs back to when it was saved.
+        Without a saved state (or --resume) the result CSVs are started new and None is returned
+        '''
+        if not (args.resume and os.path.isfile(state_path)):
+            write_csv_headers(file_name_train, file_name_test)
+            return None
+
+        state = torch_load(state_path)
+        logger.info("Resuming after fold %d, epoch %d from %s", state['fold'], state['epoch'], state_path)
+
+        # drop the result rows written after the training state was saved
+        for file_name, size in ((file_name_train, state['csv_sizes']['train']), (file_name_test, state['csv_sizes']['test'])):
+            if rank == 0:
+                with open(file_name, 'r+') as csv_file:
+                    csv_file.truncate(size)
+        return state
     
         
     '''
@@ -265,8 +390,27 @@ def train_model(embed_dim, epochs):
     #         pickle.dump(test, fi)
 
     logger.info("Creating Trajectory Train and Test datasets")
-    train = TrajectoryDataset(*extract_fixed_sized_segments(dataset, train_crime_trajectories, input_length=segment_length))
-    test = TrajectoryDataset(*extract_fixed_sized_segments(dataset, test_crime_trajectories, input_length=segment_length))
+    # with the frame cache the test set is evaluated on whole trajectories, its segments are not needed
+    test_trajectories = {} if frame_cache else test_crime_trajectories
+    if parallel_folds > 1:
+        # the fold workers share one memory mapped copy of the segments, written here by the parent and read by the workers
+        store = cfg['TRAINING'].get('SEGMENT_STORE') or os.path.join(base_folder, 'segments')
+        logger.info("Segment store: %s", store)
+        # a shared SEGMENT_STORE holds the segments of several configurations, store.json in every folder is checked against the trajectories
+        description = {'decomposed': layout['decomposed'], 'debug': bool(cfg['MODEL']['DEBUG'])}
+        segments_name = '_'.join([dataset, layout['decomposed'] or 'joints', str(segment_length)]) + ('_top' + str(frame_selection) if frame_selection else '') + ('_debug' if cfg['MODEL']['DEBUG'] else '')
+        # the fold workers have no trajectories and read what the parent wrote
+        train = TrajectoryDataset(*segment_store(os.path.join(store, 'train_' + segments_name), dataset, None if worker_id is not None else train_crime_trajectories,
+                                                 segment_length, frame_selection, description))
+        test = TrajectoryDataset(*segment_store(os.path.join(store, 'test_' + segments_name), dataset, None if worker_id is not None else test_trajectories,
+                                                segment_length, frame_selection, description)) if not frame_cache else None
+    elif frame_selection:
+        logger.info("Keeping the %d frames with the most motion of every segment", frame_selection)
+        train = TrajectoryDataset(*extract_selected_segments(dataset, train_crime_trajectories, segment_length, frame_selection))
+        test = TrajectoryDataset(*extract_selected_segments(dataset, test_trajectories, segment_length, frame_selection)) if test_trajectories else None
+    else:
+        train = TrajectoryDataset(*extract_fixed_sized_segments(dataset, train_crime_trajectories, input_length=segment_length))
+        test = TrajectoryDataset(*extract_fixed_sized_segments(dataset, test_trajectories, input_length=segment_length)) if test_trajectories else None # ranks > 0 of a sharded training do not test
 
 
     def collator_for_lists(batch):
@@ -276,23 +420,127 @@ def train_model(embed_dim, epochs):
         '''
         # assert all('sentences' in x for x in batch)
         # assert all('label' in x for x in batch)
-        return {
+        collated = {
             'id': [x['id'] for x in batch],
             'videos': [x['videos'] for x in batch],
             'persons': [x['persons'] for x in batch],
             'frames': torch.tensor(np.array([x['frames'] for x in batch])),
             'categories': torch.tensor(np.array([x['categories'] for x in batch])),
-            'coordinates': torch.tensor(np.array([x['coordinates'] for x in batch]))
+            'coordinates': torch.tensor(np.array([x['coordinates'] for x in batch])),
+            'index': torch.tensor([x['index'] for x in batch])
         }
+        if 'positions' in batch[0]: # segments of selected frames
+            collated['positions'] = torch.tensor(np.array([x['positions'] for x in batch]))
+        return collated
 
     logger.info('--------------------------------')
 
     logger.info('No. of trajectories to train: %s', len(train_crime_trajectories))
+
+    # the teacher has to see the segments as the student does and predict the same categories in the same order
+    teacher_layout_keys = ['dataset', 'segment_length', 'num_joints', 'in_chans', 'decomposed', 'categories']
+
+    def check_teacher_layout(teacher_layout, source):
+        '''
+        Raises if the layout of a teacher differs from that of the student
+        '''
+        different = [key for key in teacher_layout_keys if teacher_layout.get(key) != layout[key]]
+        if different:
+            raise Exception('teacher %s was trained on another layout than the student, %s' % (source, ', '.join('%s: %s instead of %s' % (key, teacher_layout.get(key), layout[key]) for key in different)))
+
+    def load_teacher(fold):
+        '''
+        Returns the frozen teacher of a fold and its layout, {fold} in TEACHER is replaced by the fold number
+        '''
+        path = teacher_path.format(fold=fold)
+        state_dict, manifest = load_checkpoint(path, device)
+        if manifest is None:
+            raise Exception('teacher %s is a whole model without a manifest, its layout cannot be checked, use a checkpoint saved by this training' % path)
+        teacher_layout = {key: manifest['layout'].get(key) for key in teacher_layout_keys}
+        check_teacher_layout(teacher_layout, path)
+        teacher = build_model(manifest, state_dict).to(device).eval()
+        teacher.requires_grad_(False)
+        logger.info("Teacher %s of fold %d: %d parameters", type(teacher).__name__, fold, sum(p.numel() for p in teacher.parameters()))
+        return teacher, teacher_layout
+
+    def write_teacher_cache(path):
+        '''
+        Saves the teacher log-likelihoods of all train segments for every fold, with the trajectory id and first frame of the segments to find them again
+        '''
+        dataloader = torch.utils.data.DataLoader(train, batch_size=batch_size, collate_fn=collator_for_lists)
+        log_likelihoods, teachers = {}, {}
+        for fold in range(1, n+1):
+            fold_teacher_path = teacher_path.format(fold=fold)
+            if fold_teacher_path not in teachers: # without {fold} in TEACHER all folds share one teacher
+                (teacher, teacher_layout), outputs = load_teacher(fold), []
+                with torch.no_grad(), autocast(device, precision):
+                    for batch in dataloader:
+                        outputs.append(teacher(batch['coordinates'].to(device)).float().cpu())
+                teachers[fold_teacher_path] = torch.cat(outputs).half() # half the size, the log-likelihoods are softened by the temperature anyway
+            log_likelihoods[fold] = teachers[fold_teacher_path]
+        cache = {'teacher': teacher_path, 'layout': teacher_layout, 'log_likelihoods': log_likelihoods,
+                 'ids': [trajectory_id[0] for trajectory_id in train.ids], 'first_frames': [int(frames[0]) for frames in train.frames]}
+        torch.save(cache, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        logger.info("Teacher log-likelihoods of %d train segments saved to %s", len(train), path)
+
+    def read_teacher_cache(path):
+        '''
+        Returns the cached teacher log-likelihoods by fold and the row of every train segment in them
+        '''
+        cache = torch_load(path)
+        if 'layout' not in cache:
+            raise Exception('teacher cache %s does not record the layout of its teacher, delete it to create it again' % path)
+        check_teacher_layout(cache['layout'], 'of the cache ' + path)
+        rows = {segment: row for row, segment in enumerate(zip(cache['ids'], cache['first_frames']))}
+        try:
+            train_rows = torch.tensor([rows[(trajectory_id[0], int(frames[0]))] for trajectory_id, frames in zip(train.ids, train.frames)])
+        except KeyError as error:
+            raise Exception('teacher cache %s has no log-likelihoods for the train segment %s, it was made from other train trajectories' % (path, error))
+        logger.info("Read the teacher log-likelihoods of %s from %s", cache['teacher'], path)
+        return cache['log_likelihoods'], train_rows
+
+    teacher_cache, teacher_rows = None, None
+    if teacher_cache_path:
+        if rank == 0 and not os.path.isfile(teacher_cache_path):
+            if not teacher_path:
+                raise Exception('teacher cache %s does not exist, set TEACHER to create it' % teacher_cache_path)
+            if trajectory_shards:
+                raise Exception('the teacher cache is made from the whole train set, create it in a training without TRAJECTORY_SHARDS')
+            write_teacher_cache(teacher_cache_path)
+        if distributed:
+            dist.barrier(group=rank0_wait_group) # written by rank 0
+        teacher_cache, teacher_rows = read_teacher_cache(teacher_cache_path)
     
     logger.info("Starting K-Fold")
 
-    # K-fold Cross Validation model evaluation
-    for fold, (train_ids, val_ids) in enumerate(kf.split(train.trajectory_ids()), 1):
+    def run_fold(fold, train_ids, val_ids, state, file_name_train, file_name_test, state_path):
+        '''
+        Trains and tests one fold, appends its results to the given CSVs and saves its training state to state_path
+        '''
+        if state is not None and (fold < state['fold'] or (fold == state['fold'] and state['fold_done'])):
+            logger.info('\nfold: %d already done', fold)
+            return
+        if state is not None and state['fold_done']:
+            # the interrupted run stopped between two folds
+            set_rng_state(state['rng'])
+            state = None
+
+        # best models are written to disk in the background and kept in memory for testing
+        checkpoint_writer = AsyncCheckpointWriter()
+
+        def save_training_state(**state):
+            '''
+            Queues the training state for --resume together with the RNG states and the current sizes of the result CSVs
+            '''
+            if rank > 0:
+                return
+            state = snapshot(state)
+            state['rng'] = get_rng_state()
+            state['csv_sizes'] = {'train': os.path.getsize(file_name_train), 'test': os.path.getsize(file_name_test)}
+            state['best'] = checkpoint_writer.best
+            checkpoint_writer.write(state, state_path)
+
         logger.info('\nfold: %d, train: %d, test: %d', fold, len(train_ids), len(val_ids))
 
         logger.info("Creating Train and Validation subsets.")
@@ -302,52 +550,97 @@ def train_model(embed_dim, epochs):
 
         logger.info("Creating Train and Validation dataloaders.")
 
-        train_dataloader = torch.utils.data.DataLoader(train_subset, batch_size = batch_size, shuffle=True, collate_fn=collator_for_lists)
-        val_dataloader = torch.utils.data.DataLoader(val_subset, batch_size = batch_size, shuffle=True, collate_fn=collator_for_lists)
+        # a compiled model would be compiled again for the smaller last batch, in training it is dropped (a different one every epoch)
+        drop_last = compile_models and len(train_subset) >= batch_size
+
+        if trajectory_shards:
+            # the folds are split on the segments of the own shards, together they are a K-fold split of the whole train set.
+            # all ranks need the same number of steps per epoch, ranks with fewer segments repeat some of theirs
+            rank_batch_size = math.ceil(batch_size / world_size)
+            train_sampler = None
+            num_samples = int(all_reduce(len(train_subset), op=dist.ReduceOp.MAX)[0])
+            train_dataloader = torch.utils.data.DataLoader(train_subset, batch_size = rank_batch_size, sampler=torch.utils.data.RandomSampler(train_subset, num_samples=num_samples), drop_last=drop_last, collate_fn=collator_for_lists)
+            val_dataloader = torch.utils.data.DataLoader(val_subset, batch_size = rank_batch_size, collate_fn=collator_for_lists)
+        elif distributed:
+            # every rank gets its shard of the fold, together the ranks still train with BATCH_SIZE segments per step
+            rank_batch_size = math.ceil(batch_size / world_size)
+            train_sampler = DistributedSampler(train_subset, shuffle=True)
+            train_dataloader = torch.utils.data.DataLoader(train_subset, batch_size = rank_batch_size, sampler=train_sampler, drop_last=drop_last, collate_fn=collator_for_lists)
+            val_dataloader = torch.utils.data.DataLoader(val_subset, batch_size = rank_batch_size, sampler=DistributedSampler(val_subset, shuffle=False), collate_fn=collator_for_lists)
+        else:
+            train_sampler = None
+            train_dataloader = torch.utils.data.DataLoader(train_subset, batch_size = batch_size, shuffle=True, drop_last=drop_last, collate_fn=collator_for_lists)
+            val_dataloader = torch.utils.data.DataLoader(val_subset, batch_size = batch_size, shuffle=True, collate_fn=collator_for_lists)
 
         logger.info("Creating the model.")
         #intialize model
         if cfg['MODEL']['MODEL_TYPE'] == 'temporal':
-            model = TemporalTransformer(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TemporalTransformer, dict(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == 'temporal_2':
-            model = TemporalTransformer_2(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TemporalTransformer_2, dict(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == 'temporal_3':
-            model = TemporalTransformer_3(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, num_parts=num_parts, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TemporalTransformer_3, dict(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, num_parts=num_parts, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == 'temporal_4':
-            model = TemporalTransformer_4(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, num_parts=num_parts, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TemporalTransformer_4, dict(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, num_parts=num_parts, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == 'spatial-temporal':
-            model = SpatialTemporalTransformer(embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = SpatialTemporalTransformer, dict(embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "parts":
-            model = BodyPartTransformer(dataset=dataset, embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = BodyPartTransformer, dict(dataset=dataset, embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "tubelet_temporal":
             kernel = tuple(map(int, cfg['TUBELET']['KERNEL'].split(',')))
             stride = tuple(map(int, cfg['TUBELET']['STRIDE'].split(',')))
-            model = TubeletTemporalTransformer(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TubeletTemporalTransformer, dict(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "ttpmc1":
             kernel = tuple(map(int, cfg['TUBELET']['KERNEL'].split(',')))
             stride = tuple(map(int, cfg['TUBELET']['STRIDE'].split(',')))
-            model = TubeletTemporalPart_mean_chan_1_Transformer(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TubeletTemporalPart_mean_chan_1_Transformer, dict(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "ttpcc1":
             kernel = tuple(map(int, cfg['TUBELET']['KERNEL'].split(',')))
             stride = tuple(map(int, cfg['TUBELET']['STRIDE'].split(',')))
-            model = TubeletTemporalPart_concat_chan_1_Transformer(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TubeletTemporalPart_concat_chan_1_Transformer, dict(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "ttpmc2":
             kernel = tuple(map(int, cfg['TUBELET']['KERNEL'].split(',')))
             stride = tuple(map(int, cfg['TUBELET']['STRIDE'].split(',')))
-            model = TubeletTemporalPart_mean_chan_2_Transformer(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TubeletTemporalPart_mean_chan_2_Transformer, dict(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "ttpcc2":
             kernel = tuple(map(int, cfg['TUBELET']['KERNEL'].split(',')))
             stride = tuple(map(int, cfg['TUBELET']['STRIDE'].split(',')))
-            model = TubeletTemporalPart_concat_chan_2_Transformer(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
+            model_class, model_kwargs = TubeletTemporalPart_concat_chan_2_Transformer, dict(dataset=dataset, embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
         elif cfg['MODEL']['MODEL_TYPE'] == "ttspcc2":
             kernel = tuple(map(int, cfg['TUBELET']['KERNEL'].split(',')))
             stride = tuple(map(int, cfg['TUBELET']['STRIDE'].split(',')))
-            model = TubeletTemporalSpatialPart_concat_chan_2_Transformer(dataset=dataset, embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1, pad_mode = cfg['TUBELET']['PAD_MODE'])
+            model_class, model_kwargs = TubeletTemporalSpatialPart_concat_chan_2_Transformer, dict(dataset=dataset, embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1, pad_mode = cfg['TUBELET']['PAD_MODE'])
         
         else:
             raise Exception('model_type is missing, must be temporal, temporal_2, temporal_3, temporal_4, spatial-temporal or parts')
-        
+
+        if temporal_window:
+            if model_class not in (TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer):
+                raise Exception('TEMPORAL_WINDOW is supported by the temporal, spatial-temporal and parts models')
+            model_kwargs.update(temporal_window=temporal_window, num_global_tokens=cfg['MODEL'].get('GLOBAL_TOKENS', 1))
+        if temporal_attention != 'softmax':
+            if model_class not in (TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer):
+                raise Exception('TEMPORAL_ATTENTION is supported by the temporal, spatial-temporal and parts models')
+            if temporal_window:
+                raise Exception('TEMPORAL_WINDOW needs TEMPORAL_ATTENTION: softmax')
+            model_kwargs.update(temporal_attention=temporal_attention)
+        if temporal_merge:
+            if model_class not in (TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer):
+                raise Exception('TEMPORAL_MERGE is supported by the temporal, spatial-temporal and parts models')
+            model_kwargs.update(temporal_merge=temporal_merge)
+        if frame_selection and model_class not in (TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer):
+            raise Exception('FRAME_SELECTION is supported by the temporal, spatial-temporal and parts models')
+        if early_exit:
+            if model_class not in (TemporalTransformer, SpatialTemporalTransformer, BodyPartTransformer):
+                raise Exception('EARLY_EXIT is supported by the temporal, spatial-temporal and parts models')
+            model_kwargs.update(early_exit=True)
+
+        model = model_class(**model_kwargs)
         model.to(device)
+        set_activation_checkpointing(model, activation_checkpointing)
+        if teacher_path or teacher_cache is not None:
+            logger.info("Distilling into %s: %d parameters", model_class.__name__, sum(p.numel() for p in model.parameters()))
+        teacher = load_teacher(fold)[0] if teacher_path and teacher_cache is None else None
 
         logger.info("Models defined")
         
@@ -358,20 +651,43 @@ def train_model(embed_dim, epochs):
             if p.dim() > 1:
                 #print('parameter:',p)
                 nn.init.xavier_uniform_(p)
+
+        # averages the gradients of all ranks in backward, the parameters of rank 0 are copied to the others here
+        # checkpoints use the model itself
+        if compile_models:
+            architecture = (model_class.__name__, repr(sorted(model_kwargs.items())))
+            if architecture in compiled_models:
+                # the new initial parameters are copied into the model the graphs were compiled for, so they are not compiled again
+                compiled = compiled_models[architecture]
+                compiled['model'].load_state_dict(model.state_dict())
+                model = compiled['model']
+                if distributed:
+                    for tensor in model.state_dict().values():
+                        dist.broadcast(tensor, 0)
+            else:
+                logger.info("Compiling the model, the first epoch includes the compile time")
+                compiled = {'model': model, 'train': compile_model(DistributedDataParallel(model) if distributed else model), 'eval': compile_model(model)}
+                compiled_models[architecture] = compiled
+            ddp_model, eval_model = compiled['train'], compiled['eval']
+        else:
+            ddp_model = DistributedDataParallel(model) if distributed else model
+            eval_model = model
         
         # Define optimizer
         optim = torch.optim.Adam(model.parameters(), lr=cfg['TRAINING']['LR'], weight_decay=wd, betas=(0.9, 0.98), eps=1e-9)
         cross_entropy_loss = nn.CrossEntropyLoss()
+        # float16 gradients can underflow and are scaled, bfloat16 has the range of float32 and needs no scaling
+        scaler = torch.amp.GradScaler('cuda', enabled=precision == 'float16') if hasattr(torch.amp, 'GradScaler') else torch.cuda.amp.GradScaler(enabled=precision == 'float16')
         
         '''
         Define scheduler for adaptive learning
         learning rate patience < early stopping patience
         '''
         lr_patience = cfg['TRAINING']['LR_PATIENCE']
-        scheduler = ReduceLROnPlateau(optim, patience = lr_patience, verbose=True) 
+        scheduler = ReduceLROnPlateau(optim, patience = lr_patience) # the LR is logged every epoch, verbose is gone in torch >= 2.7
             
         # Early stopping parameters
-        min_loss = inf
+        min_loss = math.inf
         patience =  cfg['TRAINING']['PATIENCE']
         logger.info('Early stopping patience: %d', patience)
         trigger_times = 0
@@ -381,9 +697,27 @@ def train_model(embed_dim, epochs):
         
         #print('start looping over epochs at', time.time())
         best_epoch = -1
-        for epoch in range(1, epochs+1):
+
+        first_epoch = 1
+        if state is not None:
+            # continue the interrupted fold after its last saved epoch
+            model.load_state_dict(state['model'])
+            optim.load_state_dict(state['optim'])
+            scheduler.load_state_dict(state['scheduler'])
+            if 'scaler' in state:
+                scaler.load_state_dict(state['scaler'])
+            min_loss, trigger_times, best_epoch = state['min_loss'], state['trigger_times'], state['best_epoch']
+            checkpoint_writer.best = state['best']
+            set_rng_state(state['rng'])
+            first_epoch = state['epoch'] + 1
+            state = None
+            logger.info('Resuming fold %d at epoch %d', fold, first_epoch)
+
+        for epoch in range(first_epoch, epochs+1):
 
             train_loss = 0.0
+            if train_sampler is not None:
+                train_sampler.set_epoch(epoch) # a new shuffle every epoch, the same on all ranks
 
             model.train()
 
@@ -400,17 +734,30 @@ def train_model(embed_dim, epochs):
                 # persons = persons
                 frames = frames.to(device)
                 data = data.to(device)
+                inputs = (data, batch['positions'].to(device)) if 'positions' in batch else (data,)
 
                 # if cfg['TUBELET']['ENABLE']:
                 #     data = rearrange(data, 'b f (h w c) -> b c f h w', h=5, w=5, c=2)
                 
                 optim.zero_grad(set_to_none=True)
                 
-                output = model(data)
+                with autocast(device, precision):
+                    output = ddp_model(*inputs)
                 
                 loss = cross_entropy_loss(output, labels)
-                loss.backward()
-                optim.step()
+                if early_exit: # the exit heads learn the labels as much as the final head
+                    loss = (loss + sum(cross_entropy_loss(exit_output, labels) for exit_output in model.exit_outputs)) / (len(model.exit_outputs) + 1)
+                if teacher is not None or teacher_cache is not None:
+                    if teacher is not None:
+                        with torch.no_grad(), autocast(device, precision):
+                            teacher_log_likelihoods = teacher(data)
+                    else:
+                        teacher_log_likelihoods = teacher_cache[fold][teacher_rows[batch['index']]].to(device)
+                    loss = alpha * distillation_loss(output, teacher_log_likelihoods, temperature) + (1 - alpha) * loss
+
+                scaler.scale(loss).backward()
+                scaler.step(optim)
+                scaler.update()
                 
                 train_loss += loss.item() * labels.size(0) # Multiplied by size since CEloss returns loss.item as loss per sample
                 
@@ -423,16 +770,22 @@ def train_model(embed_dim, epochs):
             At the end of every epoch, do validation testing
             '''
             
-            the_current_loss, all_log_likelihoods, all_labels, all_videos, all_persons = evaluation(model, val_dataloader)
+            the_current_loss, all_log_likelihoods, all_labels, all_videos, all_persons = evaluation(eval_model, val_dataloader)
 
             _, all_predictions = torch.max(all_log_likelihoods, dim=1)          
             total = all_labels.size(0)
             correct = (all_predictions == all_labels).sum().item()
             curr_lr = optim.param_groups[0]['lr']
 
-            writer.add_scalars("Fold_"+str(fold)+"/Loss", {"Training": train_loss/len(train_dataloader),"Validation": the_current_loss}, epoch)
-            # writer.add_scalar("Fold_"+str(fold)+"/Validation loss", the_current_loss, epoch)
-            writer.add_scalars("Fold_"+str(fold)+"/Accuracy", {"Training": train_acc(train_outputs, train_labels), "Validation": correct / total}, epoch)
+            if distributed:
+                # losses and accuracies over the shards of all ranks, so all ranks take the same early stopping decisions
+                train_loss, val_loss, correct, total = all_reduce(train_loss, the_current_loss * len(val_dataloader), correct, total)
+                the_current_loss = val_loss / math.ceil(total / batch_size) # per batch of BATCH_SIZE, as in a single process
+
+            if rank == 0:
+                writer.add_scalars("Fold_"+str(fold)+"/Loss", {"Training": train_loss/len(train_dataloader),"Validation": the_current_loss}, epoch)
+                # writer.add_scalar("Fold_"+str(fold)+"/Validation loss", the_current_loss, epoch)
+                writer.add_scalars("Fold_"+str(fold)+"/Accuracy", {"Training": train_acc(train_outputs, train_labels), "Validation": correct / total}, epoch)
             # writer.add_scalar("Fold_"+str(fold)+"/Training Accuracy", train_acc(train_outputs, train_labels), epoch)
 
             #print epoch performance
@@ -445,9 +798,10 @@ def train_model(embed_dim, epochs):
                     Time: {((time.time() - temp)/60):.5f} min')
             
             #Write epoch performance to file
-            with open(file_name_train, 'a') as csv_file_train:
-                csv_writer_train = csv.writer(csv_file_train, delimiter=';')
-                csv_writer_train.writerow([fold, epoch, curr_lr, train_loss/len(train_dataloader), the_current_loss, (correct / total), (time.time() - temp)/60])
+            if rank == 0:
+                with open(file_name_train, 'a') as csv_file_train:
+                    csv_writer_train = csv.writer(csv_file_train, delimiter=';')
+                    csv_writer_train.writerow([fold, epoch, curr_lr, train_loss/len(train_dataloader), the_current_loss, (correct / total), (time.time() - temp)/60])
             
             # Early stopping
             if the_current_loss < min_loss:
@@ -461,7 +815,8 @@ def train_model(embed_dim, epochs):
                 PATH = os.path.join(model_dir,  model_name + "_fold_" + str(fold) + ".pt")
                     
                 #Save trained model
-                torch.save(model, PATH)
+                if rank == 0:
+                    checkpoint_writer.save(model, PATH, model_kwargs, layout)
                 
                 logger.info("Least validation loss so far! Trained model saved to {}".format(PATH))
             else:
@@ -473,15 +828,29 @@ def train_model(embed_dim, epochs):
                 If patience exceeded, or final epoch reached, stop training
                 '''
                 logger.info('\nStopping after epoch %d', epoch)
+
+                if rank > 0:
+                    dist.barrier(group=rank0_wait_group) # rank 0 tests the best model
+                    break
                 
                 temp = time.time()
 
-                PATH = os.path.join(model_dir,  model_name + "_fold_" + str(fold) + ".pt")
-                best_model = torch.load(PATH)
+                if compile_models:
+                    # the training of the fold is over, the compiled model gets the best parameters
+                    model.load_state_dict(checkpoint_writer.best_checkpoint()['state_dict'])
+                    best_model = eval_model
+                else:
+                    best_model = checkpoint_writer.best_model(device)
+                set_chunked_execution(model if compile_models else best_model, spatial_chunk, attention_chunk)
 
                 # Evaluate model on test set after training
-                test_dataloader = torch.utils.data.DataLoader(test, batch_size=batch_size, shuffle=True, collate_fn=collator_for_lists)
-                _, all_log_likelihoods, all_labels, all_videos, all_persons = evaluation(best_model, test_dataloader)
+                if frame_cache:
+                    _, all_log_likelihoods, all_labels, all_videos, all_persons = evaluation_frame_cache(best_model, test_crime_trajectories, batch_size)
+                else:
+                    test_dataloader = torch.utils.data.DataLoader(test, batch_size=batch_size, shuffle=True, collate_fn=collator_for_lists)
+                    _, all_log_likelihoods, all_labels, all_videos, all_persons = evaluation(best_model, test_dataloader)
+                # the compiled model is reused by the next folds, which train and validate without chunks
+                set_chunked_execution(model if compile_models else best_model, None, None)
 
                 # the class with the highest log-likelihood is what we choose as prediction
                 _, all_predictions = torch.max(all_log_likelihoods, dim=1)
@@ -513,18 +882,106 @@ def train_model(embed_dim, epochs):
                     accuracy = 100 * float(correct_count) / (total_pred[classname] + 0.0000001)
                     logger.info("Accuracy for class {:5s} is: {:.2f} %".format(classname,
                                                                     accuracy))
-            
+
+                save_training_state(fold=fold, epoch=epoch, fold_done=True)
+                if distributed:
+                    dist.barrier(group=rank0_wait_group)
                 break
 
             scheduler.step(the_current_loss)
+
+            if epoch % checkpoint_every == 0:
+                save_training_state(fold=fold, epoch=epoch, fold_done=False, model=model.state_dict(), optim=optim.state_dict(), scheduler=scheduler.state_dict(), scaler=scaler.state_dict(),
+                                    min_loss=min_loss, trigger_times=trigger_times, best_epoch=best_epoch)
             
             temp = time.time()
-    
-    
-    
+
+        checkpoint_writer.close() # a new writer (and thread) for every fold
+
+    def fold_file_names(fold):
+        return os.path.join(results_dir, 'training_fold_' + str(fold) + '.csv'), os.path.join(results_dir, 'testing_fold_' + str(fold) + '.csv')
+
+    def run_worker_folds(folds):
+        '''
+        Runs the folds of this fold worker, every fold writes its own result CSVs and training state
+        '''
+        logger.info('Worker %d: folds %s on CPU cores %s', worker_id, ','.join(str(fold) for fold, _ in folds), ','.join(str(cpu) for cpu in worker_cpus))
+        for fold, (train_ids, val_ids) in folds:
+            fold_file_train, fold_file_test = fold_file_names(fold)
+            fold_state_path = os.path.join(model_dir, model_name + "_fold_" + str(fold) + "_training_state.pt")
+            run_fold(fold, train_ids, val_ids, load_training_state(fold_state_path, fold_file_train, fold_file_test), fold_file_train, fold_file_test, fold_state_path)
+
+    # K-fold Cross Validation model evaluation
+    splits = list(enumerate(kf.split(train.trajectory_ids()), 1))
+
+    if worker_id is not None:
+        run_worker_folds(splits[worker_id::int(os.environ['FOLD_WORKERS'])])
+    elif parallel_folds > 1:
+        if device.type == 'cuda':
+            raise Exception('PARALLEL_FOLDS is meant for CPU nodes, the fold workers share the cores of one node')
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        num_workers = min(parallel_folds, len(splits))
+        # split the cores between the workers, with more workers than cores they take turns
+        cores = [chunk.tolist() for chunk in np.array_split(cpus, num_workers)] if len(cpus) >= num_workers else [[cpus[worker % len(cpus)]] for worker in range(num_workers)]
+        logger.info("Training %d folds in %d worker processes", len(splits), num_workers)
+
+        # every worker is a fresh process of this script (not a fork), so it inherits no threads or thread pools of this process.
+        # it reads the segments from the segment store written above and trains every num_workers-th fold
+        workers = []
+        for worker in range(num_workers):
+            env = dict(os.environ, FOLD_WORKER=str(worker), FOLD_WORKERS=str(num_workers), FOLD_WORKER_CPUS=','.join(str(cpu) for cpu in cores[worker]), OMP_NUM_THREADS=str(len(cores[worker])))
+            workers.append(subprocess.Popen([sys.executable, '-u'] + sys.argv, env=env))
+
+        # wait for all workers, if one fails the others are stopped (restart with --resume to continue)
+        while None in [process.poll() for process in workers]:
+            if any(process.returncode not in (None, 0) for process in workers):
+                for process in workers:
+                    if process.poll() is None:
+                        process.terminate()
+                for process in workers:
+                    process.wait()
+                break
+            time.sleep(1)
+        for worker, process in enumerate(workers):
+            if process.returncode != 0:
+                raise Exception('fold worker %d failed with exit code %d' % (worker, process.returncode))
+
+        # merge the results of the folds in fold order
+        write_csv_headers(file_name_train, file_name_test)
+        for fold, _ in splits:
+            for file_name, fold_file_name in zip((file_name_train, file_name_test), fold_file_names(fold)):
+                with open(fold_file_name) as fold_file, open(file_name, 'a') as merged_file:
+                    fold_file.readline() # header
+                    shutil.copyfileobj(fold_file, merged_file)
+    else:
+        state_path = os.path.join(model_dir, model_name + "_training_state.pt")
+        state = load_training_state(state_path, file_name_train, file_name_test)
+        for fold, (train_ids, val_ids) in splits:
+            run_fold(fold, train_ids, val_ids, state, file_name_train, file_name_test, state_path)
+            if state is not None and (fold > state['fold'] or (fold == state['fold'] and not state['fold_done'])):
+                state = None # the state was used by its fold
+
+    logger.info("Models saved to {}".format(model_dir))
     logger.info("Training results saved to {}".format(file_name_train))
     logger.info("Testing results saved to {}".format(file_name_test))
 
+def all_reduce(*values, op=dist.ReduceOp.SUM):
+    '''
+    Reduces numbers over all ranks of the distributed training, sums them by default
+    '''
+    values = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(values, op=op)
+    return values.tolist()
+
+def distillation_loss(log_likelihoods, teacher_log_likelihoods, temperature):
+    '''
+    KL divergence of the temperature softened class distribution of the model from the one of the teacher (Hinton et al. 2015),
+    times temperature^2 so its gradients keep their size when the temperature changes
+    '''
+    return F.kl_div(F.log_softmax(log_likelihoods.float() / temperature, dim=1), F.log_softmax(teacher_log_likelihoods.float() / temperature, dim=1),
+                    reduction='batchmean', log_target=True) * temperature ** 2
+
 '''
 EVALUATION FUNCTION
 '''
@@ -541,7 +998,7 @@ def evaluation(model, data_loader):
     all_persons = []
 
     # Test validation data
-    with torch.no_grad():
+    with torch.no_grad(), autocast(device, precision):
         cross_entropy_loss = nn.CrossEntropyLoss()
         for batch in data_loader:
             ids, videos, persons, frames, data, categories = batch['id'], batch['videos'], batch['persons'], batch['frames'], batch['coordinates'], batch['categories']
@@ -550,10 +1007,11 @@ def evaluation(model, data_loader):
             persons = [y[0] for y in persons]
             frames = frames.to(device)
             data = data.to(device)
+            inputs = (data, batch['positions'].to(device)) if 'positions' in batch else (data,)
             # if cfg['TUBELET']['ENABLE']:
             #     data = rearrange(data, 'b f (h w c) -> b c f h w', h=5, w=5, c=2)
                 
-            outputs = model(data)
+            outputs = model(*[pad_batch(x, data_loader.batch_size) for x in inputs])[:labels.size(0)] if compile_models else model(*inputs)
 
             loss = cross_entropy_loss(outputs, labels)  
             loss_total += loss.item() * labels.size(0)
@@ -564,11 +1022,49 @@ def evaluation(model, data_loader):
             all_persons.extend(persons)
 
     return loss_total / len(data_loader), all_log_likelihoods, all_labels, all_videos, all_persons
-    
+
+def evaluation_frame_cache(model, trajectories, batch_size):
+    '''
+    Function to evaluate all sliding windows of whole trajectories (Test), the spatial features of every frame are computed once
+    '''
+    model.eval()
+    loss_total = 0
+
+    all_log_likelihoods = torch.tensor([]).to(device)
+    all_labels = torch.LongTensor([]).to(device)
+    all_videos = []
+    all_persons = []
+
+    with torch.no_grad(), autocast(device, precision):
+        cross_entropy_loss = nn.CrossEntropyLoss(reduction='sum')
+        for trajectory in trajectories.values():
+            data = torch.tensor(trajectory.coordinates).to(device)
+
+            outputs = model.forward_trajectory(data, batch_size)
+            labels = torch.full((outputs.shape[0],), int(trajectory.category), dtype=torch.long).to(device)
+            video, person = get_video_and_person(dataset, trajectory)
+
+            loss_total += cross_entropy_loss(outputs, labels).item()
+
+            all_log_likelihoods = torch.cat((all_log_likelihoods, outputs), 0)
+            all_labels = torch.cat((all_labels, labels), 0)
+            all_videos.extend([str(video)] * outputs.shape[0])
+            all_persons.extend([str(person)] * outputs.shape[0])
+
+    return loss_total / all_labels.size(0), all_log_likelihoods, all_labels, all_videos, all_persons
+
 
 #train model
 train_model(embed_dim=cfg['MODEL']['EMBED_DIM'], epochs=cfg['TRAINING']['EPOCHS'])
 
+if distributed:
+    dist.destroy_process_group()
+    if rank > 0:
+        sys.exit() # rank 0 evaluates the results
+if worker_id is not None:
+    writer.close()
+    sys.exit() # the parent merges the results of the fold workers and evaluates them
+
 
 
 '''
@@ -1,6 +1,10 @@
 from torch.utils.data import Dataset
 import numpy as np
 import re
+import pickle
+import hashlib
+import json
+import os
 
 categories = ['Abuse','Arrest','Arson', 'Assault', 'Burglary','Explosion','Fighting','RoadAccidents','Robbery','Shooting','Shoplifting','Stealing','Vandalism']
 
@@ -44,13 +48,14 @@ class TrajectoryDataset(Dataset):
     A dataset to store the trajectories. This should be more efficient than using just arrays.
     Also should be efficient with dataloaders.
     """
-    def __init__(self, trajectory_ids, trajectory_videos, trajectory_persons, trajectory_frames, trajectory_categories, X):
+    def __init__(self, trajectory_ids, trajectory_videos, trajectory_persons, trajectory_frames, trajectory_categories, X, positions=None):
         self.ids = trajectory_ids.tolist()
         self.videos = trajectory_videos.tolist()
         self.persons = trajectory_persons.tolist()
         self.frames = trajectory_frames
         self.categories = trajectory_categories
         self.coordinates = X
+        self.positions = positions # positions of the frames in their segment, for segments of selected frames (extract_selected_segments)
 
     def __len__(self):
         return len(self.ids)
@@ -63,6 +68,9 @@ class TrajectoryDataset(Dataset):
         data['frames'] = self.frames[idx]
         data['categories'] = self.categories[idx]
         data['coordinates'] = self.coordinates[idx]
+        data['index'] = idx # position of the segment in the dataset, e.g. for its row in a teacher cache
+        if self.positions is not None:
+            data['positions'] = self.positions[idx]
 
         return data
         # return self.ids[idx], self.videos[idx], self.persons[idx], self.frames[idx],self.coordinates[idx], self.categories[idx]
@@ -143,6 +151,138 @@ def extract_fixed_sized_segments(dataset, trajectories, input_length):
 
     return trajectories_ids, videos, persons, frames, categories, X
 
+def motion_energy(coordinates, dimension):
+    '''
+    Motion energy of every frame of a trajectory, coordinates: t (joints x dimension).
+    The displacement of every joint to the previous and to the next frame, averaged and summed over the joints
+    '''
+    joints = coordinates.reshape(len(coordinates), -1, dimension)
+    displacement = np.linalg.norm(np.diff(joints, axis=0), axis=2).sum(axis=1)
+    energy = np.zeros(len(coordinates), dtype=np.float32)
+    energy[1:] += displacement
+    energy[:-1] += displacement
+    energy[1:-1] /= 2 # the first and last frame have one neighbour only
+    return energy
+
+def extract_selected_segments(dataset, trajectories, input_length, num_selected):
+    '''
+    Same as extract_fixed_sized_segments, but only the num_selected frames with the highest motion energy of every segment are kept,
+    in temporal order, so the models spend no compute on idle stretches. Also returns the positions of the kept frames in their
+    segment (n num_selected) for the positional embedding
+    '''
+    if num_selected > input_length:
+        raise Exception('cannot select %d frames of segments of %d frames' % (num_selected, input_length))
+
+    segments, positions = [], []
+    for trajectory in trajectories.values():
+        energy = motion_energy(trajectory.coordinates, trajectory.dimension)
+        windows = energy[np.arange(len(energy) - input_length + 1)[:, None] + np.arange(input_length)] # the energy of every sliding window
+        traj_positions = np.sort(np.argsort(-windows, axis=1, kind='stable')[:, :num_selected], axis=1)
+
+        traj_segments = _extract_fixed_sized_segments(dataset, trajectory, input_length)
+        segments.append([np.take_along_axis(array, traj_positions[..., None] if array.ndim == 3 else traj_positions, axis=1) for array in traj_segments])
+        positions.append(traj_positions)
+
+    return tuple(np.vstack(arrays) for arrays in zip(*segments)) + (np.vstack(positions),)
+
+def segment_store(path, dataset, trajectories, input_length, num_selected=None, description=None):
+    '''
+    Same as extract_fixed_sized_segments (extract_selected_segments with num_selected), but the segments are written once to .npy files
+    in path and returned memory mapped, so processes working on the same segments share them instead of holding a copy each.
+    store.json in path records what the segments were made from: description (e.g. the dataset, decomposition and debug subset), the
+    segment shape and the ids and frames of the trajectories. Existing files in path are reused only if it matches, otherwise the segments
+    are made again. With trajectories None the segments written by another process are only read, it raises if they do not match description
+    '''
+    names = ['ids', 'videos', 'persons', 'frames', 'categories', 'X'] + (['positions'] if num_selected else [])
+    files = [os.path.join(path, name + '.npy') for name in names]
+    metadata_file = os.path.join(path, 'store.json')
+
+    metadata = dict(description or {}, dataset=dataset, input_length=input_length, num_selected=num_selected)
+    if trajectories is not None:
+        metadata['trajectories'] = hashlib.sha1(','.join(sorted(trajectories)).encode()).hexdigest()
+        metadata['num_frames'] = int(sum(len(trajectory) for trajectory in trajectories.values()))
+    metadata = json.loads(json.dumps(metadata)) # as read back from the file
+    stored = None
+    if os.path.isfile(metadata_file) and all(os.path.isfile(file) for file in files):
+        with open(metadata_file) as f:
+            stored = json.load(f)
+
+    if trajectories is None:
+        if stored is None or any(stored.get(key) != value for key, value in metadata.items()):
+            raise Exception('segment store %s is missing or was made from other trajectories than %s' % (path, metadata))
+    elif stored != metadata:
+        os.makedirs(path, exist_ok=True)
+        if os.path.isfile(metadata_file):
+            os.remove(metadata_file) # the segments are incomplete until it is written again
+        segments = extract_selected_segments(dataset, trajectories, input_length, num_selected) if num_selected else extract_fixed_sized_segments(dataset, trajectories, input_length)
+        for file, array in zip(files, segments):
+            with open(file + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(file + '.tmp', file)
+        with open(metadata_file + '.tmp', 'w') as f:
+            json.dump(metadata, f)
+        os.replace(metadata_file + '.tmp', metadata_file)
+
+    return tuple(np.load(file, mmap_mode='r') for file in files)
+
+def write_trajectory_shards(path, trajectories, num_shards):
+    '''
+    Splits a dict of trajectories into num_shards pickled dicts (shard_00000.dat, ...) with about the same number of frames each,
+    and writes an index.pkl with the trajectory ids of every shard. Ranks of a distributed training read only their shards, see read_trajectory_shards
+    '''
+    shards = [{} for _ in range(num_shards)]
+    frames = [0] * num_shards
+    # longest trajectories first, each to the shard with the fewest frames so far
+    for trajectory_id, trajectory in sorted(trajectories.items(), key=lambda item: len(item[1]), reverse=True):
+        shard = frames.index(min(frames))
+        shards[shard][trajectory_id] = trajectory
+        frames[shard] += len(trajectory)
+
+    os.makedirs(path, exist_ok=True)
+    for shard, shard_trajectories in enumerate(shards):
+        with open(os.path.join(path, 'shard_%05d.dat' % shard), 'wb') as f:
+            pickle.dump(shard_trajectories, f)
+    with open(os.path.join(path, 'index.pkl'), 'wb') as f:
+        pickle.dump({'shards': [list(shard_trajectories) for shard_trajectories in shards], 'frames': frames}, f)
+
+    return frames
+
+def read_trajectory_shards(path, rank, world_size):
+    '''
+    Returns the trajectories of the shards of one rank (shards rank, rank + world_size, ...) written by write_trajectory_shards
+    '''
+    with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+        num_shards = len(pickle.load(f)['shards'])
+    if num_shards < world_size:
+        raise Exception('%d trajectory shards in %s cannot be split between %d ranks, write at least one shard per rank' % (num_shards, path, world_size))
+
+    trajectories = {}
+    for shard in range(rank, num_shards, world_size):
+        with open(os.path.join(path, 'shard_%05d.dat' % shard), 'rb') as f:
+            trajectories.update(pickle.load(f))
+    return trajectories
+
+
+def get_video_and_person(dataset, trajectory):
+    '''
+    Given a trajectory, return the id of its video and of the person in it
+    '''
+    trajectory_id = trajectory.trajectory_id
+
+    if dataset == "HRC":
+        numbers_found = re.search(r"(\d+)_(\d+)", trajectory_id)
+        video_id = numbers_found.group(1)
+        person_id = numbers_found.group(2)
+    elif dataset == "UTK":
+        numbers_found = re.search(r"_(\w+)_(\w+)", trajectory_id)
+        video_id = numbers_found.group(1)[1:]
+        person_id = numbers_found.group(2)[1:]
+    elif "NTU" in dataset:
+        video_id = trajectory_id.split('_')[0]
+        person_id = trajectory.person_id
+
+    return video_id, person_id
+
 
 def _extract_fixed_sized_segments(dataset, trajectory, input_length):
     '''
@@ -174,18 +314,8 @@ def _extract_fixed_sized_segments(dataset, trajectory, input_length):
     np.stack() will arrange lists like this.
     '''
     traj_frames, traj_X = np.stack(traj_frames, axis=0), np.stack(traj_X, axis=0)
-    
-    if dataset == "HRC":
-        numbers_found = re.search(r"(\d+)_(\d+)", trajectory_id)
-        video_id = numbers_found.group(1)
-        person_id = numbers_found.group(2)
-    elif dataset == "UTK":
-        numbers_found = re.search(r"_(\w+)_(\w+)", trajectory_id)
-        video_id = numbers_found.group(1)[1:]
-        person_id = numbers_found.group(2)[1:]
-    elif "NTU" in dataset:
-        video_id = trajectory_id.split('_')[0] 
-        person_id = trajectory.person_id
+
+    video_id, person_id = get_video_and_person(dataset, trajectory)
 
     # Create the following np arrays in the shape of traj_frames
     traj_ids = np.full(traj_frames.shape, fill_value=trajectory_id)
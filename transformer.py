@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 from einops import rearrange, repeat
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def get_average_body_parts(num_joints, x):
@@ -213,7 +214,80 @@ def get_keypoint(skeleton, position, dim):
         #     part = torch.cat((part, x), dim=2)
     return part
 
+def build_part_index(part_volumes, num_inputs):
+    '''
+    Traces a body part layout on the input positions and returns the gather index of the packed part volume.
+    Index 0 is the zero padding, every part is placed in the top left corner of the largest part.
+    Returns the index of shape (p, c, h, w) and the (h, w) size of every part.
+    '''
+    positions = torch.arange(1, num_inputs+1, dtype=torch.float).view(1, 1, num_inputs)
+    volumes = [volume[0, :, 0] for volume in part_volumes(positions)]   ## Shape: c h w per part
+
+    c = volumes[0].shape[0]
+    h = max(volume.shape[1] for volume in volumes)
+    w = max(volume.shape[2] for volume in volumes)
+
+    index = torch.zeros(len(volumes), c, h, w, dtype=torch.long)
+    for i, volume in enumerate(volumes):
+        index[i, :, :volume.shape[1], :volume.shape[2]] = volume.round().long()
+
+    return index, [tuple(volume.shape[1:]) for volume in volumes]
+
+def part_output_mask(part_sizes, kernel, stride):
+    '''
+    Marks the tubelets of the packed volume that belong to each body part, shape: p 1 1 h w
+    '''
+    h = max(size[0] for size in part_sizes)
+    w = max(size[1] for size in part_sizes)
+    mask = torch.zeros(len(part_sizes), 1, 1, (h-kernel[1])//stride[1] + 1, (w-kernel[2])//stride[2] + 1)
+    for i, (part_h, part_w) in enumerate(part_sizes):
+        if part_h < kernel[1] or part_w < kernel[2]:
+            raise Exception('tubelet kernel %s is larger than body part %d of size %s' % (str(kernel), i, str((part_h, part_w))))
+        mask[i, :, :, :(part_h-kernel[1])//stride[1] + 1, :(part_w-kernel[2])//stride[2] + 1] = 1
+    return mask
+
+def init_part_tubelets(model, num_inputs):
+    '''
+    Registers the packed part index and tubelet mask of a tubelet part model as (non persistent) buffers
+    '''
+    index, part_sizes = build_part_index(model.part_volumes, num_inputs)
+    mask = part_output_mask(part_sizes, model.torso_conv.kernel_size, model.torso_conv.stride)
+    model.register_buffer('part_index', index, persistent=False)
+    model.register_buffer('part_mask', mask, persistent=False)
+
+def convert_part_tubelet_model(model, num_joints, in_chans=2):
+    '''
+    Converts a tubelet part model pickled with torch.save(model) before the grouped embedding,
+    the weights are unchanged so state dicts load without conversion.
+    '''
+    init_part_tubelets(model, num_joints*in_chans)
+    return model.to(model.torso_conv.weight.device)
+
+def pack_part_volumes(x, part_index):
+    '''
+    Gathers the padded volumes of all body parts at once, shape: b (p c) f h w
+    '''
+    p, c, h, w = part_index.shape
+    x = F.pad(x, (1, 0))                                                ## index 0 is the zero padding
+    x = x[:, :, part_index.flatten()]                                   ## Shape: b f (p c h w)
+    return rearrange(x, 'b f (p c h w) -> b (p c) f h w', p=p, c=c, h=h, w=w)
+
+def grouped_part_conv(x, convs):
+    '''
+    Runs the Conv3d of every body part as a single grouped convolution over the packed part volumes
+    '''
+    weight = torch.cat([conv.weight for conv in convs], dim=0)
+    bias = torch.cat([conv.bias for conv in convs], dim=0)
+    return F.conv3d(x, weight, bias, stride=convs[0].stride, groups=len(convs))
+
 #Transformer model
+class LayerNorm(nn.LayerNorm):
+    '''
+    nn.LayerNorm that normalizes in float32, also under bfloat16 autocast where it would otherwise follow its bfloat16 input
+    '''
+    def forward(self, x):
+        return super().forward(x.float())
+
 class Mlp(nn.Module):
     """ MLP as used in Vision Transformer, MLP-Mixer and related networks
     """
@@ -235,9 +309,16 @@ class Mlp(nn.Module):
         return x
     
 class Attention(nn.Module):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0.):
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., window=None, num_global=1):
+        """
+        window (int): if set, the tokens after the first num_global ones only attend to the global tokens and to the tokens
+            at most window positions away, see windowed_attention. The global tokens (e.g. the class token) attend to all tokens
+        """
         super().__init__()
         self.num_heads = num_heads
+        self.window = window
+        self.num_global = num_global
+        self.chunk_size = None # attend over at most this many sequences at a time, see set_chunked_execution
         head_dim = dim // num_heads
         
         # NOTE scale factor can be manually set to be compat with prev weights
@@ -250,43 +331,279 @@ class Attention(nn.Module):
 
     def forward(self, x):
         B, N, C = x.shape
-        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        qkv = self.qkv(x)
+        # from the qkv size, also with heads removed by prune.py and for the wrapped qkv of quantize.py, not -1 so empty batches reshape
+        head_dim = qkv.shape[-1] // (3 * self.num_heads)
+        qkv = qkv.reshape(B, N, 3, self.num_heads, head_dim).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
+        if self.chunk_size and B > self.chunk_size:
+            # the attention matrices of a chunk of the sequences at a time, the sequences do not interact
+            x = torch.cat([self.attention(q[i:i + self.chunk_size], k[i:i + self.chunk_size], v[i:i + self.chunk_size]) for i in range(0, B, self.chunk_size)])
+        else:
+            x = self.attention(q, k, v)
+
+        x = x.transpose(1, 2).reshape(B, N, self.num_heads * head_dim)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+    def attention(self, q, k, v):
+        '''
+        q, k, v: B heads N head_dim
+        '''
+        N = q.shape[2]
+        if self.window and N - self.num_global > self.window + 1:
+            return self.windowed_attention(q, k, v)
+        # also when the window covers all tokens, it is the same then
         attn = (q @ k.transpose(-2, -1)) * self.scale
-        attn = attn.softmax(dim=-1)
+        attn = attn.float().softmax(dim=-1) # float32 also under bfloat16 autocast
         attn = self.attn_drop(attn)
+        return attn @ v
+
+    def windowed_attention(self, q, k, v):
+        '''
+        Local attention with global tokens (as in Longformer), q, k, v: B heads N head_dim.
+        The global tokens attend to all tokens. The other tokens are split into blocks of window tokens, every block attends to the
+        global tokens and to the previous, its own and the next block, masked to the tokens at most window positions away.
+        Memory and compute grow linearly with the number of tokens instead of quadratically
+        '''
+        B, H, N, D = q.shape
+        g, w = self.num_global, self.window
+        n = N - g
+        blocks = -(-n // w)
+
+        attn = (q[:, :, :g] @ k.transpose(-2, -1)) * self.scale
+        attn = self.attn_drop(attn.float().softmax(dim=-1))
+        x_global = attn @ v
+
+        def split(t): # B H n D -> B H blocks w D, padded at the end
+            return F.pad(t[:, :, g:], (0, 0, 0, blocks * w - n)).reshape(B, H, blocks, w, D)
+        def context(t): # B H blocks 3w D, the previous, own and next block of every block
+            t = F.pad(split(t), (0, 0, 0, 0, 1, 1))
+            return torch.cat((t[:, :, :-2], t[:, :, 1:-1], t[:, :, 2:]), dim=3)
+
+        position = torch.arange(blocks * w, device=q.device).reshape(blocks, w, 1)
+        key_position = ((torch.arange(blocks, device=q.device) - 1) * w).reshape(blocks, 1, 1) + torch.arange(3 * w, device=q.device) # from the start of the previous block
+        masked = ((key_position - position).abs() > w) | (key_position < 0) | (key_position >= n) # blocks w 3w
+
+        q_blocks = split(q)
+        attn_global = q_blocks @ k[:, :, None, :g].transpose(-2, -1) # B H blocks w g
+        attn_window = (q_blocks @ context(k).transpose(-2, -1)).masked_fill(masked, float('-inf')) # B H blocks w 3w
+        attn = torch.cat((attn_global, attn_window), dim=-1) * self.scale
+        attn = self.attn_drop(attn.float().softmax(dim=-1))
+        x_local = attn[..., :g] @ v[:, :, None, :g] + attn[..., g:] @ context(v)
+
+        return torch.cat((x_global, x_local.reshape(B, H, blocks * w, D)[:, :, :n]), dim=2)
+
+class LinearAttention(Attention):
+    '''
+    Kernelized attention (Katharopoulos et al. 2020), softmax(q k^T) v is replaced by phi(q) (phi(k)^T v) / (phi(q) sum_n phi(k_n))
+    with the feature map phi(x) = elu(x) + 1. Computing phi(k)^T v first costs O(N head_dim^2) instead of O(N^2 head_dim), so memory
+    and compute grow linearly with the number of tokens. Same parameters as Attention, there is no attention matrix to apply attn_drop to
+    '''
+    def __init__(self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0., proj_drop=0., window=None, num_global=1, eps=1e-6):
+        if window:
+            raise Exception('LinearAttention attends to all tokens, it has no window')
+        super().__init__(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=proj_drop)
+        self.eps = eps
+
+    def forward(self, x):
+        B, N, C = x.shape
+        qkv = self.qkv(x)
+        head_dim = qkv.shape[-1] // (3 * self.num_heads)
+        qkv = qkv.reshape(B, N, 3, self.num_heads, head_dim).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        q, k = F.elu(q) + 1, F.elu(k) + 1
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        kv = k.transpose(-2, -1) @ v # B H D D
+        normalizer = q @ k.sum(dim=2).unsqueeze(-1) # B H N 1
+        x = (q @ kv) / (normalizer.float() + self.eps) # float32 also under bfloat16 autocast
+
+        x = x.transpose(1, 2).reshape(B, N, self.num_heads * head_dim)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
+def merge_frame_tokens(x, size, ratio, num_global=1):
+    '''
+    Token merging (Bolya et al. 2023) restricted to neighbouring frames, x: b n c with the num_global global tokens first.
+    The frame tokens are paired as (0, 1), (2, 3), ... and the ratio of the frame tokens from the pairs with the highest cosine
+    similarity are merged, every merged pair is replaced by the average of its two tokens weighted by size, the number of frames
+    already merged into every token (b n 1, None for one frame per token). The tokens stay in temporal order.
+    Returns the merged tokens and their sizes
+    '''
+    b, n, c = x.shape
+    g = num_global
+    if size is None:
+        size = torch.ones(b, n, 1, dtype=x.dtype, device=x.device)
+    frames = n - g
+    pairs = frames // 2
+    r = min(int(frames * ratio), pairs) # every merged pair removes one token
+    if r == 0:
+        return x, size
+
+    first, second = x[:, g:g + 2 * pairs:2], x[:, g + 1:g + 2 * pairs:2]
+    first_size, second_size = size[:, g:g + 2 * pairs:2], size[:, g + 1:g + 2 * pairs:2]
+    similarity = F.cosine_similarity(first, second, dim=-1) # b pairs
+    top = similarity.topk(r, dim=1).indices
+    merged = torch.zeros_like(similarity, dtype=torch.bool).scatter(1, top, torch.ones_like(top, dtype=torch.bool)) # a tensor source, a Python bool does not export to ONNX
+
+    # the merged token takes the place of the second token of its pair, the first one is dropped
+    merged_size = first_size + second_size
+    second = torch.where(merged[..., None], (first * first_size + second * second_size) / merged_size, second)
+    second_size = torch.where(merged[..., None], merged_size, second_size)
+    tokens = torch.cat((torch.stack((first, second), dim=2).reshape(b, 2 * pairs, c), x[:, g + 2 * pairs:]), dim=1)
+    sizes = torch.cat((torch.stack((first_size, second_size), dim=2).reshape(b, 2 * pairs, 1), size[:, g + 2 * pairs:]), dim=1)
+    keep = torch.cat((torch.stack((~merged, torch.ones_like(merged)), dim=2).reshape(b, 2 * pairs), torch.ones_like(merged[:, :frames - 2 * pairs])), dim=1)
+
+    # every row keeps frames - r tokens, topk instead of nonzero gives that fixed shape also under vmap and in ONNX, sorted back into temporal order
+    index = keep.float().topk(frames - r, dim=1, sorted=False).indices.sort(dim=1).values
+    tokens = tokens.gather(1, index[..., None].expand(-1, -1, c))
+    sizes = sizes.gather(1, index[..., None])
+    return torch.cat((x[:, :g], tokens), dim=1), torch.cat((size[:, :g], sizes), dim=1)
+
+def frame_positional_embedding(pos_embed, positions=None):
+    '''
+    Temporal positional embedding (class token first, then one per frame of a segment) of the frames at positions (b k, see
+    extract_selected_segments in trajectory.py), the whole embedding for segments of all frames (positions None)
+    '''
+    if positions is None:
+        return pos_embed
+    return torch.cat((pos_embed[:1].expand(positions.shape[0], 1, -1), pos_embed[1:][positions]), dim=1)
+
+class EarlyExits:
+    '''
+    Early exits of one forward pass through the temporal blocks of a model with exit_heads, one head per block but the last.
+    In training every exit head classifies all segments, model.exit_outputs keeps their log likelihoods for the loss.
+    At inference with model.exit_threshold, the segments whose most likely class has at least that probability after a block
+    leave with the log likelihoods of its exit head, only the others run through the next blocks. model.exit_depths then holds
+    the number of blocks every segment ran through
+    '''
+    def __init__(self, model, batch_size, device):
+        self.model = model
+        self.threshold = None if model.training else model.exit_threshold
+        self.remaining = torch.arange(batch_size, device=device) # segments of the batch still running
+        self.depths = torch.full((batch_size,), len(model.blocks), device=device)
+        self.outputs = []
+        self.log_likelihoods = None
+
+    def after_block(self, i, x, size):
+        if i >= len(self.model.exit_heads) or (self.threshold is None and not self.model.training):
+            return x, size
+        log_likelihoods = F.log_softmax(self.model.exit_heads[i](x[:, 0]).float(), dim=1)
+        if self.threshold is None:
+            self.outputs.append(log_likelihoods)
+            return x, size
+
+        if self.log_likelihoods is None:
+            self.log_likelihoods = log_likelihoods.new_zeros(len(self.depths), log_likelihoods.shape[1])
+        done = log_likelihoods.max(dim=1).values.exp() >= self.threshold
+        self.log_likelihoods[self.remaining[done]] = log_likelihoods[done]
+        self.depths[self.remaining[done]] = i + 1
+        self.remaining = self.remaining[~done]
+        return x[~done], size[~done] if size is not None else None
+
+    def finish(self, log_likelihoods):
+        '''
+        Returns the log likelihoods of all segments of the batch, log_likelihoods are those of the segments that ran through all blocks
+        '''
+        self.model.exit_outputs = self.outputs
+        if self.log_likelihoods is None:
+            return log_likelihoods
+        self.log_likelihoods[self.remaining] = log_likelihoods
+        self.model.exit_depths = self.depths
+        return self.log_likelihoods
+
+### attention implementations of the Blocks, by the name of MODEL: TEMPORAL_ATTENTION in config.yml
+ATTENTION_LAYERS = {'softmax': Attention, 'linear': LinearAttention}
+
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
-                 dropout=0., act_layer=nn.GELU):
+                 dropout=0., act_layer=nn.GELU, window=None, num_global=1, attn_layer=Attention):
         super().__init__()
-        self.norm1 = nn.LayerNorm(dim, eps=1e-6)
-        self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+        self.norm1 = LayerNorm(dim, eps=1e-6)
+        self.attn = attn_layer(dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop, window=window, num_global=num_global)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         #self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.dropout = nn.Dropout(dropout) #first try a simple dropout instead of drop path
-        self.norm2 = nn.LayerNorm(dim, eps=1e-6)
+        self.norm2 = LayerNorm(dim, eps=1e-6)
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, act_layer=act_layer, drop=drop)
+        self.checkpoint_activations = False # recompute the activations in the backward pass instead of keeping them, see set_activation_checkpointing
 
     def forward(self, x):
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            return checkpoint(self.forward_block, x, use_reentrant=False)
+        return self.forward_block(x)
+
+    def forward_block(self, x):
         #x = x + self.drop_path(self.attn(self.norm1(x)))
         #x = x + self.drop_path(self.mlp(self.norm2(x)))
         x = x + self.dropout(self.attn(self.norm1(x)))
         x = x + self.dropout(self.mlp(self.norm2(x)))
         return x
         
+ACTIVATION_CHECKPOINTING_MODES = ('block', 'tower')
+
+def set_activation_checkpointing(model, mode):
+    '''
+    Trades compute for memory in training, the activations are recomputed in the backward pass instead of kept from the forward pass:
+      block   every Block keeps only its input
+      tower   every spatial tower (the spatial stage of SpatialTemporalTransformer, the body part towers of BodyPartTransformer)
+              keeps only its input, the temporal blocks keep their activations
+    None keeps all activations
+    '''
+    if mode not in (None,) + ACTIVATION_CHECKPOINTING_MODES:
+        raise Exception('activation checkpointing must be one of %s, got %s' % (ACTIVATION_CHECKPOINTING_MODES, mode))
+    if mode == 'tower' and not hasattr(model, 'checkpoint_towers'):
+        raise Exception('%s has no spatial towers, use block activation checkpointing' % type(model).__name__)
+    for module in model.modules():
+        if isinstance(module, Block):
+            module.checkpoint_activations = mode == 'block'
+    if hasattr(model, 'checkpoint_towers'):
+        model.checkpoint_towers = mode == 'tower'
+    return model
+
+def set_chunked_execution(model, frames=None, sequences=None):
+    '''
+    Bounds the peak memory of large (inference) batches, the outputs stay the same:
+      frames      the spatial towers (SpatialTemporalTransformer, BodyPartTransformer) encode at most this many frames at a time
+      sequences   every Attention computes the attention matrices of at most this many sequences at a time
+    None runs all at once
+    '''
+    if frames and not hasattr(model, 'spatial_chunk_size'):
+        raise Exception('%s has no spatial towers to run in chunks of frames' % type(model).__name__)
+    if hasattr(model, 'spatial_chunk_size'):
+        model.spatial_chunk_size = frames
+    for module in model.modules():
+        if isinstance(module, Attention):
+            module.chunk_size = sequences
+    return model
+
+def tower_forward(model, tower, x):
+    '''
+    Runs a spatial tower of the model on x (b f p c), without keeping its activations in training with model.checkpoint_towers,
+    on at most model.spatial_chunk_size frames at a time if set. The towers encode every frame on its own, so the chunks give the same result
+    '''
+    def run(x):
+        if model.checkpoint_towers and model.training and torch.is_grad_enabled():
+            return checkpoint(tower, x, use_reentrant=False)
+        return tower(x)
+
+    b, f = x.shape[:2]
+    chunk = model.spatial_chunk_size
+    if not chunk or b * f <= chunk:
+        return run(x)
+    frames = x.reshape((1, b * f) + x.shape[2:])
+    return torch.cat([run(frames[:, i:i + chunk]) for i in range(0, b * f, chunk)], dim=1).reshape(b, f, -1)
+
 class TemporalTransformer(nn.Module):
     def __init__(self, num_classes=13, num_frames=12, num_joints=17, in_chans=2, embed_dim=64, depth=4,
                  num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., dropout=0.2):
+                 drop_rate=0., attn_drop_rate=0., dropout=0.2, temporal_window=None, num_global_tokens=1, temporal_attention='softmax',
+                 temporal_merge=None, early_exit=False):
         """    ##########hybrid_backbone=None, representation_size=None,
         Args:
             num_classes (int): number of classes for classification head, HR-Crime constists of 13 crime categories
@@ -302,6 +619,11 @@ class TemporalTransformer(nn.Module):
             drop_rate (float): dropout rate
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
+            temporal_window (int): if set, every frame only attends to the frames at most temporal_window positions away and to the global tokens (Attention.windowed_attention)
+            num_global_tokens (int): number of global tokens of the temporal blocks, the class token and num_global_tokens - 1 learned ones
+            temporal_attention (str): attention implementation of the temporal blocks, softmax or linear (see ATTENTION_LAYERS)
+            temporal_merge (list): fraction of the frame tokens merged with a neighbouring frame after every temporal block (merge_frame_tokens), None for no merging
+            early_exit (bool): add a classification head after every temporal block but the last, segments leave as soon as one is confident enough (EarlyExits)
         """
         super().__init__()
         
@@ -316,6 +638,15 @@ class TemporalTransformer(nn.Module):
         ### Additional class token
         self.cls_token = nn.Parameter(torch.zeros(1, embed_dim))
 
+        ### learned global tokens after the class token, the windowed temporal attention passes information between distant frames through them
+        self.global_tokens = nn.Parameter(torch.zeros(num_global_tokens - 1, embed_dim)) if num_global_tokens > 1 else None
+        self.num_global_tokens = num_global_tokens
+
+        ### per block reduction schedule of the frame tokens, the later temporal blocks run on fewer tokens
+        if temporal_merge is not None and len(temporal_merge) != depth:
+            raise Exception('temporal_merge needs one fraction per temporal block, got %d for %d blocks' % (len(temporal_merge), depth))
+        self.temporal_merge = temporal_merge
+
         ### positional embedding including class token
         self.pos_embed = nn.Parameter(torch.zeros(num_frames+1, embed_dim))
 
@@ -326,13 +657,14 @@ class TemporalTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout
+                drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout, window=temporal_window, num_global=num_global_tokens,
+                attn_layer=ATTENTION_LAYERS[temporal_attention]
                  #drop_path=dpr[i] #first try a simple dropout instead of drop path
                 )
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -349,6 +681,10 @@ class TemporalTransformer(nn.Module):
         "Define standard linear + softmax generation step."
         "use learned linear transformation and softmax function to convert the output to predicted class probabilities"
         self.head = nn.Linear(embed_dim, num_classes) #no softmax is used
+
+        ### early exit heads on the class token after every temporal block but the last, see EarlyExits
+        self.exit_heads = nn.ModuleList([nn.Sequential(LayerNorm(embed_dim, eps=1e-6), nn.Linear(embed_dim, num_classes)) for i in range(depth - 1)]) if early_exit else None
+        self.exit_threshold = None
         
         # initialize weights
         self.init_weights()
@@ -360,7 +696,7 @@ class TemporalTransformer(nn.Module):
           self.head.bias.data.zero_()
           self.head.weight.data.uniform_(-initrange, initrange)
 
-    def forward_features(self, x):
+    def forward_features(self, x, positions=None, exits=None):
 
         #print("call forward features")
         # print(f"x shape: {x.shape}")
@@ -382,12 +718,22 @@ class TemporalTransformer(nn.Module):
         #print(f"pos_embed shape: {self.pos_embed.shape}")
         #print(f"x + self.pos_embed shape: {(x + self.pos_embed).shape}")
 
-        x = self.pos_drop(x + self.pos_embed)
+        x = self.pos_drop(x + frame_positional_embedding(self.pos_embed, positions))
+
+        if self.global_tokens is not None:
+            x = torch.cat((x[:, :1], self.global_tokens.expand(x.shape[0], -1, -1), x[:, 1:]), dim=1)
         #print(f"pos_drop x shape: {x.shape}")
 
         #x = self.blocks(x)
-        for blk in self.blocks:
+        size = None
+        for i, blk in enumerate(self.blocks):
             x = blk(x)
+            if self.temporal_merge and self.temporal_merge[i]:
+                x, size = merge_frame_tokens(x, size, self.temporal_merge[i], self.num_global_tokens)
+            if exits is not None:
+                x, size = exits.after_block(i, x, size)
+                if not len(x): # every segment left early
+                    break
             #print(f"blocks(x) shape: {x.shape}")
 
         x = self.norm(x)
@@ -396,11 +742,12 @@ class TemporalTransformer(nn.Module):
         #return self.pre_logits(x[:, 0])
         return cls_token_final
     
-    def forward(self, x):
-        x = self.forward_features(x)
+    def forward(self, x, positions=None):
+        exits = EarlyExits(self, x.shape[0], x.device) if self.exit_heads is not None else None
+        x = self.forward_features(x, positions, exits)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
-        return x
+        x = F.log_softmax(x.float(), dim=1)
+        return exits.finish(x) if exits is not None else x
 
 
 #input 34 values (one per 2D joint) and the vector describes the window of how the joint value fluctuates 
@@ -453,7 +800,7 @@ class TemporalTransformer_2(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -526,7 +873,7 @@ class TemporalTransformer_2(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 #Input frame sequences of average body parts coordinates
@@ -583,7 +930,7 @@ class TemporalTransformer_3(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -656,7 +1003,7 @@ class TemporalTransformer_3(nn.Module):
 
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 
@@ -713,7 +1060,7 @@ class TemporalTransformer_4(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -793,7 +1140,7 @@ class TemporalTransformer_4(nn.Module):
 
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
         
 
@@ -803,7 +1150,8 @@ class SpatialTemporalTransformer(nn.Module):
     '''
     def __init__(self, num_classes=13, num_frames=12, num_joints=17, in_chans=2, embed_dim_ratio=8, depth=4,
                  num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., dropout=0.2):
+                 drop_rate=0., attn_drop_rate=0., dropout=0.2, temporal_window=None, num_global_tokens=1, temporal_attention='softmax',
+                 temporal_merge=None, early_exit=False):
         """    ##########hybrid_backbone=None, representation_size=None,
         Args:
             num_classes (int): number of classes for classification head, HR-Crime constists of 13 crime categories
@@ -819,6 +1167,11 @@ class SpatialTemporalTransformer(nn.Module):
             drop_rate (float): dropout rate
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
+            temporal_window (int): if set, every frame only attends to the frames at most temporal_window positions away and to the global tokens (Attention.windowed_attention)
+            num_global_tokens (int): number of global tokens of the temporal blocks, the class token and num_global_tokens - 1 learned ones
+            temporal_attention (str): attention implementation of the temporal blocks, softmax or linear (see ATTENTION_LAYERS)
+            temporal_merge (list): fraction of the frame tokens merged with a neighbouring frame after every temporal block (merge_frame_tokens), None for no merging
+            early_exit (bool): add a classification head after every temporal block but the last, segments leave as soon as one is confident enough (EarlyExits)
         """
         super().__init__()
         
@@ -850,22 +1203,38 @@ class SpatialTemporalTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout)
+                drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout, window=temporal_window, num_global=num_global_tokens,
+                attn_layer=ATTENTION_LAYERS[temporal_attention])
             for i in range(depth)])
 
-        #self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
-        self.Spatial_norm =  nn.LayerNorm(embed_dim_ratio, eps=1e-6)
-        self.Temporal_norm =  nn.LayerNorm(embed_dim, eps=1e-6)
+        #self.norm = LayerNorm(embed_dim, eps=1e-6)
+        self.Spatial_norm =  LayerNorm(embed_dim_ratio, eps=1e-6)
+        self.Temporal_norm =  LayerNorm(embed_dim, eps=1e-6)
 
         print('num_classes',num_classes)
         print('embed_dim', embed_dim)
 
         self.cls_token = nn.Parameter(torch.zeros(1, embed_dim))
+
+        ### learned global tokens after the class token, the windowed temporal attention passes information between distant frames through them
+        self.global_tokens = nn.Parameter(torch.zeros(num_global_tokens - 1, embed_dim)) if num_global_tokens > 1 else None
+        self.num_global_tokens = num_global_tokens
+
+        ### per block reduction schedule of the frame tokens, the later temporal blocks run on fewer tokens
+        if temporal_merge is not None and len(temporal_merge) != depth:
+            raise Exception('temporal_merge needs one fraction per temporal block, got %d for %d blocks' % (len(temporal_merge), depth))
+        self.temporal_merge = temporal_merge
         
 
         # Classifier head(s)
         "Define standard linear to map the final output sequence to class logits"
         self.head = nn.Linear(embed_dim, num_classes) #do not use softmax here. nn.CrossEntropyLoss takes the logits as input and calculates the softmax
+
+        ### early exit heads on the class token after every temporal block but the last, see EarlyExits
+        self.exit_heads = nn.ModuleList([nn.Sequential(LayerNorm(embed_dim, eps=1e-6), nn.Linear(embed_dim, num_classes)) for i in range(depth - 1)]) if early_exit else None
+        self.exit_threshold = None
+        self.checkpoint_towers = False # recompute the activations of the spatial towers in the backward pass, see set_activation_checkpointing
+        self.spatial_chunk_size = None # the spatial towers encode at most this many frames at a time, see set_chunked_execution
         
         #print('self.head',self.head)
         #print('num_classes',num_classes)
@@ -924,7 +1293,7 @@ class SpatialTemporalTransformer(nn.Module):
         #print('rearranged x.shape', x.shape)
         return x
 
-    def forward_features(self, x):
+    def forward_features(self, x, positions=None, exits=None):
         #print('\nCall forward_features')
         #print('x.shape[0]', x.shape[0])
         b  = x.shape[0]
@@ -944,10 +1313,20 @@ class SpatialTemporalTransformer(nn.Module):
         #print(f"Temporal_pos_embed shape: {self.Temporal_pos_embed.shape}")
         #print(f"x + self.Temporal_pos_embed shape: {(x + self.Temporal_pos_embed).shape}")
 
-        x = self.pos_drop(x + self.Temporal_pos_embed)
+        x = self.pos_drop(x + frame_positional_embedding(self.Temporal_pos_embed, positions))
 
-        for blk in self.blocks:
+        if self.global_tokens is not None:
+            x = torch.cat((x[:, :1], self.global_tokens.expand(x.shape[0], -1, -1), x[:, 1:]), dim=1)
+
+        size = None
+        for i, blk in enumerate(self.blocks):
             x = blk(x)
+            if self.temporal_merge and self.temporal_merge[i]:
+                x, size = merge_frame_tokens(x, size, self.temporal_merge[i], self.num_global_tokens)
+            if exits is not None:
+                x, size = exits.after_block(i, x, size)
+                if not len(x): # every segment left early
+                    break
 
         x = self.Temporal_norm(x)
         ##### x size [b, f, emb_dim], then take weighted mean on frame dimension, we only predict 3D pose of the center frame
@@ -958,7 +1337,7 @@ class SpatialTemporalTransformer(nn.Module):
         return cls_token_final
     
     
-    def forward(self, x):
+    def forward(self, x, positions=None):
         #print('\nCall forward')
         #print('x.shape', x.shape)
         #print('x', x)
@@ -974,15 +1353,52 @@ class SpatialTemporalTransformer(nn.Module):
         #print('x reshape', x)
 
         ### now x is [batch_size, 2 channels, receptive frames, joint_num], following image data
-        x = self.Spatial_forward_features(x)
-        x = self.forward_features(x)
-        
+        x = tower_forward(self, self.Spatial_forward_features, x)
+        exits = EarlyExits(self, x.shape[0], x.device) if self.exit_heads is not None else None
+        x = self.forward_features(x, positions, exits)
+
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
+
+
+        return exits.finish(x) if exits is not None else x
+
+    def Spatial_forward_frames(self, x):
+        '''
+        Spatially encodes single frames, x: t e (t frames of 2xnumber of joints), returns t (p c)
+        The spatial stage only looks at the joints of one frame, so the result can be cached per frame
+        '''
+        t, e = x.shape
+        x = torch.reshape(x, (1, t, e//self.in_chans, self.in_chans))
+        x = tower_forward(self, self.Spatial_forward_features, x)
+        return x[0]
+
+    def forward_cached(self, x):
+        '''
+        Classifies windows assembled from cached frame features, x: b f (p c)
+        '''
+        x = self.forward_features(x)
 
+        x = self.head(x)
+        x = F.log_softmax(x.float(), dim=1)
 
         return x
 
+    def forward_trajectory(self, x, batch_size=500):
+        '''
+        Inference over all sliding windows (stride 1) of a single trajectory, x: t e
+        Every frame is spatially encoded once instead of once per window it appears in.
+        Returns the log likelihoods of the t-f+1 windows, in the order of extract_fixed_sized_segments()
+        '''
+        f = self.Temporal_pos_embed.shape[0] - 1 ##### number of frames per window
+
+        frame_features = torch.cat([self.Spatial_forward_frames(frames) for frames in torch.split(x, batch_size*f)], dim=0)
+
+        windows = frame_features.unfold(0, f, 1)  ##### shape: (t-f+1) (p c) f, a view on the cached frame features
+        windows = rearrange(windows, 'n e f -> n f e')
+
+        return torch.cat([self.forward_cached(batch) for batch in torch.split(windows, batch_size)], dim=0)
+
     def forward_mistake(self, x):
         #print('\nCall forward')
         #print('x.shape', x.shape)
@@ -1016,7 +1432,8 @@ class BodyPartTransformer(nn.Module):
     '''
     def __init__(self, dataset=None, num_classes=13, num_frames=12, num_joints=17, in_chans=2, embed_dim_ratio=32, depth=4,
                  num_heads=8, mlp_ratio=2., qkv_bias=True, qk_scale=None,
-                 drop_rate=0., attn_drop_rate=0., dropout=0.2):
+                 drop_rate=0., attn_drop_rate=0., dropout=0.2, temporal_window=None, num_global_tokens=1, temporal_attention='softmax',
+                 temporal_merge=None, early_exit=False):
         """    ##########hybrid_backbone=None, representation_size=None,
         Args:
             num_classes (int): number of classes for classification head, HR-Crime constists of 13 crime categories
@@ -1032,6 +1449,11 @@ class BodyPartTransformer(nn.Module):
             drop_rate (float): dropout rate
             attn_drop_rate (float): attention dropout rate
             drop_path_rate (float): stochastic depth rate
+            temporal_window (int): if set, every frame only attends to the frames at most temporal_window positions away and to the global tokens (Attention.windowed_attention)
+            num_global_tokens (int): number of global tokens of the temporal blocks, the class token and num_global_tokens - 1 learned ones
+            temporal_attention (str): attention implementation of the temporal blocks, softmax or linear (see ATTENTION_LAYERS)
+            temporal_merge (list): fraction of the frame tokens merged with a neighbouring frame after every temporal block (merge_frame_tokens), None for no merging
+            early_exit (bool): add a classification head after every temporal block but the last, segments leave as soon as one is confident enough (EarlyExits)
         """
         super().__init__()
 
@@ -1104,22 +1526,38 @@ class BodyPartTransformer(nn.Module):
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
-                drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout)
+                drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout, window=temporal_window, num_global=num_global_tokens,
+                attn_layer=ATTENTION_LAYERS[temporal_attention])
             for i in range(depth)])
 
-        #self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
-        self.Spatial_norm =  nn.LayerNorm(embed_dim_ratio, eps=1e-6)
-        self.Temporal_norm =  nn.LayerNorm(embed_dim, eps=1e-6)
+        #self.norm = LayerNorm(embed_dim, eps=1e-6)
+        self.Spatial_norm =  LayerNorm(embed_dim_ratio, eps=1e-6)
+        self.Temporal_norm =  LayerNorm(embed_dim, eps=1e-6)
 
         print('num_classes',num_classes)
         print('embed_dim', embed_dim)
 
         self.cls_token = nn.Parameter(torch.zeros(1, embed_dim))
+
+        ### learned global tokens after the class token, the windowed temporal attention passes information between distant frames through them
+        self.global_tokens = nn.Parameter(torch.zeros(num_global_tokens - 1, embed_dim)) if num_global_tokens > 1 else None
+        self.num_global_tokens = num_global_tokens
+
+        ### per block reduction schedule of the frame tokens, the later temporal blocks run on fewer tokens
+        if temporal_merge is not None and len(temporal_merge) != depth:
+            raise Exception('temporal_merge needs one fraction per temporal block, got %d for %d blocks' % (len(temporal_merge), depth))
+        self.temporal_merge = temporal_merge
         
 
         # Classifier head(s)
         "Define standard linear to map the final output sequence to class logits"
         self.head = nn.Linear(embed_dim, num_classes) #do not use softmax here. nn.CrossEntropyLoss takes the logits as input and calculates the softmax
+
+        ### early exit heads on the class token after every temporal block but the last, see EarlyExits
+        self.exit_heads = nn.ModuleList([nn.Sequential(LayerNorm(embed_dim, eps=1e-6), nn.Linear(embed_dim, num_classes)) for i in range(depth - 1)]) if early_exit else None
+        self.exit_threshold = None
+        self.checkpoint_towers = False # recompute the activations of the spatial towers in the backward pass, see set_activation_checkpointing
+        self.spatial_chunk_size = None # the spatial towers encode at most this many frames at a time, see set_chunked_execution
         
         #print('self.head',self.head)
         #print('num_classes',num_classes)
@@ -1250,7 +1688,7 @@ class BodyPartTransformer(nn.Module):
         #print('rearranged x.shape', x.shape)
         return x
 
-    def forward_features(self, x):
+    def forward_features(self, x, positions=None, exits=None):
         #print('\nCall forward_features')
         #print('x.shape[0]', x.shape[0])
         b  = x.shape[0]
@@ -1270,10 +1708,20 @@ class BodyPartTransformer(nn.Module):
         #print(f"Temporal_pos_embed shape: {self.Temporal_pos_embed.shape}")
         #print(f"x + self.Temporal_pos_embed shape: {(x + self.Temporal_pos_embed).shape}")
 
-        x = self.pos_drop(x + self.Temporal_pos_embed)
+        x = self.pos_drop(x + frame_positional_embedding(self.Temporal_pos_embed, positions))
 
-        for blk in self.blocks:
+        if self.global_tokens is not None:
+            x = torch.cat((x[:, :1], self.global_tokens.expand(x.shape[0], -1, -1), x[:, 1:]), dim=1)
+
+        size = None
+        for i, blk in enumerate(self.blocks):
             x = blk(x)
+            if self.temporal_merge and self.temporal_merge[i]:
+                x, size = merge_frame_tokens(x, size, self.temporal_merge[i], self.num_global_tokens)
+            if exits is not None:
+                x, size = exits.after_block(i, x, size)
+                if not len(x): # every segment left early
+                    break
 
         x = self.Temporal_norm(x)
         ##### x size [b, f, emb_dim], then take weighted mean on frame dimension, we only predict 3D pose of the center frame
@@ -1284,7 +1732,7 @@ class BodyPartTransformer(nn.Module):
         return cls_token_final
 
 
-    def forward(self, x):
+    def forward(self, x, positions=None):
         #print('\nCall forward')
         #print('x.shape', x.shape)
         b, f, e = x.shape  ##### b is batch size, f is number of frames, e is number of elements equal to 2xnumber of joints
@@ -1355,11 +1803,11 @@ class BodyPartTransformer(nn.Module):
         print('x_ankle', x_ankle)
         '''
         
-        x_torso = self.Torso_forward_features(x_torso)
-        x_elbow = self.Elbow_forward_features(x_elbow)
-        x_wrist = self.Wrist_forward_features(x_wrist)
-        x_knee = self.Knee_forward_features(x_knee)
-        x_ankle = self.Ankle_forward_features(x_ankle)
+        x_torso = tower_forward(self, self.Torso_forward_features, x_torso)
+        x_elbow = tower_forward(self, self.Elbow_forward_features, x_elbow)
+        x_wrist = tower_forward(self, self.Wrist_forward_features, x_wrist)
+        x_knee = tower_forward(self, self.Knee_forward_features, x_knee)
+        x_ankle = tower_forward(self, self.Ankle_forward_features, x_ankle)
 
         '''
         print('x_torso features shape', x_torso.shape)
@@ -1377,15 +1825,16 @@ class BodyPartTransformer(nn.Module):
 
         #print('x.shape', x.shape)
 
-        x = self.forward_features(x)
+        exits = EarlyExits(self, x.shape[0], x.device) if self.exit_heads is not None else None
+        x = self.forward_features(x, positions, exits)
         
         x = self.head(x)
 
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
 
         #print(f"head(x) size: {x.size()}")
 
-        return x
+        return exits.finish(x) if exits is not None else x
   
 class TubeletTemporalTransformer(nn.Module):
     '''
@@ -1444,7 +1893,7 @@ class TubeletTemporalTransformer(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -1501,7 +1950,7 @@ class TubeletTemporalTransformer(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
@@ -1542,6 +1991,7 @@ class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
             self.wrists_conv = torch.nn.Conv3d(1, embed_dim, kernel_size=kernel, stride=stride)
             self.knees_conv = torch.nn.Conv3d(1, embed_dim, kernel_size=kernel, stride=stride)
             self.ankles_conv = torch.nn.Conv3d(1, embed_dim, kernel_size=kernel, stride=stride)
+            init_part_tubelets(self, num_joints*in_chans)
 
         ### patch embedding
         # self.embedding = nn.Linear(num_joints*in_chans, embed_dim)
@@ -1564,7 +2014,7 @@ class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -1592,9 +2042,12 @@ class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
           self.head.bias.data.zero_()
           self.head.weight.data.uniform_(-initrange, initrange)
 
-    def tubelet_embedding(self, x):
+    def part_volumes(self, x):
+        '''
+        Returns the padded volume of every body part, each of shape b c f h w
+        '''
         if self.dataset == "NTU_3D":
-            torso = get_keypoint(x, [], 3)
+            raise Exception('tubelet body parts are not defined for NTU_3D')
         elif self.dataset == "NTU_2D":
             torso = get_keypoint(x, [4, 3, 9, 21, 5, 2, 17, 1, 13], 2)
             elbows = get_keypoint(x, [10, 6], 2)
@@ -1622,34 +2075,7 @@ class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(1, 1), mode='constant', value=0) ## Shape: b f 4 4
             ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 4 4
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
-
-            torso_embed = torch.mean(torso_embed, dim=2)
-            elbows_embed = torch.mean(elbows_embed, dim=2)
-            wrists_embed = torch.mean(wrists_embed, dim=2)
-            knees_embed = torch.mean(knees_embed, dim=2)
-            ankles_embed = torch.mean(ankles_embed, dim=2)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
-
-            return x
+            return torso, elbows, wrists, knees, ankles
         elif self.dataset == "HRC":
             torso = get_keypoint(x, [1, 2, 3, 4, 5, 6, 7, 12, 13], 2)
             elbows = get_keypoint(x, [8, 9], 2)
@@ -1677,35 +2103,19 @@ class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
             # ankles = F.pad(input=ankles, pad=(1, 1), mode='constant', value=0) ## Already a square
             ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 4 4
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
+            return torso, elbows, wrists, knees, ankles
+            
 
-            torso_embed = torch.mean(torso_embed, dim=2)
-            elbows_embed = torch.mean(elbows_embed, dim=2)
-            wrists_embed = torch.mean(wrists_embed, dim=2)
-            knees_embed = torch.mean(knees_embed, dim=2)
-            ankles_embed = torch.mean(ankles_embed, dim=2)
+    def tubelet_embedding(self, x):
+        x = pack_part_volumes(x, self.part_index)                          ## Shape: b (p c) f h w
+        x = grouped_part_conv(x, [self.torso_conv, self.elbows_conv, self.wrists_conv, self.knees_conv, self.ankles_conv])
 
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
+        # OUTPUT SHAPE : b (p e) n1 n2 n3, mean over the tubelets of each part only
 
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
+        x = rearrange(x, "b (p e) n1 n2 n3 -> b p e n1 n2 n3", p=5)
+        x = (x * self.part_mask).sum(dim=(3, 4, 5)) / (self.part_mask.sum(dim=(2, 3, 4)) * x.shape[3])
 
-            return x
-            
+        return x
 
     def forward_features(self, x):
         
@@ -1733,7 +2143,7 @@ class TubeletTemporalPart_mean_chan_1_Transformer(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
@@ -1777,6 +2187,7 @@ class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
             self.wrists_conv = torch.nn.Conv3d(1, embed_dim, kernel_size=kernel, stride=stride)
             self.knees_conv = torch.nn.Conv3d(1, embed_dim, kernel_size=kernel, stride=stride)
             self.ankles_conv = torch.nn.Conv3d(1, embed_dim, kernel_size=kernel, stride=stride)
+            init_part_tubelets(self, num_joints*in_chans)
 
         ### patch embedding
         # self.embedding = nn.Linear(num_joints*in_chans, embed_dim)
@@ -1806,7 +2217,7 @@ class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(self.final_embed_dim, eps=1e-6)
+        self.norm = LayerNorm(self.final_embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -1834,9 +2245,12 @@ class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
           self.head.bias.data.zero_()
           self.head.weight.data.uniform_(-initrange, initrange)
 
-    def tubelet_embedding(self, x):
+    def part_volumes(self, x):
+        '''
+        Returns the padded volume of every body part, each of shape b c f h w
+        '''
         if self.dataset == "NTU_3D":
-            torso = get_keypoint(x, [], 3)
+            raise Exception('tubelet body parts are not defined for NTU_3D')
         elif self.dataset == "NTU_2D":
             torso = get_keypoint(x, [4, 3, 9, 21, 5, 2, 17, 1, 13], 2)
             elbows = get_keypoint(x, [10, 6], 2)
@@ -1864,34 +2278,7 @@ class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(2, 2, 1, 1), mode='constant', value=0) ## Shape: b f 6 6
             ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 6 6
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
-            ## CONCAT THE RESULTS OF CONVOLUTION (N x 32 dimensional)
-            torso_embed = rearrange(torso_embed, "b e n -> b (n e)")
-            elbows_embed = rearrange(elbows_embed, "b e n -> b (n e)")
-            wrists_embed = rearrange(wrists_embed, "b e n -> b (n e)")
-            knees_embed = rearrange(knees_embed, "b e n -> b (n e)")
-            ankles_embed = rearrange(ankles_embed, "b e n -> b (n e)")
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
-
-            return x
+            return torso, elbows, wrists, knees, ankles
         elif self.dataset == "HRC":
             torso = get_keypoint(x, [1, 2, 3, 4, 5, 6, 7, 12, 13], 2)
             elbows = get_keypoint(x, [8, 9], 2)
@@ -1919,35 +2306,17 @@ class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(2, 2, 2, 2), mode='constant', value=0) ## Shape: b f 6 6
             ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 6 6
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
-            ## CONCAT THE RESULTS OF CONVOLUTION (N x 32 dimensional)
-            torso_embed = rearrange(torso_embed, "b e n -> b (n e)")
-            elbows_embed = rearrange(elbows_embed, "b e n -> b (n e)")
-            wrists_embed = rearrange(wrists_embed, "b e n -> b (n e)")
-            knees_embed = rearrange(knees_embed, "b e n -> b (n e)")
-            ankles_embed = rearrange(ankles_embed, "b e n -> b (n e)")
+            return torso, elbows, wrists, knees, ankles
+            
 
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
+    def tubelet_embedding(self, x):
+        x = pack_part_volumes(x, self.part_index)                          ## Shape: b (p c) f h w
+        x = grouped_part_conv(x, [self.torso_conv, self.elbows_conv, self.wrists_conv, self.knees_conv, self.ankles_conv])
 
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
+        ## CONCAT THE RESULTS OF CONVOLUTION (N x 32 dimensional)
+        x = rearrange(x, "b (p e) n1 n2 n3 -> b p (n1 n2 n3 e)", p=5)
 
-            return x
-            
+        return x
 
     def forward_features(self, x):
         
@@ -1975,7 +2344,7 @@ class TubeletTemporalPart_concat_chan_1_Transformer(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
@@ -2016,6 +2385,7 @@ class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
             self.wrists_conv = torch.nn.Conv3d(in_chans, embed_dim, kernel_size=kernel, stride=stride)
             self.knees_conv = torch.nn.Conv3d(in_chans, embed_dim, kernel_size=kernel, stride=stride)
             self.ankles_conv = torch.nn.Conv3d(in_chans, embed_dim, kernel_size=kernel, stride=stride)
+            init_part_tubelets(self, num_joints*in_chans)
 
         ### patch embedding
         # self.embedding = nn.Linear(num_joints*in_chans, embed_dim)
@@ -2038,7 +2408,7 @@ class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
+        self.norm = LayerNorm(embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -2066,9 +2436,12 @@ class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
           self.head.bias.data.zero_()
           self.head.weight.data.uniform_(-initrange, initrange)
 
-    def tubelet_embedding(self, x):
+    def part_volumes(self, x):
+        '''
+        Returns the padded volume of every body part, each of shape b c f h w
+        '''
         if self.dataset == "NTU_3D":
-            torso = get_keypoint(x, [], 3)
+            raise Exception('tubelet body parts are not defined for NTU_3D')
         elif self.dataset == "NTU_2D":
             torso = get_keypoint(x, [4, 3, 9, 21, 5, 2, 17, 1, 13], 2)
             elbows = get_keypoint(x, [10, 6], 2)
@@ -2098,40 +2471,7 @@ class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(1, 0, 1, 0), mode='constant', value=0) 
             # ankles = ankles.unsqueeze(1)                                       
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # OUTPUT SHAPE : b e n1 n2 n3
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
-            # OUTPUT SHAPE : b e (n1xn2xn3)
-
-
-            torso_embed = torch.mean(torso_embed, dim=2)
-            elbows_embed = torch.mean(elbows_embed, dim=2)
-            wrists_embed = torch.mean(wrists_embed, dim=2)
-            knees_embed = torch.mean(knees_embed, dim=2)
-            ankles_embed = torch.mean(ankles_embed, dim=2)
-
-            # OUTPUT SHAPE : b e
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
-
-            return x
+            return torso, elbows, wrists, knees, ankles
         elif self.dataset == "HRC":
             torso = get_keypoint(x, [1, 2, 3, 4, 5, 6, 7, 12, 13], 2)
             elbows = get_keypoint(x, [8, 9], 2)
@@ -2159,35 +2499,19 @@ class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(1, 0, 1, 1), mode='constant', value=0) ## Shape: b 2 f 2 2
             # ankles = ankles.unsqueeze(1)                                       
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
+            return torso, elbows, wrists, knees, ankles
+            
 
-            torso_embed = torch.mean(torso_embed, dim=2)
-            elbows_embed = torch.mean(elbows_embed, dim=2)
-            wrists_embed = torch.mean(wrists_embed, dim=2)
-            knees_embed = torch.mean(knees_embed, dim=2)
-            ankles_embed = torch.mean(ankles_embed, dim=2)
+    def tubelet_embedding(self, x):
+        x = pack_part_volumes(x, self.part_index)                          ## Shape: b (p c) f h w
+        x = grouped_part_conv(x, [self.torso_conv, self.elbows_conv, self.wrists_conv, self.knees_conv, self.ankles_conv])
 
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
+        # OUTPUT SHAPE : b (p e) n1 n2 n3, mean over the tubelets of each part only
 
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
+        x = rearrange(x, "b (p e) n1 n2 n3 -> b p e n1 n2 n3", p=5)
+        x = (x * self.part_mask).sum(dim=(3, 4, 5)) / (self.part_mask.sum(dim=(2, 3, 4)) * x.shape[3])
 
-            return x
-            
+        return x
 
     def forward_features(self, x):
         
@@ -2215,7 +2539,7 @@ class TubeletTemporalPart_mean_chan_2_Transformer(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
@@ -2261,6 +2585,7 @@ class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
             self.wrists_conv = torch.nn.Conv3d(in_chans, embed_dim, kernel_size=kernel, stride=stride)
             self.knees_conv = torch.nn.Conv3d(in_chans, embed_dim, kernel_size=kernel, stride=stride)
             self.ankles_conv = torch.nn.Conv3d(in_chans, embed_dim, kernel_size=kernel, stride=stride)
+            init_part_tubelets(self, num_joints*in_chans)
 
         ### patch embedding
         # self.embedding = nn.Linear(num_joints*in_chans, embed_dim)
@@ -2290,7 +2615,7 @@ class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
             for i in range(depth)])
         
 
-        self.norm = nn.LayerNorm(self.final_embed_dim, eps=1e-6)
+        self.norm = LayerNorm(self.final_embed_dim, eps=1e-6)
 
          # Representation layer
         '''if representation_size and not distilled:
@@ -2318,9 +2643,12 @@ class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
           self.head.bias.data.zero_()
           self.head.weight.data.uniform_(-initrange, initrange)
 
-    def tubelet_embedding(self, x):
+    def part_volumes(self, x):
+        '''
+        Returns the padded volume of every body part, each of shape b c f h w
+        '''
         if self.dataset == "NTU_3D":
-            torso = get_keypoint(x, [], 3)
+            raise Exception('tubelet body parts are not defined for NTU_3D')
         elif self.dataset == "NTU_2D":
             torso = get_keypoint(x, [4, 3, 9, 21, 5, 2, 17, 1, 13], 2)
             elbows = get_keypoint(x, [10, 6], 2)
@@ -2349,34 +2677,7 @@ class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(1, 0, 1, 0), mode='constant', value=0) ## Shape: b f 6 6
             # ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 6 6
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
-            ## CONCAT THE RESULTS OF CONVOLUTION (N x 32 dimensional)
-            torso_embed = rearrange(torso_embed, "b e n -> b (n e)")
-            elbows_embed = rearrange(elbows_embed, "b e n -> b (n e)")
-            wrists_embed = rearrange(wrists_embed, "b e n -> b (n e)")
-            knees_embed = rearrange(knees_embed, "b e n -> b (n e)")
-            ankles_embed = rearrange(ankles_embed, "b e n -> b (n e)")
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
-
-            return x
+            return torso, elbows, wrists, knees, ankles
         elif self.dataset == "HRC":
             torso = get_keypoint(x, [1, 2, 3, 4, 5, 6, 7, 12, 13], 2)
             elbows = get_keypoint(x, [8, 9], 2)
@@ -2404,35 +2705,17 @@ class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
             ankles = F.pad(input=ankles, pad=(1, 0, 1, 1), mode='constant', value=0) ## Shape: b f 6 6
             # ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 6 6
 
-            torso_embed = self.torso_conv(torso)
-            elbows_embed = self.elbows_conv(elbows)
-            wrists_embed = self.wrists_conv(wrists)
-            knees_embed = self.knees_conv(knees)
-            ankles_embed = self.ankles_conv(ankles)
-
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
-
-            torso_embed = torch.flatten(torso_embed, start_dim=2)
-            elbows_embed = torch.flatten(elbows_embed, start_dim=2)
-            wrists_embed = torch.flatten(wrists_embed, start_dim=2)
-            knees_embed = torch.flatten(knees_embed, start_dim=2)
-            ankles_embed = torch.flatten(ankles_embed, start_dim=2)
-
-            ## CONCAT THE RESULTS OF CONVOLUTION (N x 32 dimensional)
-            torso_embed = rearrange(torso_embed, "b e n -> b (n e)")
-            elbows_embed = rearrange(elbows_embed, "b e n -> b (n e)")
-            wrists_embed = rearrange(wrists_embed, "b e n -> b (n e)")
-            knees_embed = rearrange(knees_embed, "b e n -> b (n e)")
-            ankles_embed = rearrange(ankles_embed, "b e n -> b (n e)")
+            return torso, elbows, wrists, knees, ankles
+            
 
-            # print(torso_embed.shape)
-            # print(elbows_embed.shape)
+    def tubelet_embedding(self, x):
+        x = pack_part_volumes(x, self.part_index)                          ## Shape: b (p c) f h w
+        x = grouped_part_conv(x, [self.torso_conv, self.elbows_conv, self.wrists_conv, self.knees_conv, self.ankles_conv])
 
-            x = torch.stack((torso_embed, elbows_embed, wrists_embed, knees_embed, ankles_embed), dim=1)
+        ## CONCAT THE RESULTS OF CONVOLUTION (N x 32 dimensional)
+        x = rearrange(x, "b (p e) n1 n2 n3 -> b p (n1 n2 n3 e)", p=5)
 
-            return x
-            
+        return x
 
     def forward_features(self, x):
         
@@ -2460,7 +2743,7 @@ class TubeletTemporalPart_concat_chan_2_Transformer(nn.Module):
     def forward(self, x):
         x = self.forward_features(x)
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
 
 
@@ -2503,6 +2786,7 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
             self.wrists_conv = torch.nn.Conv3d(in_chans, embed_dim_ratio, kernel_size=kernel, stride=stride)
             self.knees_conv = torch.nn.Conv3d(in_chans, embed_dim_ratio, kernel_size=kernel, stride=stride)
             self.ankles_conv = torch.nn.Conv3d(in_chans, embed_dim_ratio, kernel_size=kernel, stride=stride)
+            init_part_tubelets(self, num_joints*in_chans)
 
         ### Tubelet Embedder - Position embedding
         if self.dataset == "HRC":
@@ -2570,9 +2854,9 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
                 drop=drop_rate, attn_drop=attn_drop_rate, dropout=dropout)
             for i in range(depth)])
 
-        #self.norm = nn.LayerNorm(embed_dim, eps=1e-6)
-        self.Spatial_norm =  nn.LayerNorm(embed_dim_ratio, eps=1e-6)
-        self.Temporal_norm =  nn.LayerNorm(embed_dim, eps=1e-6)
+        #self.norm = LayerNorm(embed_dim, eps=1e-6)
+        self.Spatial_norm =  LayerNorm(embed_dim_ratio, eps=1e-6)
+        self.Temporal_norm =  LayerNorm(embed_dim, eps=1e-6)
 
         print('num_classes',num_classes)
         print('embed_dim', embed_dim)
@@ -2604,8 +2888,6 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         self.head.weight.data.uniform_(-initrange, initrange)
     
     def Torso_forward_features(self, x):
-        x = self.torso_conv(x)
-        x = rearrange(x, "b e n1 n2 n3 -> b (n1 n2 n3) e")
         x = self.pos_drop(x + self.Torso_pos_embed)
 
         for blk in self.Torso_blocks:
@@ -2617,8 +2899,6 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         return x
     
     def Elbow_forward_features(self, x):
-        x = self.elbows_conv(x)
-        x = rearrange(x, "b e n1 n2 n3 -> b (n1 n2 n3) e")
         x = self.pos_drop(x + self.Elbow_pos_embed)
 
         for blk in self.Elbow_blocks:
@@ -2630,8 +2910,6 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         return x
     
     def Wrist_forward_features(self, x):
-        x = self.wrists_conv(x)
-        x = rearrange(x, "b e n1 n2 n3 -> b (n1 n2 n3) e")
         x = self.pos_drop(x + self.Wrist_pos_embed)
 
         for blk in self.Wrist_blocks:
@@ -2643,8 +2921,6 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         return x
     
     def Knee_forward_features(self, x):
-        x = self.knees_conv(x)
-        x = rearrange(x, "b e n1 n2 n3 -> b (n1 n2 n3) e")
         x = self.pos_drop(x + self.Knee_pos_embed)
 
         for blk in self.Knee_blocks:
@@ -2656,8 +2932,6 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         return x
 
     def Ankle_forward_features(self, x):
-        x = self.ankles_conv(x)
-        x = rearrange(x, "b e n1 n2 n3 -> b (n1 n2 n3) e")
         x = self.pos_drop(x + self.Ankle_pos_embed)
 
         for blk in self.Ankle_blocks:
@@ -2683,9 +2957,12 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         return cls_token_final
 
 
-    def tubelet_embedding(self, x):
+    def part_volumes(self, x):
+        '''
+        Returns the padded volume of every body part, each of shape b c f h w
+        '''
         if self.dataset == "NTU_3D":
-            torso = get_keypoint(x, [], 3)
+            raise Exception('tubelet body parts are not defined for NTU_3D')
         elif self.dataset == "NTU_2D":
             torso = get_keypoint(x, [4, 3, 9, 21, 5, 2, 17, 1, 13], 2)
             elbows = get_keypoint(x, [10, 6], 2)
@@ -2762,6 +3039,13 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
                 ankles = F.pad(input=ankles, pad=(1, 0, 1, 1, 0, 0), mode=self.pad_mode) ## Shape: b f 6 6
             # ankles = ankles.unsqueeze(1)                                       ## Shape: b 1 f 6 6
 
+        return torso, elbows, wrists, knees, ankles
+
+    def tubelet_embedding(self, x):
+        x = pack_part_volumes(x, self.part_index)                          ## Shape: b (p c) f h w
+        x = grouped_part_conv(x, [self.torso_conv, self.elbows_conv, self.wrists_conv, self.knees_conv, self.ankles_conv])
+        torso, elbows, wrists, knees, ankles = rearrange(x, "b (p e) n1 n2 n3 -> p b (n1 n2 n3) e", p=5)
+
         torso_embed = self.Torso_forward_features(torso)
         elbows_embed = self.Elbow_forward_features(elbows)
         wrists_embed = self.Wrist_forward_features(wrists)
@@ -2778,5 +3062,5 @@ class TubeletTemporalSpatialPart_concat_chan_2_Transformer(nn.Module):
         x = self.forward_features(x)
         
         x = self.head(x)
-        x = F.log_softmax(x, dim=1)
+        x = F.log_softmax(x.float(), dim=1)
         return x
\ No newline at end of file
@@ -53,7 +53,9 @@ class Attention_store_attn(nn.Module):
 
     def forward(self, x):
         B, N, C = x.shape
-        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        qkv = self.qkv(x)
+        head_dim = qkv.shape[-1] // (3 * self.num_heads) # also with heads removed by prune.py and for the wrapped qkv of quantize.py
+        qkv = qkv.reshape(B, N, 3, self.num_heads, head_dim).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
         attn = (q @ k.transpose(-2, -1)) * self.scale
@@ -66,7 +68,7 @@ class Attention_store_attn(nn.Module):
 
         #print('self.attn_scores', self.attn_scores)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = (attn @ v).transpose(1, 2).reshape(B, N, self.num_heads * head_dim)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -3,19 +3,25 @@ from sklearn.metrics import balanced_accuracy_score, accuracy_score, precision_s
 import logging
 import sys
 import os
+import random
+import queue
+import threading
+import contextlib
+import inspect
 import numpy as np
 import torch
 import torch.nn.functional as F
 
-def SetupFolders(training_name, dataset):
+def SetupFolders(training_name, dataset, resume=False):
   base_folder = os.path.join('/home/s2435462/HRC/results', dataset, training_name)
   model_dir = os.path.join(base_folder, 'models')
   log_dir = os.path.join(base_folder, 'logs')
   results_dir = os.path.join(base_folder, 'results')
 
-  os.makedirs(model_dir)
-  os.makedirs(log_dir)
-  os.makedirs(results_dir)
+  # a resumed training continues in the folders of the interrupted run
+  os.makedirs(model_dir, exist_ok=resume)
+  os.makedirs(log_dir, exist_ok=resume)
+  os.makedirs(results_dir, exist_ok=resume)
 
   return base_folder, model_dir, log_dir, results_dir
 
@@ -48,6 +54,215 @@ def SetupLogger(name, log_dir=None):
 
     return logger
 
+def snapshot(obj):
+  '''
+  Copies the tensors in (nested) dicts and lists to the CPU, so the copy does not change when training goes on
+  '''
+  if torch.is_tensor(obj):
+    return obj.detach().to('cpu', copy=True)
+  if isinstance(obj, dict):
+    return {key: snapshot(value) for key, value in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(snapshot(value) for value in obj)
+  return obj
+
+def get_rng_state():
+  state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+  if torch.cuda.is_available():
+    state['cuda'] = torch.cuda.get_rng_state_all()
+  return state
+
+def set_rng_state(state):
+  random.setstate(state['python'])
+  np.random.set_state(state['numpy'])
+  torch.set_rng_state(state['torch'])
+  if 'cuda' in state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state['cuda'])
+
+def make_checkpoint(model, model_kwargs, layout=None, copy=False):
+  '''
+  Returns the state dict of a model together with a manifest to rebuild it:
+  the model class (from transformer.py), its constructor arguments and the dataset layout it was trained on.
+  copy snapshots the state dict on the CPU, so it does not change when training goes on
+  '''
+  manifest = {'model_class': type(model).__name__, 'model_kwargs': model_kwargs, 'layout': layout or {}}
+  state_dict = snapshot(model.state_dict()) if copy else model.state_dict()
+  return {'manifest': manifest, 'state_dict': state_dict}
+
+def save_checkpoint(model, path, model_kwargs, layout=None):
+  '''
+  Saves the state dict of a model together with its manifest, see make_checkpoint
+  '''
+  torch.save(make_checkpoint(model, model_kwargs, layout), path)
+
+class AsyncCheckpointWriter:
+  '''
+  Writes checkpoints on a background thread so training does not wait for the disk.
+  save() snapshots the state dict in memory and returns, the file is written to PATH.tmp and renamed to PATH,
+  so an interrupted write never leaves a broken checkpoint. The last saved snapshot (the best model so far)
+  stays in memory and best_model() rebuilds it without reading the file back. close() ends the thread once everything is written.
+  '''
+  def __init__(self):
+    self.queue = queue.Queue()
+    self.best = None
+    self.error = None
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def save(self, model, path, model_kwargs, layout=None):
+    self.best = make_checkpoint(model, model_kwargs, layout, copy=True)
+    self.write(self.best, path)
+
+  def write(self, checkpoint, path):
+    '''
+    Queues any dict for writing, its tensors must not change anymore (see snapshot)
+    '''
+    self.queue.put((checkpoint, path))
+
+  def run(self):
+    while True:
+      item = self.queue.get()
+      if item is None: # queued by close()
+        self.queue.task_done()
+        return
+      checkpoint, path = item
+      try:
+        torch.save(checkpoint, path + '.tmp')
+        os.replace(path + '.tmp', path)
+      except Exception as error:
+        self.error = error
+      finally:
+        self.queue.task_done()
+
+  def wait(self):
+    '''
+    Blocks until all queued checkpoints are on disk
+    '''
+    self.queue.join()
+    if self.error is not None:
+      raise self.error
+
+  def close(self):
+    '''
+    Writes the queued checkpoints and stops the thread, the writer cannot be used afterwards
+    '''
+    self.queue.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+
+  def best_checkpoint(self):
+    '''
+    The last saved checkpoint, raises if none was saved (the validation loss never decreased, e.g. it was NaN in every epoch)
+    '''
+    if self.best is None:
+      raise Exception('no checkpoint was saved, the validation loss never decreased below its initial value')
+    return self.best
+
+  def best_model(self, device='cpu'):
+    best = self.best_checkpoint()
+    return build_model(best['manifest'], best['state_dict']).to(device)
+
+def torch_load(path, device='cpu', mmap=False):
+  '''
+  torch.load that works from torch 1.12 on, mmap maps the tensors from the file instead of reading them (torch >= 2.1)
+  '''
+  kwargs = {'map_location': device, 'weights_only': False}
+  if mmap:
+    kwargs['mmap'] = True
+  try:
+    return torch.load(path, **kwargs)
+  except TypeError: # torch < 1.13 has no weights_only and torch < 2.1 no mmap argument
+    return torch.load(path, map_location=device)
+
+def load_checkpoint(path, device='cpu', mmap=False):
+  '''
+  Returns the state dict and the manifest of a checkpoint, the manifest is None for a whole model saved with torch.save(model, PATH)
+  '''
+  checkpoint = torch_load(path, device, mmap)
+  if isinstance(checkpoint, torch.nn.Module):
+    return checkpoint.state_dict(), None
+  return checkpoint['state_dict'], checkpoint['manifest']
+
+def build_model(manifest, state_dict=None, models=None, class_suffix=''):
+  '''
+  Creates the model described by a checkpoint manifest and loads the state dict into it, also for the pruned models of prune.py and the int8 models of quantize.py.
+  models is the module to take the model class from, transformer.py by default. class_suffix selects a variant of the class with the same parameters,
+  e.g. models=transformer_store_attn, class_suffix='_store_attn' for the models that keep their attention weights for visualization
+  '''
+  if models is None:
+    import transformer as models
+  model_class = getattr(models, manifest['model_class'] + class_suffix)
+  # e.g. the _store_attn classes lack the options added to transformer.py later (temporal_window, temporal_attention, temporal_merge, early_exit, ...)
+  arguments = inspect.signature(model_class.__init__).parameters
+  unsupported = [key for key in manifest['model_kwargs'] if key not in arguments]
+  if unsupported:
+    raise Exception('%s does not support the options %s the checkpoint was trained with' % (model_class.__name__, ', '.join(unsupported)))
+  model = model_class(**manifest['model_kwargs'])
+  if manifest.get('pruning'): # a smaller model of prune.py
+    from compression import resize_model
+    resize_model(model, manifest['pruning'])
+  quantization = manifest.get('quantization')
+  if quantization: # an int8 model of quantize.py
+    from compression import quantize_model, quantized_engine
+    with quantized_engine(quantization['engine']): # the int8 weights are packed for the engine when they are loaded
+      model = quantize_model(model, quantization['mode'], quantization['engine'])
+      if state_dict is not None:
+        model.load_state_dict(state_dict)
+    return model
+  if state_dict is not None:
+    try:
+      model.load_state_dict(state_dict, assign=True) # keeps memory mapped tensors instead of copying them
+    except TypeError: # torch < 2.1 has no assign argument
+      model.load_state_dict(state_dict)
+  return model
+
+def check_all_frames(manifest, source):
+  '''
+  Raises for a model trained on the selected frames of its segments (MODEL: FRAME_SELECTION), which needs the positions of those frames,
+  in the scripts that run models on segments of all frames only
+  '''
+  if manifest and manifest['layout'].get('frame_selection'):
+    raise Exception('%s was trained on the %d frames with the most motion of every segment (MODEL: FRAME_SELECTION) and needs their positions, '
+                    'this script only runs models on segments of all frames' % (source, manifest['layout']['frame_selection']))
+
+def load_model(path, device='cpu', mmap=False, all_frames=False):
+  '''
+  Loads a model saved with save_checkpoint, or a whole model saved with torch.save(model, PATH).
+  all_frames: the caller only passes segments of all frames, raises for a model trained with MODEL: FRAME_SELECTION
+  '''
+  checkpoint = torch_load(path, device, mmap)
+  if isinstance(checkpoint, torch.nn.Module):
+    return checkpoint
+  if all_frames:
+    check_all_frames(checkpoint['manifest'], path)
+  return build_model(checkpoint['manifest'], checkpoint['state_dict']).to(device)
+
+def autocast(device, dtype=None):
+  '''
+  Mixed precision context for forward passes, dtype is 'bfloat16' or 'float16' (CUDA only), None or False runs in float32.
+  The LayerNorms, attention softmax and output log_softmax of the models in transformer.py stay in float32
+  '''
+  if not dtype:
+    return contextlib.nullcontext()
+  return torch.autocast(device_type=torch.device(device).type, dtype=getattr(torch, dtype))
+
+def compile_model(model):
+  '''
+  torch.compile with static shapes (torch >= 2.0), returns the model itself on older torch versions
+  '''
+  if not hasattr(torch, 'compile'):
+    return model
+  return torch.compile(model, dynamic=False)
+
+def pad_batch(x, batch_size):
+  '''
+  Pads a batch with zeros up to batch_size samples, so a compiled model sees the same shape for a smaller last batch
+  '''
+  if len(x) >= batch_size:
+    return x
+  return torch.cat([x, x.new_zeros((batch_size - len(x),) + x.shape[1:])])
+
 def smaller_than_mean(lengths, mean):
     return len([x for x in lengths if x <= mean])
 
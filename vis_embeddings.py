@@ -19,7 +19,7 @@ import pickle
 import os
 import argparse
 import yaml
-from utils import print_statistics, SetupLogger, evaluate_all, evaluate_category, conv_to_float, SetupFolders, train_acc, SetupVisFolders
+from utils import print_statistics, SetupLogger, evaluate_all, evaluate_category, conv_to_float, SetupFolders, train_acc, SetupVisFolders, load_checkpoint, check_all_frames, build_model
 
 
 # %%
@@ -857,20 +857,19 @@ elif "NTU" in dataset:
 PATH = os.path.join('/home/s2435462/HRC/results/', dataset, filename, 'models', filename+'_fold_1.pt')
 # PATH = '/home/s2435462/HRC/results/'+dataset+'/NTU_2D_ttpcc1/models'
 # PATH = '/data/s3447707/MasterThesis/trained_models/' + filename + '.pt'
-model_ = torch.load(PATH)
+state_dict, manifest = load_checkpoint(PATH)
+check_all_frames(manifest, PATH)
 
 
 if not os.path.exists('/home/s2435462/HRC/results/tsne_silhouette' +'/'+ filename):
     os.mkdir('/home/s2435462/HRC/results/tsne_silhouette' +'/'+ filename)
-NEW_PATH = '/home/s2435462/HRC/results/tsne_silhouette' +'/'+ filename + '/state_dict.pt'
-if not os.path.isfile(NEW_PATH):
-    torch.save(model_.state_dict(), NEW_PATH)
-    print('\nsave model state dict to', NEW_PATH)
-else:
-    print('\model state dict %s already exists' % (NEW_PATH))
 
 # %%
-if model_type == 'ttspcc2':
+if manifest is not None:
+    # the checkpoint describes its model
+    model = build_model(manifest, state_dict)
+# whole models saved without a manifest
+elif model_type == 'ttspcc2':
     kernel = tuple(map(int, kernel.split(',')))
     stride = tuple(map(int, stride.split(',')))
     model = TubeletTemporalSpatialPart_concat_chan_2_Transformer(dataset=dataset, embed_dim_ratio=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, kernel=kernel, stride=stride, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1, pad_mode = 'constant')
@@ -880,7 +879,8 @@ elif model_type == 'spatial-temporal':
 
 
 #Load model state dict
-model.load_state_dict(torch.load(NEW_PATH), strict=False)
+if manifest is None:
+    model.load_state_dict(state_dict, strict=False)
 model.to(device)
 model.eval()
 
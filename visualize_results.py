@@ -13,6 +13,7 @@ import torch.nn.functional as F
 import numpy as np
 
 from trajectory import Trajectory, extract_fixed_sized_segments, split_into_train_and_test, remove_short_trajectories, get_categories, get_UTK_categories
+import transformer_store_attn
 from transformer_store_attn import TubeletTemporalSpatialPart_concat_chan_2_Transformer_store_attn, TubeletTemporalPart_concat_chan_1_Transformer_store_attn, TubeletTemporalTransformer_store_attn, TubeletTemporalPart_mean_chan_1_Transformer_store_attn, TubeletTemporalPart_mean_chan_2_Transformer_store_attn, TubeletTemporalPart_concat_chan_2_Transformer_store_attn, TemporalTransformer_4_store_attn, TemporalTransformer_3_store_attn, TemporalTransformer_2_store_attn, BodyPartTransformer_store_attn, SpatialTemporalTransformer_store_attn, TemporalTransformer_store_attn
 from trajectory import TrajectoryDataset, Trajectory, extract_fixed_sized_segments, split_into_train_and_test, remove_short_trajectories, get_NTU_categories, get_categories
 import pickle
@@ -20,7 +21,7 @@ import os
 import argparse
 import yaml
 from einops import rearrange
-from utils import print_statistics, SetupLogger, evaluate_all, evaluate_category, conv_to_float, SetupFolders, train_acc, SetupVisFolders
+from utils import print_statistics, SetupLogger, evaluate_all, evaluate_category, conv_to_float, SetupFolders, train_acc, SetupVisFolders, load_checkpoint, check_all_frames, build_model
 
 from visualize_attention_weights import visualize_attention_weights
 from visualize_skeleton_and_attention import visualize_skeleton_and_attention
@@ -92,19 +93,15 @@ if cfg['DECOMPOSED']['ENABLE']:
 PATH = os.path.join('/home/s2435462/HRC/results/', dataset, filename, 'models', filename+'_fold_1.pt')
 # PATH = '/home/s2435462/HRC/results/'+dataset+'/NTU_2D_ttpcc1/models'
 # PATH = '/data/s3447707/MasterThesis/trained_models/' + filename + '.pt'
-model_ = torch.load(PATH)
+state_dict, manifest = load_checkpoint(PATH)
+check_all_frames(manifest, PATH)
 
 
-NEW_PATH = base_folder +'/'+ filename + 'state_dict.pt'
-if not os.path.isfile(NEW_PATH):
-    torch.save(model_.state_dict(), NEW_PATH)
-    print('\nsave model state dict to', NEW_PATH)
-else:
-    print('\model state dict %s already exists' % (NEW_PATH))
-
-
-#Create model object
-if cfg['MODEL']['MODEL_TYPE'] == 'temporal':
+if manifest is not None:
+    # the checkpoint describes its model, the _store_attn variant of its class keeps the attention weights
+    model = build_model(manifest, state_dict, models=transformer_store_attn, class_suffix='_store_attn')
+#Create model object, whole models saved without a manifest
+elif cfg['MODEL']['MODEL_TYPE'] == 'temporal':
     model = TemporalTransformer_store_attn(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
 elif cfg['MODEL']['MODEL_TYPE'] == 'temporal_2':
     model = TemporalTransformer_2_store_attn(embed_dim=embed_dim, num_frames=segment_length, num_classes=num_classes, num_joints=num_joints, in_chans=in_chans, mlp_ratio=2., qkv_bias=True, qk_scale=None, dropout=0.1)
@@ -143,7 +140,8 @@ elif cfg['MODEL']['MODEL_TYPE'] == "ttspcc2":
 
 
 #Load model state dict
-model.load_state_dict(torch.load(NEW_PATH), strict=False)
+if manifest is None:
+    model.load_state_dict(state_dict, strict=False)
 model.eval()
 
 if cfg['DECOMPOSED']['ENABLE']: